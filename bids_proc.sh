@@ -12,12 +12,12 @@
 
 # set usage
 function display_usage {
-	echo -e "\033[0;35m++ usage: $0 [-h|--help] [--modality [research | clinical | altclinical | meg]] [-l|--list SUBJ_LIST] [SUBJ [SUBJ ...]] ++\033[0m"
+	echo -e "\033[0;35m++ usage: $0 [-h|--help] [--modality [research | clinical | altclinical | meg]] [--batch] [--warm_worker] [-l|--list SUBJ_LIST] [SUBJ [SUBJ ...]] ++\033[0m"
 	exit 1
 }
 
 #set defaults
-subj_list=false;
+subj_list=false; meg_batch_flag=""; warm_worker=false
 proc_research=true; proc_clinical=true; proc_altclinical=true; proc_meg=true
 
 # parse options
@@ -27,6 +27,8 @@ while [ -n "$1" ]; do
     	-h|--help) 		display_usage ;;	# help
         --modality)     modality=$2; shift ;; # modality to use
         -l|--list)      subj_list=$2; shift ;; #subject_list
+        --batch)        meg_batch_flag="--batch" ;; # never prompt during MEG conversion
+        --warm_worker)  warm_worker=true ;; # run Python steps in a worker with preloaded libraries
 	    *) 				subj=$1; break ;;	# prevent any further shifting by breaking)
     esac
     shift 	# shift to next argument
@@ -83,6 +85,13 @@ raw_meg_dir="${raw_dir}/MEG"
 
 key=${NEU_dir}/Scripts_and_Parameters/14N0061_key
 
+# all stages of this run record their timing and resource use into one log
+if [[ -z $BIDS_PROC_RUN_LOG ]]; then
+    export BIDS_PROC_RUN_LOG=$(python $scripts_dir/instrument.py new-log)
+fi
+instrument="python $scripts_dir/instrument.py run"
+py_run="python $scripts_dir/worker_run.py"
+
 #--------------------------------------------------------------------------------------------------------------------
 
 # REQUIREMENT CHECK
@@ -132,6 +141,41 @@ fi
 
 #--------------------------------------------------------------------------------------------------------------------
 
+# start a warm worker for the Python steps (stopped on exit unless it was already running)
+if [[ $warm_worker == 'true' ]]; then
+    python $scripts_dir/worker_daemon.py start
+    if [[ $? == 0 ]]; then
+        trap 'python $scripts_dir/worker_daemon.py stop' EXIT
+    fi
+fi
+
+# make missing BEM surfaces for all subjects at once so proc_meg.sh does not wait on them
+if [[ $proc_meg == 'true' ]]; then
+    python $scripts_dir/bem_batch.py "${subj_arr[@]}"
+
+    # in batch mode copy the .ds of every subject with raw MEG and precompute
+    # their trans inputs in one pool; proc_meg.sh --batch only finalizes them
+    if [ -n "$meg_batch_flag" ]; then
+        meg_subj_arr=()
+        for meg_subj in "${subj_arr[@]}"; do
+            meg_subj_name=$(grep "^${meg_subj}=" "$key" | head -n 1 | cut -d '=' -f 2 | tr -d '\r')
+            if [[ -n $meg_subj_name ]] && compgen -G "${raw_meg_dir}/*/${meg_subj_name}" > /dev/null; then
+                meg_subj_arr+=("$meg_subj")
+            fi
+        done
+        if [[ ${#meg_subj_arr[@]} -gt 0 ]]; then
+            $instrument --stage create_trans_meg_precompute -- python $scripts_dir/create_trans_meg.py \
+                --phase precompute \
+                --retrieve \
+                --pnum "${meg_subj_arr[@]}"
+        fi
+    fi
+
+    # fetch all emptyroom sessions the cohort needs at once (subjects whose .ds
+    # are not in sourcedata yet are handled by proc_meg.sh as before)
+    $instrument --stage emptyroom_prefetch -- $py_run $scripts_dir/emptyroom_planner.py "${subj_arr[@]}"
+fi
+
 # iterate through subjects
 for subj in "${subj_arr[@]}"; do
 
@@ -173,22 +217,26 @@ for subj in "${subj_arr[@]}"; do
 
                 if [ -d "$raw_session_dir" ]; then
 
-                    bash $scripts_dir/proc_research_anat.sh   \
+                    $instrument --stage research_anat --subject "$subj" -- \
+                        bash $scripts_dir/proc_research_anat.sh   \
                         --folder_type "$folder_type"  \
                         --raw_session_dir "$raw_session_dir"  \
                         "$subj"
 
-                    bash $scripts_dir/proc_dwi.sh   \
+                    $instrument --stage dwi --subject "$subj" -- \
+                        bash $scripts_dir/proc_dwi.sh   \
                         --folder_type "$folder_type"  \
                         --raw_session_dir "$raw_session_dir"  \
                         "$subj"
 
-                    bash $scripts_dir/proc_perf.sh   \
+                    $instrument --stage perf --subject "$subj" -- \
+                        bash $scripts_dir/proc_perf.sh   \
                         --folder_type "$folder_type"  \
                         --raw_session_dir "$raw_session_dir"  \
                         "$subj"
 
-                    bash $scripts_dir/proc_rsfmri.sh   \
+                    $instrument --stage rsfmri --subject "$subj" -- \
+                        bash $scripts_dir/proc_rsfmri.sh   \
                         --folder_type "$folder_type"  \
                         --raw_session_dir "$raw_session_dir"  \
                         "$subj"
@@ -199,7 +247,8 @@ for subj in "${subj_arr[@]}"; do
         ## PROCESS CLINICAL SCANS
         if [[ -d $subj_raw_clinical_dir ]] && [[ $proc_clinical == "true" ]]; then
             
-            bash $scripts_dir/proc_clinical_anat.sh \
+            $instrument --stage clinical_anat --subject "$subj" -- \
+                bash $scripts_dir/proc_clinical_anat.sh \
                 --folder_type "$folder_type" \
                 --subj_name "$subj_name" \
                 "$subj"
@@ -208,7 +257,8 @@ for subj in "${subj_arr[@]}"; do
         ## PROCESS ALTERNATE CLINICAL SCANS
         if [[ -d $subj_raw_altclinical_dir ]] && [[ $proc_altclinical == "true" ]]; then
             
-            bash $scripts_dir/proc_altclinical_anat.sh \
+            $instrument --stage altclinical_anat --subject "$subj" -- \
+                bash $scripts_dir/proc_altclinical_anat.sh \
                 --folder_type "$folder_type" \
                 --subj_name "$subj_name" \
                 "$subj"
@@ -217,13 +267,16 @@ for subj in "${subj_arr[@]}"; do
         ## PROCESS MEG SCANS
         if [[ -d $subj_raw_meg_dir ]] && [[ $proc_meg == "true" ]]; then
             
-            bash $scripts_dir/proc_meg.sh \
+            $instrument --stage meg --subject "$subj" -- \
+                bash $scripts_dir/proc_meg.sh \
                 --folder_type "$folder_type" \
+                $meg_batch_flag \
                 "$subj"
         fi
     done
 
     # UPDATE PARTICIPANTS.TSV
-    python $scripts_dir/update_participants.py "$subj"
+    $instrument --stage update_participants --subject "$subj" -- \
+        $py_run $scripts_dir/update_participants.py "$subj"
 
 done
\ No newline at end of file
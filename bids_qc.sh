@@ -12,12 +12,12 @@
 
 # set usage
 function display_usage {
-	echo -e "\033[0;35m++ usage: $0 [-h|--help] [-l|--list SUBJ_LIST] [SUBJ [SUBJ ...]] ++\033[0m"
+	echo -e "\033[0;35m++ usage: $0 [-h|--help] [--prescreen | --render | --ingest DECISIONS_FILE] [-l|--list SUBJ_LIST] [SUBJ [SUBJ ...]] ++\033[0m"
 	exit 1
 }
 
 #set defaults
-subj_list=false
+subj_list=false; render=false; prescreen=false; decisions_file=""
 
 # parse options
 while [ -n "$1" ]; do
@@ -25,6 +25,9 @@ while [ -n "$1" ]; do
     case "$1" in
     	-h|--help) 		display_usage ;;	# help
         -l|--list)      subj_list=$2; shift ;; #subject_list
+        --render)       render=true ;; # headless montages + HTML index instead of afni
+        --prescreen)    prescreen=true; render=true ;; # auto-pass clear registrations, render the rest
+        --ingest)       decisions_file=$2; shift ;; # decisions exported from the HTML index
 	    *) 				subj=$1; break ;;	# prevent any further shifting by breaking)
     esac
     shift 	# shift to next argument
@@ -43,8 +46,13 @@ else
     subj_arr=("$@")
 fi
 
+# record decisions exported by the HTML index in the qc status store
+if [[ -n $decisions_file ]]; then
+    render=true
+fi
+
 # check that length of subject list is greater than zero
-if [[ ! ${#subj_arr} -gt 0 ]]; then
+if [[ ! ${#subj_arr} -gt 0 ]] && [[ -z $decisions_file ]]; then
 	echo -e "\033[0;35m++ Subject list length is zero; please specify at least one subject to perform batch processing on ++\033[0m"
 	display_usage
 fi
@@ -55,6 +63,12 @@ fi
 
 unameOut="$(uname -s)"
 case "${unameOut}" in
+    Linux*)     NEU_dir="/shares/NEU"
+                # the afni review needs Mac OS; headless rendering works anywhere
+                if [[ $render != "true" ]]; then
+                    echo -e "\033[0;35m++ Interactive QC must be run on Mac OS. Use --render on Linux.\
+                             Exiting... ++\033[0m"; exit 1
+                fi;;
     Darwin*)    NEU_dir="/Volumes/shares/NEU";;
     *)          echo -e "\033[0;35m++ Unrecognized OS. Must be Mac OS in order to run script.\
 						 Exiting... ++\033[0m"; exit 1
@@ -62,6 +76,20 @@ esac
 
 bids_root="${NEU_dir}/Data"
 registration_qc_dir="$bids_root/derivatives/registration_qc/"
+scripts_dir=${NEU_dir}/Users/price/dev/bids-proc/scripts
+
+# headless QC: render montages for review in a browser, or record the
+# decisions exported from the review page
+if [[ -n $decisions_file ]]; then
+    python $scripts_dir/qc_sheets.py ingest "$decisions_file"
+    exit $?
+elif [[ $prescreen == "true" ]]; then
+    python $scripts_dir/qc_metric.py --render "${subj_arr[@]}"
+    exit $?
+elif [[ $render == "true" ]]; then
+    python $scripts_dir/qc_sheets.py render "${subj_arr[@]}"
+    exit $?
+fi
 
 #--------------------------------------------------------------------------------------------------------------------
 
@@ -93,15 +121,16 @@ for subj in "${subj_arr[@]}"; do
         mkdir "$subj_qc_dir"
     fi
 
-    qc_output_file="$subj_qc_dir"/qc_output.txt
-    if [[ -f $qc_output_file ]]; then
+    # decisions are kept in the cohort qc status store (qc_status.py)
+    qc_status="python $scripts_dir/qc_status.py"
+    if [[ -n $($qc_status list --subj "$subj") ]]; then
         echo -e "\033[0;35m++ Registration QC has already been run on $subj. Do you want to run again and overwrite the previous results? Enter y if yes and n if no. ++\033[0m"
         read -r ynresponse
         ynresponse=$(echo "$ynresponse" | tr '[:upper:]' '[:lower:]')
 
         if [ "$ynresponse" == "y" ]; then
             echo -e "\033[0;35m++ Running QC on $subj again. ++\033[0m"
-            rm -f "$qc_output_file"
+            $qc_status clear "$subj"
         else
             echo -e "\033[0;35m++ OK. Exiting... ++\033[0m"
             exit 1
@@ -132,10 +161,10 @@ for subj in "${subj_arr[@]}"; do
 
                 if [ "$ynresponse" == "y" ]; then
                     echo -e "\033[0;35m++ Registration correct. Continuing... ++\033[0m"
-                    echo "ses-${ses_prefix}clinical${ses_suffix}=success" >> "$qc_output_file"
+                    $qc_status set "$subj" ses-${ses_prefix}clinical${ses_suffix} success --source bids_qc
                 else
                     echo -e "\033[0;35m++ Registration not correct. You need to fix registrations for sub-${subj}/ses-${ses_prefix}clinical${ses_suffix}/anat. Continuing... ++\033[0m"
-                    echo "ses-${ses_prefix}clinical${ses_suffix}=failure" >> "$qc_output_file"
+                    $qc_status set "$subj" ses-${ses_prefix}clinical${ses_suffix} failure --source bids_qc
                 fi
             fi
 
@@ -154,10 +183,10 @@ for subj in "${subj_arr[@]}"; do
 
             if [ "$ynresponse" == "y" ]; then
                 echo -e "\033[0;35m++ Registration correct. Continuing... ++\033[0m"
-                echo "ses-research${ses_suffix}=success" >> "$qc_output_file"
+                $qc_status set "$subj" ses-research${ses_suffix} success --source bids_qc
             else
                 echo -e "\033[0;35m++ Registration not correct. You need to fix registrations for sub-${subj}/ses-research${ses_suffix}/anat. Continuing... ++\033[0m"
-                echo "ses-research${ses_suffix}=failure" >> "$qc_output_file"
+                $qc_status set "$subj" ses-research${ses_suffix} failure --source bids_qc
             fi
         fi
 
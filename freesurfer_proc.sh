@@ -58,6 +58,7 @@ fi
 
 #---------------------------------------------------------------------------------------------------------------------
 
+scripts_dir=${NEU_dir}/Users/price/dev/bids-proc/scripts
 bids_root="${NEU_dir}/Data"
 derivatives_dir="${bids_root}/derivatives"
 fs_dir="${derivatives_dir}/freesurfer-${version}"
@@ -80,29 +81,17 @@ if [[ ! -d $bids_root/sub-"$subj"/ses-$session/anat ]]; then
     fi
 fi
 
-subj_qc_dir=$registration_qc_dir/sub-${subj}
-qc_output_file="$subj_qc_dir"/qc_output.txt
-if [[ ! -f $qc_output_file ]]; then
-	echo -e "\033[0;35m++ Subject does not have registration qc output file. Please run bids_qc.sh to check whether registration succeeded. Exiting... ++\033[0m"
-    exit 1
+# registration qc status is kept cohort-wide by qc_status.py
+ses_status=$(python $scripts_dir/qc_status.py get "$subj" ses-$session)
+
+if [[ $ses_status == 'success' ]]; then
+	echo -e "\033[0;32m++ Subject registration was a success. ++\033[0m"
+elif [[ $ses_status == 'failure' ]]; then
+	echo -e "\033[0;35m++ $subj registration failed for ses-$session. Please fix registration before running Freesurfer. Exiting... ++\033[0m"
+	exit 1
 else
-	ses_status=''
-	for line in $(cat $qc_output_file); do
-        if [[ $line == ses-$session=* ]]; then
-            ses_status=$(echo "${line#*'='}" | tr -d '\r' 2>&1)
-			break
-        fi
-    done
-	
-	if [[ $ses_status == 'success' ]]; then
-		echo -e "\033[0;32m++ Subject registration was a success. ++\033[0m"
-	elif [[ $ses_status == 'failure' ]]; then
-		echo -e "\033[0;35m++ $subj registration failed for ses-$session. Please fix registration before running Freesurfer. Exiting... ++\033[0m"
-    	exit 1
-	elif [[ $ses_status == '' ]]; then
-		echo -e "\033[0;35m++ $subj does not have registration qc output for ses-$session. Please run bids_qc.sh again to check whether registration succeeded. Exiting... ++\033[0m"
-    	exit 1
-	fi
+	echo -e "\033[0;35m++ $subj does not have registration qc output for ses-$session. Please run bids_qc.sh to check whether registration succeeded. Exiting... ++\033[0m"
+	exit 1
 fi
 #---------------------------------------------------------------------------------------------------------------------
 
@@ -110,12 +99,13 @@ fi
 
 subj_fs_dir=$fs_dir/sub-${subj}_ses-$session
 anat_dir=$bids_root/sub-$subj/ses-$session/anat
+instrument="python $scripts_dir/instrument.py run --subject $subj --session ses-$session"
 
 if [ -d "${subj_fs_dir}" ]; then
 	echo -e "\033[0;35m++ Freesurfer has already been run. Please delete to rerun. ++\033[0m"
 elif [[ -f "${anat_dir}"/sub-"${subj}"_ses-${session}_rec-axialized_T1w.nii.gz ]] && [[ -f "${anat_dir}"/sub-"${subj}"_ses-${session}_rec-axialized_T2w.nii.gz  ]]; then
 	echo -e "\033[0;32m++ Running Freesurfer with T1 and T2 images. ++\033[0m"
-	recon-all \
+	$instrument -- recon-all \
 		-s sub-"${subj}"_ses-$session \
 		-sd $fs_dir \
 		-all \
@@ -125,7 +115,7 @@ elif [[ -f "${anat_dir}"/sub-"${subj}"_ses-${session}_rec-axialized_T1w.nii.gz ]
 		-contrasurfreg
 elif [[ -f "${anat_dir}"/sub-"${subj}"_ses-${session}_rec-axialized_T1w.nii.gz ]] && [[ -f "${anat_dir}"/sub-"${subj}"_ses-${session}_rec-axialized_FLAIR.nii.gz  ]]; then
 	echo -e "\033[0;32m++ Running Freesurfer with T1 and FLAIR images. ++\033[0m"
-	recon-all \
+	$instrument -- recon-all \
 		-s sub-"${subj}"_ses-$session \
 		-sd $fs_dir \
 		-all \
@@ -135,7 +125,7 @@ elif [[ -f "${anat_dir}"/sub-"${subj}"_ses-${session}_rec-axialized_T1w.nii.gz ]
 		-contrasurfreg
 elif [[ -f "${anat_dir}"/sub-"${subj}"_ses-${session}_rec-axialized_T1w.nii.gz ]]; then
 	echo -e "\033[0;32m++ Running Freesurfer with T1 image only. ++\033[0m"
-	recon-all \
+	$instrument -- recon-all \
 		-s sub-"${subj}"_ses-$session \
 		-sd $fs_dir \
 		-all \
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Convert, axialize, deface and register the anatomical scans of one subject
+session. The clinical, altclinical and research sessions only differ in the
+SESSION_SPECS entries below; proc_*_anat.sh are thin wrappers around this.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import os
+from pathlib import Path
+import shutil
+import sys
+
+from colors import Colors
+from compression import dcm2niix_args
+from dedup_store import absorb_paths
+from instrument import run_command
+from neu_paths import (bids_root, files_dir, raw_altclinical_dir,
+                       raw_clinical_dir, ses_suffix, sourcedata_dir)
+from series_catalog import output_suffix, scan_session, select_series
+from staging import dir_size, publish, scratch_dir
+
+# each contrast lists its raw folder candidates in order of preference as
+# (folder, suffix dcm2niix appends to the output name), or names a role of the
+# raw series catalog (see series_catalog.py and files/series_rules.json); the
+# T1w is the reference that every other contrast is registered to with 'cost'
+SESSION_SPECS = {
+    'clinical': {
+        'raw_dir': lambda args: raw_clinical_dir / args.folder_type / args.subj_name / 'mri',
+        'contrasts': [
+            {'suffix': 'T1w', 'acq': '', 'raw_folders': [('mprage', '')]},
+            {'suffix': 'T2w', 'acq': '', 'raw_folders': [('t2', '')], 'cost': 'lpc'},
+            {'suffix': 'FLAIR', 'acq': '', 'raw_folders': [('flair', '')], 'cost': 'nmi'},
+        ],
+    },
+    'altclinical': {
+        'raw_dir': lambda args: raw_altclinical_dir / args.folder_type / args.subj_name,
+        'contrasts': [
+            {'suffix': 'T1w', 'acq': '', 'raw_folders': [('t1', '')]},
+            {'suffix': 'T2w', 'acq': '', 'raw_folders': [('t2', '')], 'cost': 'lpc'},
+            {'suffix': 'FLAIR', 'acq': '', 'raw_folders': [('fl', '')], 'cost': 'nmi'},
+        ],
+    },
+    'research': {
+        'raw_dir': lambda args: Path(args.raw_session_dir),
+        'require_any': True,
+        'contrasts': [
+            {'suffix': 'T1w', 'acq': '', 'role': 't1w'},
+            {'suffix': 'T2w', 'acq': 'fatsat', 'role': 't2w_fatsat', 'cost': 'lpc'},
+        ],
+    },
+}
+
+
+def bids_name(subj, session, contrast, rec=False):
+    """BIDS file stem for a contrast, optionally with the rec-axialized entity."""
+
+    entities = [f'sub-{subj}', f'ses-{session}']
+    if contrast['acq']:
+        entities.append(f"acq-{contrast['acq']}")
+    if rec:
+        entities.append('rec-axialized')
+    entities.append(contrast['suffix'])
+
+    return '_'.join(entities)
+
+
+def find_raw_folder(raw_dir, contrast, series=None):
+    """Return (raw folder path, dcm2niix suffix) of the first existing candidate.
+
+    Contrasts with a catalog role are looked up in series (the session catalog).
+    """
+
+    if 'role' in contrast:
+        names = select_series(contrast['role'], series or {})
+        if names:
+            return raw_dir / names[0], output_suffix(contrast['role'], names[0])
+        return None, None
+
+    for folder, dcm_suffix in contrast['raw_folders']:
+        if (raw_dir / folder).is_dir():
+            return raw_dir / folder, dcm_suffix
+
+    return None, None
+
+
+def run_cmd(cmd, cwd, env=None, **labels):
+    """Run an external (AFNI/dcm2niix) command in cwd and return its exit code.
+
+    Each command is recorded as a stage named after the tool in the run log.
+    """
+
+    return run_command(cmd, cwd=cwd, env=env, **labels)
+
+
+def thread_env(n_threads):
+    """Environment that caps OpenMP threads for one of several parallel jobs."""
+
+    env = os.environ.copy()
+    env['OMP_NUM_THREADS'] = str(n_threads)
+
+    return env
+
+
+def convert_dicom(raw_folder, work_dir, out_stem, dcm_suffix, **labels):
+    """Run dcm2niix_afni into work_dir; return the converted nifti or None."""
+
+    run_cmd(
+        ['dcm2niix_afni', '-o', str(work_dir)] + dcm2niix_args() + ['-f', out_stem, str(raw_folder)],
+        cwd=work_dir, **labels
+    )
+    nii_file = work_dir / f'{out_stem}{dcm_suffix}.nii.gz'
+    json_file = work_dir / f'{out_stem}{dcm_suffix}.json'
+    if not json_file.is_file() or not nii_file.is_file():
+        return None
+
+    return nii_file
+
+
+def process_t1(subj, session, contrast, raw_folder, dcm_suffix, work_dir):
+    """Convert, axialize and deface the T1w inside work_dir.
+
+    Returns a dict of the produced files or None if any step failed.
+    """
+
+    raw_stem = bids_name(subj, session, contrast)
+    rec_stem = bids_name(subj, session, contrast, rec=True)
+    labels = {'subject': subj, 'session': f'ses-{session}', 'contrast': contrast['suffix']}
+
+    raw_nii = convert_dicom(raw_folder, work_dir, raw_stem, dcm_suffix, **labels)
+    if raw_nii is None:
+        return None
+
+    # axialize t1 nifti
+    run_cmd([
+        'fat_proc_axialize_anat',
+        '-inset', raw_nii.name,
+        '-refset', str(files_dir / 'TT_N27+tlrc'),
+        '-prefix', f'{rec_stem}_temp',
+        '-mode_t1w',
+        '-extra_al_inps', '-nomask',
+        '-focus_by_ss',
+        '-no_qc_view',
+        '-no_cmd_out',
+    ], cwd=work_dir, **labels)
+
+    # deface scan
+    run_cmd([
+        '@afni_refacer_run',
+        '-input', f'{rec_stem}_temp.nii.gz',
+        '-mode_deface',
+        '-no_images',
+        '-prefix', f'{rec_stem}.nii.gz',
+    ], cwd=work_dir, **labels)
+
+    outputs = {
+        'raw': raw_nii,
+        'json': work_dir / f'{raw_stem}{dcm_suffix}.json',
+        'axialized': work_dir / f'{rec_stem}_temp.nii.gz',
+        'defaced': work_dir / f'{rec_stem}.nii.gz',
+        'face': work_dir / f'{rec_stem}.face.nii.gz',
+    }
+    if not all(f.is_file() for f in outputs.values()):
+        return None
+
+    return outputs
+
+
+def register_contrast(subj, session, contrast, raw_folder, dcm_suffix,
+                      t1_file, face_file, work_dir, n_threads):
+    """Convert a contrast and register it to the axialized, defaced T1w.
+
+    Returns a dict of the produced files or None if any step failed.
+    """
+
+    raw_stem = bids_name(subj, session, contrast)
+    rec_stem = bids_name(subj, session, contrast, rec=True)
+    labels = {'subject': subj, 'session': f'ses-{session}', 'contrast': contrast['suffix']}
+    env = thread_env(n_threads)
+
+    raw_nii = convert_dicom(raw_folder, work_dir, raw_stem, dcm_suffix, **labels)
+    if raw_nii is None:
+        return None
+
+    run_cmd([
+        '3dAllineate',
+        '-base', str(t1_file),
+        '-master', str(t1_file),
+        '-input', raw_nii.name,
+        '-cost', contrast['cost'],
+        '-source_automask',
+        '-cmass',
+        '-prefix', f'{rec_stem}_temp.nii.gz',
+    ], cwd=work_dir, env=env, **labels)
+
+    # remove face voxels using the T1w refacer mask
+    run_cmd([
+        '3dcalc',
+        '-a', str(face_file),
+        '-b', f'{rec_stem}_temp.nii.gz',
+        '-expr', 'iszero(a)*b',
+        '-prefix', f'{rec_stem}.nii.gz',
+    ], cwd=work_dir, env=env, **labels)
+
+    outputs = {
+        'raw': raw_nii,
+        'json': work_dir / f'{raw_stem}{dcm_suffix}.json',
+        'axialized': work_dir / f'{rec_stem}_temp.nii.gz',
+        'defaced': work_dir / f'{rec_stem}.nii.gz',
+    }
+    if not all(f.is_file() for f in outputs.values()):
+        return None
+
+    return outputs
+
+
+def publish_outputs(outputs, subj, session, contrast, anat_dir, source_anat_dir):
+    """Publish finished files from the scratch dir into the BIDS/sourcedata tree.
+
+    The BIDS image is published last since its presence marks the contrast
+    as done for later runs. Sourcedata files identical to ones already
+    stored (e.g. a re-run) are linked to the stored copy.
+    """
+
+    raw_stem = bids_name(subj, session, contrast)
+    rec_stem = bids_name(subj, session, contrast, rec=True)
+
+    source_files = [publish(outputs['raw'], source_anat_dir / f'{raw_stem}.nii.gz'),
+                    publish(outputs['axialized'], source_anat_dir / f'{rec_stem}.nii.gz')]
+    if 'face' in outputs:
+        source_files.append(publish(outputs['face'], source_anat_dir / f'{rec_stem}.face.nii.gz'))
+    absorb_paths(source_files)
+    publish(outputs['json'], anat_dir / f'{rec_stem}.json')
+    publish(outputs['defaced'], anat_dir / f'{rec_stem}.nii.gz')
+
+
+def process_session(subj, session, spec, raw_dir, n_jobs=2):
+    """Run the anat pipeline for every contrast of a session spec.
+
+    Returns the number of contrasts that failed.
+    """
+
+    anat_dir = bids_root / f'sub-{subj}' / f'ses-{session}' / 'anat'
+    source_anat_dir = sourcedata_dir / f'sub-{subj}' / f'ses-{session}' / 'anat'
+
+    series = None
+    if any('role' in contrast for contrast in spec['contrasts']):
+        series = scan_session(raw_dir)
+    raw_folders = {}
+    for contrast in spec['contrasts']:
+        raw_folders[contrast['suffix']] = find_raw_folder(raw_dir, contrast, series)
+
+    if spec.get('require_any') and not any(f for f, _ in raw_folders.values()):
+        print(
+            Colors.PURPLE,
+            f'++ {subj} does not have any recognized anat directory in {raw_dir} Exiting... ++',
+            Colors.END
+        )
+        return 1
+
+    anat_dir.mkdir(parents=True, exist_ok=True)
+    source_anat_dir.mkdir(parents=True, exist_ok=True)
+
+    t1_contrast = spec['contrasts'][0]
+    others = [
+        c for c in spec['contrasts'][1:]
+        if raw_folders[c['suffix']][0] is not None
+        and not (anat_dir / f"{bids_name(subj, session, c, rec=True)}.nii.gz").is_file()
+    ]
+    n_failed = 0
+
+    size_hint = sum(dir_size(f) for f, _ in raw_folders.values() if f is not None)
+    with scratch_dir(prefix=f'anat_{subj}_{session}_', size_hint=size_hint) as scratch:
+
+        # anat t1 dicom to nifti
+        t1_rec_stem = bids_name(subj, session, t1_contrast, rec=True)
+        t1_file = anat_dir / f'{t1_rec_stem}.nii.gz'
+        face_file = source_anat_dir / f'{t1_rec_stem}.face.nii.gz'
+        cached_t1 = scratch / t1_file.name
+        cached_face = scratch / face_file.name
+        t1_raw_folder, t1_dcm_suffix = raw_folders[t1_contrast['suffix']]
+
+        if not t1_file.is_file() and t1_raw_folder is not None:
+            t1_dir = scratch / 'T1w'
+            t1_dir.mkdir()
+            t1_outputs = process_t1(
+                subj, session, t1_contrast, t1_raw_folder, t1_dcm_suffix, t1_dir
+            )
+            if t1_outputs is None:
+                print(Colors.PURPLE, f'++ {subj} ses-{session} T1 conversion failed. ++', Colors.END)
+                n_failed += 1
+            else:
+                # keep scratch copies of the T1w and face mask for registration
+                shutil.copy(t1_outputs['defaced'], cached_t1)
+                shutil.copy(t1_outputs['face'], cached_face)
+                publish_outputs(t1_outputs, subj, session, t1_contrast, anat_dir, source_anat_dir)
+        elif others and t1_file.is_file() and face_file.is_file():
+            # cache existing T1w outputs locally once for all registrations
+            shutil.copy(t1_file, cached_t1)
+            shutil.copy(face_file, cached_face)
+
+        if not others:
+            return n_failed
+
+        if not cached_t1.is_file() or not cached_face.is_file():
+            for contrast in others:
+                print(
+                    Colors.PURPLE,
+                    f"++ {subj} ses-{session} {contrast['suffix']} will not be converted to BIDS because T1 conversion failed. ++",
+                    Colors.END
+                )
+            return n_failed + len(others)
+
+        # register remaining contrasts in parallel
+        n_workers = max(1, min(n_jobs, len(others)))
+        n_threads = max(1, (os.cpu_count() or 1) // n_workers)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = {}
+            for contrast in others:
+                work_dir = scratch / contrast['suffix']
+                work_dir.mkdir()
+                raw_folder, dcm_suffix = raw_folders[contrast['suffix']]
+                futures[contrast['suffix']] = (contrast, executor.submit(
+                    register_contrast, subj, session, contrast, raw_folder,
+                    dcm_suffix, cached_t1, cached_face, work_dir, n_threads
+                ))
+
+            for suffix, (contrast, future) in futures.items():
+                outputs = future.result()
+                label = 'T2' if suffix == 'T2w' else suffix
+                if outputs is None:
+                    print(Colors.PURPLE, f'++ {subj} ses-{session} {label} conversion failed. ++', Colors.END)
+                    n_failed += 1
+                else:
+                    publish_outputs(outputs, subj, session, contrast, anat_dir, source_anat_dir)
+
+    return n_failed
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "convert, axialize, deface and register anat scans into bids formatting"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("--session", choices=list(SESSION_SPECS), required=True,
+                        help="session type to process")
+    parser.add_argument("--folder_type", help="Patients, Post-op or Healthy_Volunteers")
+    parser.add_argument("--subj_name", help="subject name in Raw_Data (clinical sessions)")
+    parser.add_argument("--raw_session_dir", help="raw session directory (research session)")
+    parser.add_argument("--n_jobs", type=int, default=2,
+                        help="number of contrasts to register in parallel")
+    parser.add_argument("subj", help="subject p-number")
+
+    args = parser.parse_args()
+    spec = SESSION_SPECS[args.session]
+    session = args.session + ses_suffix(args.folder_type)
+
+    n_failed = process_session(
+        subj=args.subj,
+        session=session,
+        spec=spec,
+        raw_dir=spec['raw_dir'](args),
+        n_jobs=args.n_jobs
+    )
+    if n_failed:
+        sys.exit(1)
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Make BEM surfaces (mne watershed_bem) for every FreeSurfer subject that lacks
+them, several subjects at a time. Each subject runs in its own scratch
+SUBJECTS_DIR and the finished bem files are published into the FreeSurfer
+directory atomically, inner_skull.surf last, so proc_meg.sh only has to check
+for that file.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import os
+import subprocess
+import sys
+
+from colors import Colors
+from instrument import logs_dir, run_command
+from neu_paths import fs_dir
+from staging import publish, scratch_dir
+
+# written last; its presence means the BEM surfaces are complete
+COMPLETION_FILE = 'inner_skull.surf'
+
+
+def bem_done(fs_subj):
+
+    return (fs_dir / fs_subj / 'bem' / COMPLETION_FILE).is_file()
+
+
+def recon_done(fs_subj):
+
+    return (fs_dir / fs_subj / 'scripts' / 'recon-all.done').is_file()
+
+
+def meg_fs_subjects(pnum):
+    """FreeSurfer subjects proc_meg.sh uses for pnum (clinical, else altclinical; pre- and post-op)."""
+
+    fs_subjs = []
+    for ses_suffix in ('', 'postop'):
+        for session in (f'clinical{ses_suffix}', f'altclinical{ses_suffix}'):
+            if (fs_dir / f'sub-{pnum}_ses-{session}').is_dir():
+                fs_subjs.append(f'sub-{pnum}_ses-{session}')
+                break
+
+    return fs_subjs
+
+
+def pending_subjects(fs_subjs):
+    """fs_subjs that have a finished recon-all but no BEM surfaces."""
+
+    pending = []
+    for fs_subj in fs_subjs:
+        if bem_done(fs_subj):
+            continue
+        if not recon_done(fs_subj):
+            print(Colors.YELLOW, f"++ recon-all has not finished for {fs_subj}; skipping BEM ++", Colors.END)
+            continue
+        pending.append(fs_subj)
+
+    return pending
+
+
+def publish_bem(src_bem_dir, dst_bem_dir):
+    """Move every file of a scratch bem dir into place, COMPLETION_FILE last."""
+
+    files = [path for path in src_bem_dir.rglob('*') if not path.is_dir()]
+    files.sort(key=lambda path: (path.name == COMPLETION_FILE, len(path.relative_to(src_bem_dir).parts) == 1, str(path)))
+    for path in files:
+        publish(path, dst_bem_dir / path.relative_to(src_bem_dir))
+
+
+def run_bem(fs_subj):
+    """Run watershed_bem for one subject in scratch and publish the surfaces."""
+
+    subj_fs_dir = fs_dir / fs_subj
+    bem_dir = subj_fs_dir / 'bem'
+    bem_dir.mkdir(exist_ok=True)
+    pnum, session = fs_subj[len('sub-'):].split('_', 1)
+
+    # a second batch (or proc_meg.sh) working on the same subject waits here
+    with open(bem_dir / '.watershed.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if bem_done(fs_subj):
+            print(Colors.YELLOW, f"++ Bem surfaces already exist for {fs_subj} ++", Colors.END)
+            return 0
+
+        with scratch_dir(prefix=f'bem_{fs_subj}_') as scratch:
+            # watershed only reads mri/; everything it writes goes to scratch bem/
+            (scratch / fs_subj).mkdir()
+            (scratch / fs_subj / 'mri').symlink_to(subj_fs_dir / 'mri')
+
+            cmd = ['mne', 'watershed_bem', '-d', str(scratch), '-s', fs_subj, '--copy']
+            logs_dir.mkdir(parents=True, exist_ok=True)
+            with open(logs_dir / f'watershed_bem_{fs_subj}.log', 'w') as log:
+                returncode = run_command(cmd, stage='watershed_bem', stdout=log, stderr=subprocess.STDOUT,
+                                         env=dict(os.environ, SUBJECTS_DIR=str(scratch)),
+                                         subject=pnum, session=session)
+
+            if returncode == 0:
+                publish_bem(scratch / fs_subj / 'bem', bem_dir)
+
+    if returncode == 0:
+        print(Colors.GREEN, f"++ Bem surfaces made for {fs_subj} ++", Colors.END)
+    else:
+        print(Colors.RED, f"++ watershed_bem failed for {fs_subj} (see {logs_dir}/watershed_bem_{fs_subj}.log) ++",
+              Colors.END)
+
+    return returncode
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "make BEM surfaces for FreeSurfer subjects that lack them"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("pnums", nargs="*", help="subject p-numbers (default: every FreeSurfer subject)")
+    parser.add_argument("-l", "--list", help="file with one subject per line")
+    parser.add_argument("--fs_subj", action="append", default=[], help="FreeSurfer subject name (repeatable)")
+    parser.add_argument("--n_jobs", type=int, default=4, help="concurrent watershed_bem jobs")
+    parser.add_argument("--dry_run", action="store_true", help="only show what would run")
+
+    args = parser.parse_args()
+
+    pnums = list(args.pnums)
+    if args.list:
+        with open(args.list, 'r') as f:
+            pnums += f.read().split()
+
+    fs_subjs = list(args.fs_subj) + [fs_subj for pnum in pnums for fs_subj in meg_fs_subjects(pnum)]
+    if not pnums and not args.fs_subj:
+        fs_subjs = sorted(d.name for d in fs_dir.glob('sub-*_ses-*') if d.is_dir())
+
+    jobs = pending_subjects(dict.fromkeys(fs_subjs))
+    print(Colors.YELLOW, f"++ {len(jobs)} subject(s) need BEM surfaces ++", Colors.END)
+    for fs_subj in jobs:
+        print(Colors.YELLOW, f"++   {fs_subj} ++", Colors.END)
+
+    if args.dry_run or not jobs:
+        sys.exit()
+
+    with ThreadPoolExecutor(max_workers=args.n_jobs) as pool:
+        returncodes = list(pool.map(run_bem, jobs))
+
+    if any(returncodes):
+        sys.exit(1)
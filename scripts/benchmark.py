@@ -0,0 +1,578 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Benchmarks for the pipeline's Python hot paths on synthetic fixtures:
+GE multi-echo DICOM series for sortme.py and fake BIDS trees with a stub
+participants.tsv for update_participants.py. The compression benchmark times
+each gzip engine and level of the compression.py policy on NIfTIs of our
+series sizes (synthetic, or real files given with --nifti). 'validate' checks the direct
+NIfTI writer of sortme.py against dcm2niix on the same series (tests/test_sortme_direct.py
+runs the same check). Results are written as JSON
+(tagged with the git commit) so runs can be compared across commits.
+"""
+
+from argparse import ArgumentParser
+import contextlib
+from datetime import datetime
+import gzip
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pydicom
+from pydicom.dataset import Dataset, FileMetaDataset
+from pydicom.uid import ExplicitVRLittleEndian, MRImageStorage, generate_uid
+
+repo_dir = Path(__file__).resolve().parents[1]
+
+DICOM_SCALES = [1000, 10000, 50000, 200000]
+SUBJECT_SCALES = [10, 100, 500, 2000]
+
+# geometry of the synthetic multi-echo EPI series
+N_SLICES = 40
+N_ECHOES = 3
+MATRIX = (6, 8)
+
+# int16 image sizes of our series for the compression benchmark
+SERIES_SHAPES = {
+    'T1w': (256, 256, 176),
+    'dwi': (112, 112, 70, 50),
+    'bold_echo': (64, 64, 40, 300),
+}
+GZIP_LEVELS = [1, 3, 6, 9]
+
+
+def git_commit():
+    """(commit hash, dirty flag) of the working tree, or (None, None) outside git."""
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir,
+                                capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                cwd=repo_dir, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, bool(status.strip())
+
+
+def ge_multiecho_template():
+    """Header shared by every file of a synthetic GE multi-echo series."""
+
+    ds = Dataset()
+    ds.file_meta = FileMetaDataset()
+    ds.file_meta.MediaStorageSOPClassUID = MRImageStorage
+    ds.file_meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds.is_little_endian = True
+    ds.is_implicit_VR = False
+
+    ds.SOPClassUID = MRImageStorage
+    ds.Manufacturer = 'GE MEDICAL SYSTEMS'
+    ds.Modality = 'MR'
+    ds.ImageType = ['ORIGINAL', 'PRIMARY', 'EPI', 'NONE']
+    ds.SeriesNumber = 5
+    ds.InstitutionName = 'NIH'
+    ds.StationName = 'MR750'
+    ds.ManufacturerModelName = 'DISCOVERY MR750'
+    ds.SoftwareVersions = ['27', 'LX', 'MR Software release:DV26.0_R03']
+    ds.BodyPartExamined = 'HEAD'
+    ds.PatientPosition = 'HFS'
+    ds.ScanningSequence = ['EP', 'GR']
+    ds.SequenceVariant = 'NONE'
+    ds.ScanOptions = ['EPI_GEMS', 'PFF']
+    ds.SequenceName = 'epiRT'
+    ds.ProtocolName = 'epi_3_mm_rest_run_1'
+    ds.SeriesDescription = 'epi_3_mm_rest_run_1'
+    ds.ImagingFrequency = '127.7692'
+    ds.PixelBandwidth = '7812.5'
+    ds.SeriesInstanceUID = generate_uid()
+    ds.StudyInstanceUID = generate_uid()
+    ds.AcquisitionDate = '20240101'
+    ds.AcquisitionTime = '120000'
+    ds.EchoTime = '11.0'
+    ds.NumberOfTemporalPositions = 1
+    ds.ImagesInAcquisition = N_SLICES * N_ECHOES
+    ds.RepetitionTime = '2000'
+    ds.FlipAngle = '70'
+    ds.MagneticFieldStrength = '3'
+    ds.InPlanePhaseEncodingDirection = 'COL'
+    ds.ImageOrientationPatient = ['1', '0', '0', '0', '0.9848', '-0.1736']
+    ds.PixelSpacing = ['3.75', '3.75']
+    ds.SliceThickness = '3.5'
+    ds.SpacingBetweenSlices = '3.5'
+    ds.Rows = MATRIX[0]
+    ds.Columns = MATRIX[1]
+    ds.BitsAllocated = 16
+    ds.BitsStored = 16
+    ds.HighBit = 15
+    ds.PixelRepresentation = 1
+    ds.SamplesPerPixel = 1
+    ds.PhotometricInterpretation = 'MONOCHROME2'
+    ds.PixelData = np.zeros(MATRIX, dtype=np.int16).tobytes()
+
+    # private tags read by sortme.py
+    ds.add_new((0x0019, 0x0010), 'LO', 'GEMS_ACQU_01')
+    ds.add_new((0x0019, 0x10a2), 'SL', 0)                  # slice index
+    ds.add_new((0x0019, 0x10a9), 'DS', str(N_ECHOES))      # number of echoes
+    ds.add_new((0x0019, 0x10ac), 'DS', '25.0')             # echo spacing (ms)
+    ds.add_new((0x0021, 0x0010), 'LO', 'GEMS_RELA_01')
+    ds.add_new((0x0021, 0x104f), 'SS', N_SLICES)           # slices per volume
+
+    return ds
+
+
+def make_ge_multiecho_series(out_dir, n_files, duplicates=0.01):
+    """Write a synthetic GE multi-echo series of about n_files DICOM files.
+
+    Files are named like the scanner export (i0000001.dcm, ...) in acquisition
+    order. A fraction of files is repeated under a second name with the same
+    SOPInstanceUID, as happens with real GE multi-echo exports.
+    Returns the number of files written.
+    """
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    n_images = N_SLICES * N_ECHOES
+    n_reps = max(1, round(n_files / n_images))
+    ds = ge_multiecho_template()
+    ds.NumberOfTemporalPositions = n_reps
+
+    rng = np.random.default_rng(0)
+    normal = np.cross(np.array(ds.ImageOrientationPatient[:3], dtype=float),
+                      np.array(ds.ImageOrientationPatient[3:], dtype=float))
+    n_written = 0
+    for rep in range(n_reps):
+        for echo in range(N_ECHOES):
+            for slice_num in range(N_SLICES):
+                ds.SOPInstanceUID = generate_uid()
+                ds.file_meta.MediaStorageSOPInstanceUID = ds.SOPInstanceUID
+                ds.InstanceNumber = n_written + 1
+                ds.TemporalPositionIdentifier = rep + 1
+                ds[0x0019, 0x10a2].value = echo * N_SLICES + slice_num + 1
+                # interleaved slice acquisition
+                ds.TriggerTime = str(((slice_num % 2) * (N_SLICES // 2) + slice_num // 2) * 50)
+                position = np.array([-15.0, -10.0, -60.0]) + normal * 3.5 * slice_num
+                ds.ImagePositionPatient = [f'{v:.4f}' for v in position]
+                ds.PixelData = rng.integers(0, 1000, MATRIX, dtype=np.int16).tobytes()
+                n_written += 1
+                ds.save_as(out_dir / f'i{n_written:07d}.dcm', write_like_original=False)
+                if rng.random() < duplicates:
+                    n_written += 1
+                    ds.save_as(out_dir / f'i{n_written:07d}.dcm', write_like_original=False)
+
+    return n_written
+
+
+def unsort_series(series_dir):
+    """Undo sortMultiEcho by moving echo_#### files back into series_dir."""
+
+    series_dir = Path(series_dir)
+    for echo_dir in series_dir.glob('echo_*'):
+        for f in echo_dir.iterdir():
+            os.rename(f, series_dir / f.name)
+        echo_dir.rmdir()
+
+
+def make_bids_tree(root, n_subjects):
+    """Write a fake BIDS tree and a participants.tsv stub with n_subjects.
+
+    Subjects cycle through the session layouts that update_participants.py
+    looks for; every other subject already has a participants.tsv row.
+    """
+
+    from update_participants import session_columns
+
+    bids_dir = Path(root) / 'Data'
+    layouts = [
+        {'ses-research': {'anat': ['acq-fatsat_T2w.nii.gz', 'T1w.nii.gz'],
+                          'dwi': ['dwi.nii.gz'], 'perf': ['asl.nii.gz'],
+                          'func': ['task-resteyesopen_run-1_bold.nii.gz',
+                                   'task-resteyesopen_run-1_physio.tsv.gz',
+                                   'task-resteyesclosed_run-1_bold.nii.gz']},
+         'ses-clinical': {'anat': ['T1w.nii.gz', 'FLAIR.nii.gz']}},
+        {'ses-clinical': {'anat': ['T1w.nii.gz']},
+         'ses-meg': {'meg': ['task-resteyesopen_run-01_meg.ds',
+                             'task-resteyesclosed_run-01_meg.ds']}},
+        {'ses-altclinical': {'anat': ['T1w.nii.gz', 'T2w.nii.gz', 'FLAIR.nii.gz']},
+         'ses-researchpostop': {'anat': ['T1w.nii.gz'], 'dwi': ['dwi.nii.gz']}},
+    ]
+
+    rows = []
+    for i in range(n_subjects):
+        pnum = f'p{i + 1:04d}'
+        for session, datatypes in layouts[i % len(layouts)].items():
+            for datatype, suffixes in datatypes.items():
+                dt_dir = bids_dir / f'sub-{pnum}' / session / datatype
+                dt_dir.mkdir(parents=True, exist_ok=True)
+                for suffix in suffixes:
+                    (dt_dir / f'sub-{pnum}_{session}_{suffix}').touch()
+        if i % 2 == 0:
+            rows.append([f'sub-{pnum}', 'M', 'R'] + ['0'] * len(session_columns))
+
+    with open(bids_dir / 'participants.tsv', 'w') as f:
+        f.write('\t'.join(['participant_id', 'sex', 'handedness'] + session_columns) + '\n')
+        for row in rows:
+            f.write('\t'.join(row) + '\n')
+
+    return [f'p{i + 1:04d}' for i in range(n_subjects)]
+
+
+def time_call(func, repeats, setup=None):
+    """Wall times (s) of repeats calls of func, running setup untimed before each."""
+
+    times = []
+    for _ in range(repeats):
+        if setup is not None:
+            setup()
+        t0 = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - t0)
+
+    return times
+
+
+def result(benchmark, scale, times, **extra):
+    """One machine-readable benchmark result."""
+
+    row = {
+        'benchmark': benchmark,
+        'scale': scale,
+        'repeats': len(times),
+        'times_s': [round(t, 4) for t in times],
+        'median_s': round(statistics.median(times), 4),
+        'min_s': round(min(times), 4),
+    }
+    row.update(extra)
+
+    return row
+
+
+def bench_sortme(work_dir, scales, repeats, budget):
+    """Time sortme.sortMultiEcho on synthetic series of increasing size."""
+
+    import sortme
+
+    results = []
+    for n_files in scales:
+        series_dir = Path(work_dir) / f'ge_multiecho_{n_files}'
+        if not series_dir.is_dir():
+            print(f'++ Writing synthetic GE series with ~{n_files} slices ++', file=sys.stderr)
+            make_ge_multiecho_series(series_dir, n_files)
+        unsort_series(series_dir)
+        file_names = sorted(f.name for f in series_dir.glob('*.dcm'))
+
+        def run():
+            cwd = os.getcwd()
+            os.chdir(series_dir)
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    sortme.sortMultiEcho(file_names)
+            finally:
+                os.chdir(cwd)
+
+        times = time_call(run, repeats, setup=lambda: unsort_series(series_dir))
+        unsort_series(series_dir)
+        results.append(result('sortme.sortMultiEcho', n_files, times, n_files=len(file_names)))
+        print(f'++ sortMultiEcho {len(file_names)} files: {min(times):.2f}s ++', file=sys.stderr)
+
+        if min(times) > budget:
+            for skipped in scales[scales.index(n_files) + 1:]:
+                results.append({'benchmark': 'sortme.sortMultiEcho', 'scale': skipped,
+                                'skipped': f'previous scale exceeded {budget}s'})
+            break
+
+    return results
+
+
+def bench_participants(scales, repeats, budget):
+    """Time the update_participants.py scan and rewrite across cohort sizes.
+
+    Must run with NEU_DIR pointing at the fixture root, since the BIDS root
+    is resolved when update_participants is imported.
+    """
+
+    import update_participants as up
+
+    fixture_root = up.bids_root.parent
+    results = []
+    for n_subjects in scales:
+        if up.bids_root.is_dir():
+            shutil.rmtree(up.bids_root)
+        pnums = make_bids_tree(fixture_root, n_subjects)
+
+        def scan_cohort():
+            df = up.read_participants()
+            for pnum in pnums:
+                subj_df = df.loc[df.participant_id == f'sub-{pnum}']
+                if len(subj_df):
+                    old_dict = subj_df.to_dict('list')
+                else:
+                    old_dict = up.empty_subject_dict(pnum)
+                up.scan_subject(pnum, old_dict, verbose=False)
+
+        new_dict = up.scan_subject(pnums[-1], up.empty_subject_dict(pnums[-1]), verbose=False)
+
+        times = time_call(scan_cohort, repeats)
+        results.append(result('update_participants.scan_cohort', n_subjects, times))
+        times = time_call(lambda: up.write_subject(pnums[-1], new_dict), repeats)
+        results.append(result('update_participants.write_subject', n_subjects, times))
+        print(f'++ update_participants {n_subjects} subjects: '
+              f'{min(results[-2]["times_s"]):.2f}s scan ++', file=sys.stderr)
+
+        if min(results[-2]['times_s']) > budget:
+            for skipped in scales[scales.index(n_subjects) + 1:]:
+                for name in ('scan_cohort', 'write_subject'):
+                    results.append({'benchmark': f'update_participants.{name}', 'scale': skipped,
+                                    'skipped': f'previous scale exceeded {budget}s'})
+            break
+
+    return results
+
+
+def synthetic_mri(shape, seed=0):
+    """int16 image with a noisy ellipsoid 'head' on a low-noise background, compressing like MR data."""
+
+    rng = np.random.default_rng(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape[:3])]
+    radius = sum(((g - n / 2) / (0.4 * n)) ** 2 for g, n in zip(grid, shape[:3]))
+    volume = np.where(radius < 1, 800 - 300 * radius, 0)
+    n_volumes = shape[3] if len(shape) > 3 else 1
+    data = np.empty(shape[:3] + (n_volumes,), dtype=np.int16)
+    for t in range(n_volumes):
+        noise = rng.normal(0, np.where(radius < 1, 20, 4))
+        data[..., t] = np.abs(volume + noise)
+
+    return data if len(shape) > 3 else data[..., 0]
+
+
+def bench_compression(work_dir, levels, repeats, nifti_files=None):
+    """Time and size of every available gzip engine and level on uncompressed NIfTIs."""
+
+    import nibabel
+
+    images = {}
+    if nifti_files:
+        for nifti_file in nifti_files:
+            name = Path(nifti_file).name.split('.')[0]
+            images[name] = work_dir / f'{name}.nii'
+            nibabel.Nifti1Image(np.asanyarray(nibabel.load(nifti_file).dataobj), np.eye(4)).to_filename(images[name])
+    else:
+        for name, shape in SERIES_SHAPES.items():
+            images[name] = work_dir / f'{name}.nii'
+            if not images[name].is_file():
+                print(f'++ Writing synthetic {name} {shape} ++', file=sys.stderr)
+                nibabel.Nifti1Image(synthetic_mri(shape), np.eye(4)).to_filename(images[name])
+
+    # zlib is what nibabel and dcm2niix -z i use; gzip and pigz are the command line tools
+    engines = ['zlib'] + [tool for tool in ('gzip', 'pigz') if shutil.which(tool)]
+    out_file = work_dir / 'compressed.gz'
+
+    results = []
+    print(f"{'series':<14}{'engine':<8}{'level':>6}{'time (s)':>10}{'MB/s':>8}{'ratio':>8}", file=sys.stderr)
+    for name, nii_file in images.items():
+        data = nii_file.read_bytes()
+        for engine in engines:
+            for level in levels:
+                if engine == 'zlib':
+                    def run():
+                        out_file.write_bytes(gzip.compress(data, compresslevel=level, mtime=0))
+                else:
+                    def run():
+                        with open(nii_file, 'rb') as f_in, open(out_file, 'wb') as f_out:
+                            subprocess.run([engine, '-n', f'-{level}'], stdin=f_in, stdout=f_out, check=True)
+
+                times = time_call(run, repeats)
+                ratio = len(data) / out_file.stat().st_size
+                results.append(result(f'compress.{engine}.{level}', name, times, bytes_in=len(data),
+                                      bytes_out=out_file.stat().st_size, ratio=round(ratio, 3)))
+                print(f'{name:<14}{engine:<8}{level:>6}{min(times):>10.2f}'
+                      f'{len(data) / 1e6 / min(times):>8.0f}{ratio:>8.2f}', file=sys.stderr)
+    out_file.unlink(missing_ok=True)
+
+    return results
+
+
+def validate_direct(work_dir, n_files):
+    """Convert one series with sortme.py (dcm2niix) and sortme.py --direct and compare.
+
+    Images are compared after reorienting both to RAS+ (same voxels, affine
+    and zooms, including TR). Every sidecar field dcm2niix sets must be in
+    the direct sidecar with the same value, except those sortme.py lists in
+    directMissingKeys. Returns (list of differences, {mode: seconds}).
+    """
+
+    import nibabel as nib
+
+    sys.path.insert(0, str(repo_dir / 'scripts'))
+    from sortme import directMissingKeys
+
+    src_dir = Path(work_dir) / f'validate_{n_files}'
+    if not src_dir.is_dir():
+        make_ge_multiecho_series(src_dir, n_files)
+
+    times = {}
+    for mode, options in (('dcm2niix', []), ('direct', ['--direct'])):
+        series_dir = Path(work_dir) / f'validate_{n_files}_{mode}'
+        if series_dir.is_dir():
+            shutil.rmtree(series_dir)
+        shutil.copytree(src_dir, series_dir)
+        t0 = time.perf_counter()
+        subprocess.run([sys.executable, str(repo_dir / 'scripts' / 'sortme.py')] + options + [str(series_dir)],
+                       capture_output=True, check=True)
+        times[mode] = time.perf_counter() - t0
+
+    differences = []
+    for echo in range(1, N_ECHOES + 1):
+        name = f'echo_{echo:04d}'
+        ref, new = (nib.as_closest_canonical(nib.load(str(Path(work_dir) / f'validate_{n_files}_{mode}' / f'{name}.nii.gz')))
+                    for mode in ('dcm2niix', 'direct'))
+        if ref.shape != new.shape:
+            differences.append(f'{name}: shape {new.shape} != {ref.shape}')
+            continue
+        if not np.array_equal(ref.get_fdata(), new.get_fdata()):
+            differences.append(f'{name}: voxel values differ')
+        if not np.allclose(ref.affine, new.affine, atol=1e-3):
+            differences.append(f'{name}: affine differs\n{new.affine}\n{ref.affine}')
+        if not np.allclose(ref.header.get_zooms(), new.header.get_zooms(), atol=1e-4):
+            differences.append(f'{name}: zooms {new.header.get_zooms()} != {ref.header.get_zooms()}')
+
+        ref_json, new_json = (json.loads((Path(work_dir) / f'validate_{n_files}_{mode}' / f'{name}.json').read_text())
+                              for mode in ('dcm2niix', 'direct'))
+        for key in ref_json:
+            if key in directMissingKeys or key == 'ConversionSoftware':
+                continue
+            if key not in new_json:
+                differences.append(f'{name}: {key} missing')
+            elif isinstance(ref_json[key], str) or isinstance(ref_json[key], list) and \
+                    any(isinstance(v, str) for v in ref_json[key]):
+                if ref_json[key] != new_json[key]:
+                    differences.append(f'{name}: {key} {new_json[key]} != {ref_json[key]}')
+            elif not np.allclose(ref_json[key], new_json[key], atol=1e-4):
+                differences.append(f'{name}: {key} {new_json[key]} != {ref_json[key]}')
+
+    return differences, times
+
+
+def compare(old_file, new_file):
+    """Print the median time ratio new/old for every benchmark/scale in both files."""
+
+    def medians(path):
+        with open(path, 'r') as f:
+            data = json.load(f)
+        return data.get('git_commit'), {
+            (r['benchmark'], r['scale']): r['median_s'] for r in data['results'] if 'median_s' in r
+        }
+
+    old_commit, old = medians(old_file)
+    new_commit, new = medians(new_file)
+    print(f"{'benchmark':<36}{'scale':>8}{'old (s)':>10}{'new (s)':>10}{'ratio':>8}")
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key] / old[key] if old[key] else float('nan')
+        print(f'{key[0]:<36}{key[1]:>8}{old[key]:>10.3f}{new[key]:>10.3f}{ratio:>8.2f}')
+    print(f'\nold: {old_commit}\nnew: {new_commit}')
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "benchmark sortme.py and update_participants.py on synthetic fixtures"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--only", choices=['sortme', 'participants', 'compression'], action='append',
+                            help="benchmark(s) to run (default: sortme and participants)")
+    run_parser.add_argument("--dicom_scales", type=int, nargs='+', default=DICOM_SCALES,
+                            help="approximate number of DICOM slices per series")
+    run_parser.add_argument("--subject_scales", type=int, nargs='+', default=SUBJECT_SCALES,
+                            help="number of subjects in the fake BIDS tree")
+    run_parser.add_argument("--levels", type=int, nargs='+', default=GZIP_LEVELS,
+                            help="gzip levels for the compression benchmark")
+    run_parser.add_argument("--nifti", nargs='+',
+                            help="real NIfTIs for the compression benchmark (default: synthetic series)")
+    run_parser.add_argument("--repeats", type=int, default=3)
+    run_parser.add_argument("--budget", type=float, default=600,
+                            help="skip larger scales once a run takes longer than this (s)")
+    run_parser.add_argument("--work_dir", help="fixture directory (kept between runs; default: temporary)")
+    run_parser.add_argument("-o", "--output", help="JSON results file (default: stdout)")
+
+    validate_parser = subparsers.add_parser("validate", help="check sortme.py --direct against dcm2niix")
+    validate_parser.add_argument("--n_files", type=int, default=1200, help="approximate series size")
+    validate_parser.add_argument("--work_dir", help="fixture directory (default: temporary)")
+
+    compare_parser = subparsers.add_parser("compare", help="compare two results files")
+    compare_parser.add_argument("old")
+    compare_parser.add_argument("new")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        compare(args.old, args.new)
+        sys.exit()
+
+    if args.command == "validate":
+        work_dir = Path(args.work_dir or tempfile.mkdtemp(prefix='bids_proc_validate_'))
+        try:
+            differences, times = validate_direct(work_dir, args.n_files)
+        finally:
+            if not args.work_dir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        print(f"++ dcm2niix {times['dcm2niix']:.2f}s, direct {times['direct']:.2f}s ++")
+        for difference in differences:
+            print(f'++ {difference} ++')
+        if differences:
+            sys.exit(1)
+        print('++ sortme.py --direct matches dcm2niix ++')
+        sys.exit()
+
+    only = args.only or ['sortme', 'participants']
+    if args.work_dir:
+        work_dir = Path(args.work_dir)
+        work_dir.mkdir(parents=True, exist_ok=True)
+    else:
+        work_dir = Path(tempfile.mkdtemp(prefix='bids_proc_bench_'))
+
+    # the BIDS fixture must be in place before neu_paths is imported
+    os.environ['NEU_DIR'] = str(work_dir / 'NEU')
+
+    commit, dirty = git_commit()
+    results = []
+    try:
+        if 'sortme' in only:
+            results += bench_sortme(work_dir, sorted(args.dicom_scales), args.repeats, args.budget)
+        if 'participants' in only:
+            results += bench_participants(sorted(args.subject_scales), args.repeats, args.budget)
+        if 'compression' in only:
+            results += bench_compression(work_dir, args.levels, args.repeats, args.nifti)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    output = {
+        'git_commit': commit,
+        'git_dirty': dirty,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'pydicom': pydicom.__version__,
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    else:
+        json.dump(output, sys.stdout, indent=2)
+        print()
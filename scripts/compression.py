@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+One compression policy for the pipeline's .nii.gz and .tsv.gz outputs. It is
+set with environment variables, so the proc_*.sh stages, dcm2niix and the
+Python steps all follow it:
+
+    BIDS_PROC_GZIP_LEVEL    gzip level 1 (fastest) to 9 (smallest); default 6,
+                            the level dcm2niix and gzip use
+    BIDS_PROC_INTERMEDIATE  'none' leaves intermediates that are deleted
+                            anyway uncompressed; default 'gz'
+
+pigz compresses on all cores when it is on the PATH (dcm2niix then pipes
+to it with -z o); otherwise the single-threaded zlib compressors are used.
+`benchmark.py run --only compression` shows the time/size trade-off per level.
+"""
+
+from argparse import ArgumentParser
+import os
+import shlex
+import shutil
+import subprocess
+import sys
+
+LEVEL_ENV = 'BIDS_PROC_GZIP_LEVEL'
+INTERMEDIATE_ENV = 'BIDS_PROC_INTERMEDIATE'
+DEFAULT_LEVEL = 6
+
+
+def gzip_level():
+    """gzip level from $BIDS_PROC_GZIP_LEVEL (the default if unset or invalid)."""
+
+    value = os.environ.get(LEVEL_ENV, '')
+    if value.isdigit() and 1 <= int(value) <= 9:
+        return int(value)
+    if value:
+        print(f"++ Ignoring {LEVEL_ENV}={value} (must be 1-9) ++", file=sys.stderr)
+
+    return DEFAULT_LEVEL
+
+
+def compress_intermediates():
+    """False if intermediates should be written uncompressed."""
+
+    return os.environ.get(INTERMEDIATE_ENV, 'gz') != 'none'
+
+
+def pigz_path():
+
+    return shutil.which('pigz')
+
+
+def nifti_ext(intermediate=False):
+    """Extension for a NIfTI written under the policy."""
+
+    return '.nii' if intermediate and not compress_intermediates() else '.nii.gz'
+
+
+def dcm2niix_args(intermediate=False):
+    """dcm2niix compression options, e.g. ['-z', 'o', '-6']."""
+
+    if intermediate and not compress_intermediates():
+        return ['-z', 'n']
+
+    return ['-z', 'o' if pigz_path() else 'i', f'-{gzip_level()}']
+
+
+def gzip_command():
+    """Command that gzips stdin to stdout (-n keeps names and times out of the header)."""
+
+    return [pigz_path() or 'gzip', '-n', f'-{gzip_level()}']
+
+
+def gzip_file(in_file, out_file):
+    """Compress in_file into out_file; in_file is removed."""
+
+    with open(in_file, 'rb') as f_in, open(out_file, 'wb') as f_out:
+        subprocess.run(gzip_command(), stdin=f_in, stdout=f_out, check=True)
+    os.remove(in_file)
+
+
+def save_nifti(img, out_file):
+    """nibabel save that follows the policy (pigz for .nii.gz where installed)."""
+
+    out_file = str(out_file)
+    if not out_file.endswith('.gz'):
+        img.to_filename(out_file)
+        return
+
+    if pigz_path():
+        tmp_file = f'{out_file[:-len(".nii.gz")]}.{os.getpid()}.tmp.nii'
+        img.to_filename(tmp_file)
+        gzip_file(tmp_file, out_file)
+        return
+
+    from nibabel.openers import ImageOpener
+
+    ImageOpener.default_compresslevel = gzip_level()
+    img.to_filename(out_file)
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "print the pipeline's compression options (for use from shell scripts)"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    dcm2niix_parser = subparsers.add_parser("dcm2niix", help="dcm2niix compression options")
+    dcm2niix_parser.add_argument("--intermediate", action="store_true",
+                                 help="output is deleted later (uncompressed with BIDS_PROC_INTERMEDIATE=none)")
+
+    ext_parser = subparsers.add_parser("ext", help="NIfTI extension (.nii or .nii.gz)")
+    ext_parser.add_argument("--intermediate", action="store_true")
+
+    subparsers.add_parser("gzip", help="command that compresses stdin to stdout")
+
+    args = parser.parse_args()
+
+    if args.command == "dcm2niix":
+        print(shlex.join(dcm2niix_args(args.intermediate)))
+    elif args.command == "ext":
+        print(nifti_ext(args.intermediate))
+    elif args.command == "gzip":
+        print(shlex.join(gzip_command()))
@@ -7,79 +7,287 @@ Created on Thu Apr 20 2023
 """
 
 from argparse import ArgumentParser
+import csv
+import fcntl
 import json
+import os
 from pathlib import Path
 import shutil
+import statistics
 import sys
-from datetime import datetime
 
 from mne import read_trans
 from mne.io import read_raw_ctf
+import mne_bids
 from mne_bids import get_anat_landmarks, update_anat_landmarks, write_raw_bids, BIDSPath, update_sidecar_json
 import numpy as np
 
 from colors import Colors
-from retrieve_emptyroom import nearest, anonymize_date
+from ctf_probe import probe_many
+from instrument import stage_timer
+from neu_paths import bids_root, fs_dir, sourcedata_dir
+from retrieve_emptyroom import nearest, anonymize_date, update_daysback
+from staging import replace_dir
 
-neu_dir = Path("/Volumes/shares/NEU")
-meg_key = neu_dir / "Scripts_and_Parameters/meg_key"
-pnum_key = neu_dir / "Scripts_and_Parameters/14N0061_key"
-bids_root = neu_dir / 'Data'
-fs_dir = bids_root / 'derivatives' / 'freesurfer-6.0.0'
+# precomputed run -> task assignments (columns: pnum, ds, task), and the queue
+# of subjects whose assignment could not be inferred in batch mode
+task_map_file = sourcedata_dir / 'meg_task_map.tsv'
+review_file = sourcedata_dir / 'meg_task_review.tsv'
+
+TASKS = ('resteyesopen', 'resteyesclosed')
+# runs shorter than this are treated as aborted/test recordings
+MIN_RUN_S = 60
+# runs this far off the subject's median duration need a human to look at them
+MAX_DURATION_DEVIATION = 0.5
+# bump when the conversion changes so that checkpointed runs are converted again
+CHECKPOINT_VERSION = 1
+
+def list_runs(data_dir, batch=False):
+    """Map run number (last two digits of the .ds name) to .ds directory."""
+
+    run_dirs = {}
 
-def get_task_dict_and_sessions(data_dir):
-    
-    runs = []
-    
     for meg_session in [d for d in data_dir.iterdir() if d.is_dir()]:
         try:
             run = int(meg_session.stem[-2:])
-            runs.append(run)
+            run_dirs[run] = meg_session
         except ValueError:
             message = (f"{meg_session} is not a valid directory. It will be ign"
             "ored. If you don't want this to happen, then type ctr"
             "l-c now. Otherwise, hit the return key.")
-            input(f"{Colors.PURPLE} {message} {Colors.END}")
+            if batch:
+                print(Colors.YELLOW, f"++ Ignoring {meg_session} ++", Colors.END)
+            else:
+                input(f"{Colors.PURPLE} {message} {Colors.END}")
             continue
-    
-    ordered_runs = sorted(runs)
+
+    return run_dirs
+
+def read_marker_task(ds_dir):
+    """Task named by the markers in MarkerFile.mrk (None if absent or unclear)."""
+
+    marker_file = ds_dir / 'MarkerFile.mrk'
+    if not marker_file.is_file():
+        return None
+
+    with open(marker_file, 'r', errors='ignore') as f:
+        lines = [line.strip() for line in f]
+
+    tasks = set()
+    for i, line in enumerate(lines[:-1]):
+        if line != 'NAME:':
+            continue
+        name = ''.join(c for c in lines[i+1].lower() if c.isalnum())
+        if 'closed' in name or name == 'ec':
+            tasks.add('resteyesclosed')
+        elif 'open' in name or name == 'eo':
+            tasks.add('resteyesopen')
+
+    return tasks.pop() if len(tasks) == 1 else None
+
+def run_duration(probe):
+    """Recording length in seconds from a ctf_probe result (None if unreadable)."""
+
+    if probe['error']:
+        return None
+
+    return probe['duration']
+
+def infer_tasks(run_dirs):
+    """Infer run -> task from .ds metadata.
+
+    The protocol records eyes open first and eyes closed afterwards; markers
+    in MarkerFile.mrk override that order. Returns (task_dict, reasons) where
+    reasons lists everything that needs a human to confirm the assignment.
+    """
+
+    ordered_runs = sorted(run_dirs)
     task_dict = {}
-    
+    reasons = []
+
+    probes = probe_many(run_dirs.values())
+    durations = {run: run_duration(probes[run_dirs[run]]) for run in ordered_runs}
+    known = [d for d in durations.values() if d is not None]
+    median_s = statistics.median(known) if known else None
+
     for i, run in enumerate(ordered_runs):
-        if i == 0:
-            task_dict[run] = 'resteyesopen'
+        default_task = 'resteyesopen' if i == 0 else 'resteyesclosed'
+        marker_task = read_marker_task(run_dirs[run])
+        task_dict[run] = marker_task or default_task
+
+        duration = durations[run]
+        if duration is not None and duration < MIN_RUN_S:
+            reasons.append(f'run {run} is only {duration:.0f}s long')
+        elif duration is not None and median_s and \
+                abs(duration - median_s) > MAX_DURATION_DEVIATION * median_s:
+            reasons.append(f'run {run} lasts {duration:.0f}s (median {median_s:.0f}s)')
+
+    n_open = sum(1 for task in task_dict.values() if task == 'resteyesopen')
+    if n_open != 1:
+        reasons.append(f'{n_open} runs assigned to resteyesopen')
+
+    return task_dict, reasons
+
+def read_task_map(map_file, pnum, run_dirs):
+    """Run -> task for pnum from a precomputed map (None if pnum is not in it).
+
+    Runs of a mapped subject that are missing from the map, or mapped to
+    'ignore', are not converted.
+    """
+
+    if map_file is None or not Path(map_file).is_file():
+        return None
+
+    with open(map_file, 'r', newline='') as f:
+        rows = [row for row in csv.DictReader(f, delimiter='\t')
+                if row['pnum'] == pnum]
+    if not rows:
+        return None
+
+    ds_tasks = {Path(row['ds']).stem: row['task'] for row in rows}
+    task_dict = {}
+    for run, ds_dir in run_dirs.items():
+        task = ds_tasks.get(ds_dir.stem, 'ignore')
+        if task == 'ignore':
+            print(Colors.YELLOW, f"++ Skipping {ds_dir.name} (not mapped to a task) ++", Colors.END)
+        elif task not in TASKS:
+            sys.exit(f"++ Bad task '{task}' for {ds_dir.name} in {map_file} ++")
         else:
-            task_dict[run] = 'resteyesclosed'
-            
+            task_dict[run] = task
+
+    return task_dict
+
+def queue_for_review(pnum, run_dirs, task_dict, reasons):
+    """Append a subject's inferred assignment to the review queue.
+
+    Rows have the task map columns, so corrected rows can be moved to the
+    task map as they are. Earlier rows for the subject are replaced.
+    """
+
+    review_file.parent.mkdir(parents=True, exist_ok=True)
+    # batches of subjects queue at the same time; re-read and replace under a lock
+    with open(review_file.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        rows = []
+        if review_file.is_file():
+            with open(review_file, 'r', newline='') as f:
+                rows = [row for row in csv.reader(f, delimiter='\t')][1:]
+        rows = [row for row in rows if row and row[0] != pnum]
+
+        tmp_file = review_file.with_name(f'.{review_file.name}.tmp')
+        with open(tmp_file, 'w', newline='') as f:
+            writer = csv.writer(f, delimiter='\t')
+            writer.writerow(['pnum', 'ds', 'task', 'reason'])
+            writer.writerows(rows)
+            for run in sorted(task_dict):
+                writer.writerow([pnum, run_dirs[run].name, task_dict[run], '; '.join(reasons)])
+        os.replace(tmp_file, review_file)
+
+def confirm_tasks(task_dict):
+    """Let the user check and correct the assignment interactively."""
+
     for run,task in task_dict.items():
         print(f'Run {run}: {task}')
-    
+
     resp = input(f'{Colors.PURPLE} Everything look OK? Enter n if not, otherwise hit return.\n {Colors.END}')
     if resp in ["N","n","'n'","'N'"]:
         print('Please type in the correct task for each run (resteyesopen / resteyesclosed).')
         for run in task_dict.keys():
             task_val = input(f'Run {run}: ')
-            if task_val not in ('resteyesopen','resteyesclosed'):
+            if task_val not in TASKS:
                 print(Colors.RED, 'Bad input value! Exiting ++', Colors.END)
                 sys.exit(1)
             else:
                 task_dict[run] = task_val
 
+    return task_dict
+
+def ds_fingerprint(ds_dir):
+    """Name, size and mtime of the files of a .ds (a changed dataset is converted again)."""
+
+    with os.scandir(ds_dir) as it:
+        files = sorted([entry.name, entry.stat().st_size, entry.stat().st_mtime_ns]
+                       for entry in it if entry.is_file())
+
+    return {'ds': ds_dir.name, 'files': files}
+
+def read_checkpoints(checkpoint_dir):
+    """.ds name -> parameters of the runs converted by earlier attempts."""
+
+    checkpoints = {}
+    for checkpoint_file in checkpoint_dir.glob('*.json'):
+        try:
+            with open(checkpoint_file, 'r') as f:
+                checkpoints[checkpoint_file.stem] = json.load(f)
+        except (OSError, ValueError):
+            continue
+
+    return checkpoints
+
+def write_checkpoint(checkpoint_dir, ds_name, params):
+    """Record a converted run; written last, so a crash mid-run leaves no checkpoint."""
+
+    checkpoint_file = checkpoint_dir / f'{ds_name}.json'
+    tmp_file = checkpoint_dir / f'.{ds_name}.json.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(params, f)
+    os.replace(tmp_file, checkpoint_file)
+
+def drop_checkpoint(checkpoint_dir, ds_name):
+
+    checkpoint_file = checkpoint_dir / f'{ds_name}.json'
+    if checkpoint_file.is_file():
+        checkpoint_file.unlink()
+
+def run_files(meg_dir, basename):
+    """Files written for one run (sub-X_ses-meg_task-Y_run-Z_*)."""
+
+    return list(meg_dir.glob(f'{basename}_*'))
+
+def prune_scans(ses_dir):
+    """Drop rows of the scans.tsv in ses_dir whose file no longer exists."""
+
+    for scans_file in ses_dir.glob('*_scans.tsv'):
+        with open(scans_file, 'r', newline='') as f:
+            reader = csv.DictReader(f, delimiter='\t')
+            fields = reader.fieldnames
+            rows = [row for row in reader if (ses_dir / row['filename']).exists()]
+        with open(scans_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields, delimiter='\t', lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(rows)
+
+def get_task_dict_and_sessions(data_dir, pnum, batch=False, map_file=task_map_file):
+    """Assign a task to each run of a subject.
+
+    A precomputed map wins; otherwise the assignment is inferred from the .ds
+    metadata. Interactively it is then confirmed by the user; in batch mode
+    it is accepted unless it is ambiguous, in which case the subject is
+    queued for review and (None, None, None) is returned.
+    """
+
+    run_dirs = list_runs(data_dir, batch=batch)
+
+    task_dict = read_task_map(map_file, pnum, run_dirs)
+    if task_dict is None:
+        task_dict, reasons = infer_tasks(run_dirs)
+        if not batch:
+            for reason in reasons:
+                print(Colors.YELLOW, f'++ {reason} ++', Colors.END)
+            task_dict = confirm_tasks(task_dict)
+        elif reasons:
+            queue_for_review(pnum, run_dirs, task_dict, reasons)
+            return None, None, None
+    else:
+        for run,task in sorted(task_dict.items()):
+            print(f'Run {run}: {task}')
+
     final_runs = sorted([k for k,v in task_dict.items() if v == 'resteyesopen'])
     closed_runs = sorted([k for k,v in task_dict.items() if v == 'resteyesclosed'])
     for r in closed_runs:
         final_runs.append(r)
 
-    return task_dict, final_runs
-
-def update_daysback(current_date, new_date=19050101):
-    
-    date_a = datetime.strptime(str(current_date), "%Y%m%d")
-    date_b = datetime.strptime(str(new_date), "%Y%m%d")
-    
-    difference = date_a - date_b
-
-    return difference.days
+    return task_dict, final_runs, run_dirs
 
 if __name__ == "__main__":
 
@@ -89,6 +297,12 @@ if __name__ == "__main__":
     parser.add_argument("--pnum", help="subject p-number")
     parser.add_argument("--fs_subj", help="sub-{pnum}_ses-{session}")
     parser.add_argument("--files_dir", help="location of daysback.txt")
+    parser.add_argument("--batch", action="store_true",
+                        help="never prompt; queue subjects with ambiguous run/task assignment for review")
+    parser.add_argument("--task_map", default=task_map_file,
+                        help=f"precomputed run/task assignments (default: {task_map_file})")
+    parser.add_argument("--reconvert", action="store_true",
+                        help="discard runs checkpointed by earlier attempts and convert every run")
 
     args = parser.parse_args()
     pnum = args.pnum
@@ -96,12 +310,19 @@ if __name__ == "__main__":
     fs_session = fs_subj.split('_')[-1].split('-')[1]
     files_dir = Path(args.files_dir)
 
-    subj_source_meg_dir = bids_root / 'sourcedata' / f'sub-{pnum}' / 'ses-meg' / 'meg'
+    subj_source_meg_dir = sourcedata_dir / f'sub-{pnum}' / 'ses-meg' / 'meg'
     subj_fs_dir = fs_dir / fs_subj
     temp_bids_root = bids_root / f'temp_{pnum}'
-    
-    if temp_bids_root.is_dir():
+    temp_meg_bids = temp_bids_root / f'sub-{pnum}' / 'ses-meg'
+    temp_meg_dir = temp_meg_bids / 'meg'
+
+    # runs finished by an earlier attempt are kept in the temp root and
+    # skipped if their .ds and conversion parameters are unchanged
+    checkpoint_dir = temp_bids_root / '.checkpoints'
+    if args.reconvert and temp_bids_root.is_dir():
         shutil.rmtree(temp_bids_root)
+    checkpoint_dir.mkdir(parents=True, exist_ok=True)
+    checkpoints = read_checkpoints(checkpoint_dir)
     
     trans_file = subj_fs_dir / 'bem' / f"{fs_subj}-trans.fif"
     if not trans_file.is_file():
@@ -113,11 +334,25 @@ if __name__ == "__main__":
         sys.exit(1)
     trans = read_trans(trans_file)
     
+    run2task_dict, final_runs, run_dirs = get_task_dict_and_sessions(
+        subj_source_meg_dir,
+        pnum,
+        batch=args.batch,
+        map_file=args.task_map
+    )
+    if run2task_dict is None:
+        print(
+            Colors.YELLOW,
+            f"++ Run/task assignment for {pnum} is ambiguous; queued in {review_file} ++",
+            Colors.END,
+        )
+        sys.exit(2)
+
+    probes = probe_many(run_dirs[run] for run in final_runs)
+
     key_file = subj_source_meg_dir / 'source_to_bids_key.txt'
-    if key_file.is_file():
-        key_file.unlink()
-    
-    run2task_dict, final_runs = get_task_dict_and_sessions(subj_source_meg_dir)
+    key_lines = []
+    converted = {}  # .ds name -> run basename
     n_eyesopen, n_eyesclosed = 1,1
     
     mri_path = BIDSPath(
@@ -148,7 +383,7 @@ if __name__ == "__main__":
     for meg_run in final_runs:
 
         # set bids path
-        meg_session = next(subj_source_meg_dir.glob(f'????????_epilepsy_????????_*{meg_run}.ds'))
+        meg_session = run_dirs[meg_run]
         task = run2task_dict[meg_run]
         
         bids_path = BIDSPath(
@@ -166,29 +401,33 @@ if __name__ == "__main__":
             bids_path.update(run=n_eyesclosed)
             n_eyesclosed+=1
         
-        try:
-            raw = read_raw_ctf(
-                directory=meg_session,
-                preload=False
-            )
-        except OSError:
-            raw = read_raw_ctf(
-                directory=meg_session,
-                preload=False,
-                system_clock='ignore'
-            )
-        except RuntimeError as e:
-            if "HPI information not available" in e.args[0]:
-                if task == 'resteyesopen':
-                    print(
-                        Colors.RED,
-                        f'Error reading the CTF dataset {meg_session.stem}. Since this was marked as resting state eyes open, all later .ds task markings (eyes open vs. closed) may be wrong. Exiting ...',
-                        Colors.END
-                    )
-                    sys.exit(1)
-                elif task == 'resteyesclosed':
-                    n_eyesclosed-=1
-                continue
+        # the header probe spots runs without HPI data before MNE is involved
+        hpi_missing = probes[meg_session]['hpi'] is False
+        if not hpi_missing:
+            try:
+                raw = read_raw_ctf(
+                    directory=meg_session,
+                    preload=False
+                )
+            except OSError:
+                raw = read_raw_ctf(
+                    directory=meg_session,
+                    preload=False,
+                    system_clock='ignore'
+                )
+            except RuntimeError as e:
+                hpi_missing = "HPI information not available" in e.args[0]
+        if hpi_missing:
+            if task == 'resteyesopen':
+                print(
+                    Colors.RED,
+                    f'Error reading the CTF dataset {meg_session.stem}. Since this was marked as resting state eyes open, all later .ds task markings (eyes open vs. closed) may be wrong. Exiting ...',
+                    Colors.END
+                )
+                sys.exit(1)
+            elif task == 'resteyesclosed':
+                n_eyesclosed-=1
+            continue
         
         # update mri landmarks and retrieve emptyroom path for first run only
         if i==0:
@@ -229,29 +468,62 @@ if __name__ == "__main__":
             daysback = update_daysback(
                 current_date=int(meg_session.stem.split('_')[2])
             )
-        write_raw_bids(
-            raw=raw,
-            bids_path=bids_path,
-            anonymize={'daysback':daysback,'keep_his':False},
-            events=None,
-            event_id=None,
-            overwrite=True
-        )
-        
-        bids_path.update(extension='.json')
-        update_sidecar_json(
-            bids_path=bids_path,
-            entries={
-                'AssociatedEmptyRoom':final_er_path,
-                'TaskName':task_w_spaces_dict[task]
-            }
-        )
+        basename = bids_path.basename
+        params = {
+            'version': CHECKPOINT_VERSION,
+            'mne_bids': mne_bids.__version__,
+            'source': ds_fingerprint(meg_session),
+            'basename': basename,
+            'daysback': int(daysback),
+            'emptyroom': final_er_path,
+            'line_freq': raw.info['line_freq'],
+        }
+        converted[meg_session.name] = basename
+        if checkpoints.get(meg_session.name) == params and run_files(temp_meg_dir, basename):
+            print(Colors.YELLOW, f"++ {meg_session.name} was converted by an earlier attempt ++", Colors.END)
+        else:
+            # the run is (re)written, so checkpoints of runs that had this name are void
+            for ds_name, checkpoint in list(checkpoints.items()):
+                if ds_name == meg_session.name or checkpoint.get('basename') == basename:
+                    drop_checkpoint(checkpoint_dir, ds_name)
+                    del checkpoints[ds_name]
+
+            with stage_timer('write_raw_bids', subject=pnum, run=meg_session.stem):
+                write_raw_bids(
+                    raw=raw,
+                    bids_path=bids_path,
+                    anonymize={'daysback':daysback,'keep_his':False},
+                    events=None,
+                    event_id=None,
+                    overwrite=True
+                )
+
+            bids_path.update(extension='.json')
+            update_sidecar_json(
+                bids_path=bids_path,
+                entries={
+                    'AssociatedEmptyRoom':final_er_path,
+                    'TaskName':task_w_spaces_dict[task]
+                }
+            )
+            write_checkpoint(checkpoint_dir, meg_session.name, params)
         
-        with open(key_file, 'a') as f:
-            if task == 'resteyesopen':
-                f.write(f'{meg_session.stem}, task: {task}, run: {n_eyesopen-1}\n')
-            elif task == 'resteyesclosed':
-                f.write(f'{meg_session.stem}, task: {task}, run: {n_eyesclosed-1}\n')
+        if task == 'resteyesopen':
+            key_lines.append(f'{meg_session.stem}, task: {task}, run: {n_eyesopen-1}\n')
+        elif task == 'resteyesclosed':
+            key_lines.append(f'{meg_session.stem}, task: {task}, run: {n_eyesclosed-1}\n')
+
+    # remove runs of earlier attempts that are not part of this conversion
+    for run_file in temp_meg_dir.glob('*_run-*'):
+        if run_file.name.rsplit('_', 1)[0] in converted.values():
+            continue
+        if run_file.is_dir():
+            shutil.rmtree(run_file)
+        else:
+            run_file.unlink()
+    for ds_name in set(checkpoints) - set(converted):
+        drop_checkpoint(checkpoint_dir, ds_name)
+    prune_scans(temp_meg_bids)
         
     # delete unnecessary entries
     json_file = BIDSPath(
@@ -280,7 +552,11 @@ if __name__ == "__main__":
     with open(json_file.fpath, "w") as f:
         json.dump(out_data, f, indent=4)
     
-    temp_meg_bids = temp_bids_root / f'sub-{pnum}' / 'ses-meg'
-    temp_meg_bids.rename((bids_root / f'sub-{pnum}' / 'ses-meg'))
+    with open(key_file.with_suffix('.tmp'), 'w') as f:
+        f.writelines(key_lines)
+    os.replace(key_file.with_suffix('.tmp'), key_file)
+
+    # an earlier ses-meg stays in place until the new one replaces it
+    replace_dir(temp_meg_bids, bids_root / f'sub-{pnum}' / 'ses-meg')
     
     shutil.rmtree(temp_bids_root)
\ No newline at end of file
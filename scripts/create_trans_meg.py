@@ -4,45 +4,52 @@
 Created on Tue Apr 18 2023
 
 @author: Price Withers
+
+The work is split into phases so compute never waits on an operator:
+precompute runs the AFNI alignments/conversions for many subjects in
+parallel and saves their state, review walks the queue of subjects that are
+ready for the AFNI checks, and finalize writes the -trans.fif files in bulk.
+bids_proc.sh --batch precomputes its whole cohort in one call and
+proc_meg.sh --batch only finalizes.
 """
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
 import os
 from pathlib import Path
 import shlex
 import shutil
+import socket
 import subprocess
 import sys
 from time import sleep
 
 from nih2mne.calc_mnetrans import coords_from_bsight_txt
 import numpy as np
-import pandas as pd
 
 from colors import Colors
+from instrument import run_command
+from neu_paths import neu_dir, sourcedata_dir, derivatives_dir, fs_dir, scripts_dir
 
-neu_dir = Path("/Volumes/shares/NEU")
-bids_root = neu_dir / 'Data'
 meg_dir = neu_dir / 'Projects' / 'MEG'
-fs_dir = bids_root / 'derivatives' / 'freesurfer-6.0.0'
-meg_key = neu_dir / 'Scripts_and_Parameters' / 'meg_key'
-pnum_key = neu_dir / 'Scripts_and_Parameters' / '14N0061_key'
+# per-subject work directories and state for the phased workflow
+trans_work_dir = derivatives_dir / 'meg_trans_work'
 
-def retrieve_key_dicts(meg_key_path, pnum_key_path):
+NO_RESPONSES = ["N", "'N'", "n", "'n'"]
 
-    # create dictionary to look-up MEG codes
-    df = pd.read_csv(meg_key_path, delimiter="=", header=None, names=["meg", "pnum"])
-    meg2pnum_dict = dict(zip(df.meg, df.pnum))
+LABEL_MESSAGE = ("If fiducials are present, open {} Dataset, type "
+                 "null.tag in 'Tag File' and click 'Read', reposition labe"
+                 "ls, 'Save' to header, then hit return in terminal when finished. O"
+                 "therwise, type 'N' and press return.")
 
-    # create dictionary to look-up subject names
-    df = pd.read_csv(pnum_key_path, delimiter="=", header=None, names=["pnum", "name"])
-    pnum2name_dict = dict(zip(df.pnum, df.name))
 
-    return meg2pnum_dict, pnum2name_dict
+class ReviewFailed(Exception):
+    """Raised when the operator marks a check as failed during review."""
 
 
 def view_afni(
-    message="Press return when finished", underlay=None, overlay=None, plugout=False
+    message="Press return when finished", underlay=None, overlay=None, plugout=False, cwd=None
 ):
 
     plugout_str1, plugout_str2 = "", ""
@@ -58,7 +65,7 @@ def view_afni(
 
     cmd = shlex.split(f"afni{plugout_str1}{underlay_str}{overlay_str}{plugout_str2}")
     print(cmd)
-    subprocess.call(cmd)
+    subprocess.call(cmd, cwd=cwd)
     sleep(5)
     user_input = input(f"{Colors.PURPLE} {message} {Colors.END} ")
 
@@ -66,346 +73,449 @@ def view_afni(
 
 
 def check_failure(
-    err, errors=["N", "'N'", "n", "'n'"], message="++ Tagset marked as bad. Skipping ++"
+    err, errors=NO_RESPONSES, message="++ Tagset marked as bad. Skipping ++"
 ):
 
     if err in errors:
-        print(Colors.RED, message, Colors.END)
-        sys.exit(1)
+        raise ReviewFailed(message)
 
 
-def create_null_tag_file():
+def create_null_tag_file(work_dir):
 
     # create null.tag file which facilitates tagset labeling
     fids = ["'Nasion'", "'Left Ear'", "'Right Ear'"]
-    with open("null.tag", "w") as f:
+    with open(Path(work_dir) / "null.tag", "w") as f:
         for fid in fids:
             f.write(fid + " 0 0 0\n")
 
 
-if __name__ == "__main__":
+def find_fs_subj(pnum):
+    """FreeSurfer subject used for MEG coregistration (as in proc_meg.sh)."""
 
-    # parse arguments
-    purpose = "create -trans.fif file"
-    parser = ArgumentParser(description=purpose)
-    parser.add_argument("--pnum", help="subject p-number")
-    parser.add_argument("--fs_subj", help="sub-{pnum}_ses-{session}")
+    for session in ('clinical', 'altclinical'):
+        if (fs_dir / f'sub-{pnum}_ses-{session}').is_dir():
+            return f'sub-{pnum}_ses-{session}'
+
+    return None
+
+
+def trans_path(fs_subj):
+
+    return fs_dir / fs_subj / 'bem' / f"{fs_subj}-trans.fif"
+
+
+def read_state(work_dir):
+    """Saved state of a subject's work directory (None if there is none)."""
+
+    state_file = Path(work_dir) / 'state.json'
+    if not state_file.is_file():
+        return None
+    with open(state_file, 'r') as f:
+        return json.load(f)
+
+
+def write_state(work_dir, state):
+    """Save a subject's state atomically."""
+
+    state_file = Path(work_dir) / 'state.json'
+    tmp_file = state_file.with_suffix('.json.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_file, state_file)
+
+
+def queued_states(status, pnums=None):
+    """(work_dir, state) of every subject with the given status, oldest first."""
+
+    queue = []
+    for state_file in sorted(trans_work_dir.glob('*/state.json'), key=lambda f: f.stat().st_mtime):
+        state = read_state(state_file.parent)
+        if state['status'] != status:
+            continue
+        if pnums and state['pnum'] not in pnums:
+            continue
+        queue.append((state_file.parent, state))
+
+    return queue
+
+
+def pid_alive(pid):
+
+    try:
+        os.kill(int(pid), 0)
+    except (OSError, TypeError, ValueError):
+        return False
+    return True
+
+
+def is_stale(state):
+    """True for a 'precomputing' state whose process is gone (killed or crashed)."""
+
+    if state['status'] != 'precomputing':
+        return False
+    if state.get('host') != socket.gethostname():
+        # cannot check processes on other nodes; trust the state
+        return False
+    return not pid_alive(state.get('pid'))
+
+
+def run_step(cmd, work_dir, state, log, stdout=None):
+    """Run one compute step in the subject's work directory."""
+
+    cmd = shlex.split(cmd)
+    log.write(f"++ {shlex.join(cmd)}\n")
+    log.flush()
+    returncode = run_command(
+        cmd,
+        cwd=work_dir,
+        stdout=stdout or log,
+        stderr=log,
+        subject=state['pnum']
+    )
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, cmd)
+
+
+def retrieve_meg(pnum):
+    """Copy the subject's .ds into sourcedata (retrieve_meg.py leaves existing ones alone)."""
+
+    run_command([sys.executable, str(scripts_dir / 'retrieve_meg.py'), pnum], stage='retrieve_meg', subject=pnum)
+
+
+def precompute_subject(pnum, fs_subj, force=False):
+    """Run every alignment/conversion for one subject that needs no operator.
+
+    Returns the saved state; subjects that already have a trans file or a
+    pending state are left alone (unless they failed, their precompute was
+    interrupted, or force is set).
+    """
 
-    args = parser.parse_args()
-    pnum = args.pnum
-    fs_subj = args.fs_subj
-    fs_session = fs_subj.split('_')[-1]
-    
     if fs_subj.endswith('postop'):
-        postop=True
         ses_suffix='postop'
     else:
-        postop=False
         ses_suffix=''
-
-    meg2pnum_dict, _ = retrieve_key_dicts(meg_key, pnum_key)
-
-    subj_fs_dir = fs_dir / fs_subj
-    subj_bids_dir = bids_root / f'sub-{pnum}'
-    subj_source_dir = bids_root / 'sourcedata' / f'sub-{pnum}'
-    subj_source_meg_dir = subj_source_dir / 'ses-meg' / 'meg'
-    fs_t1_dir = subj_source_dir / fs_session / 'anat'
+    fs_session = fs_subj.split('_')[-1]
 
     # if subject already has -trans.fif, then skip patient
-    trans_file = subj_fs_dir / 'bem' / f"{fs_subj}-trans.fif"
-    if trans_file.exists():
+    if trans_path(fs_subj).exists():
         print(Colors.YELLOW, f"++ Trans file already exists for {pnum} ++", Colors.END)
-        sys.exit(1)
+        return {'pnum': pnum, 'fs_subj': fs_subj, 'status': 'done'}
+
+    work_dir = trans_work_dir / fs_subj
+    state = read_state(work_dir)
+    if state and state['status'] != 'failed' and not is_stale(state) and not force:
+        print(Colors.YELLOW, f"++ {pnum} is already {state['status']} ++", Colors.END)
+        return state
+    if state and is_stale(state):
+        print(Colors.YELLOW, f"++ Redoing interrupted precompute for {pnum} ++", Colors.END)
+    if work_dir.is_dir():
+        shutil.rmtree(work_dir)
+    work_dir.mkdir(parents=True)
+
+    subj_source_dir = sourcedata_dir / f'sub-{pnum}'
+    subj_source_meg_dir = subj_source_dir / 'ses-meg' / 'meg'
+    clinical_nii = subj_source_dir / fs_session / 'anat' / f'{fs_subj}_rec-axialized_T1w.nii.gz'
+    research_scan = f'sub-{pnum}_ses-research{ses_suffix}_rec-axialized_T1w.nii.gz'
+    research_nii = subj_source_dir / f'ses-research{ses_suffix}' / 'anat' / research_scan
+    subj_brainsight_dir = meg_dir / f"Brainsight/{pnum}"
+    subj_research_brainsight_dir = meg_dir / f"Brainsight/{pnum}_research"
+
+    state = {'pnum': pnum, 'fs_subj': fs_subj, 'status': 'precomputing',
+             'host': socket.gethostname(), 'pid': os.getpid()}
+    write_state(work_dir, state)
+
+    with open(work_dir / 'precompute.log', 'w') as log:
+        try:
+            # get path to a .ds folder
+            ds_dirs = sorted(subj_source_meg_dir.glob("*.ds"))
+            if not ds_dirs:
+                raise FileNotFoundError(f"{pnum} does not have MEG data stored in {subj_source_meg_dir}.")
+            state['ds_dir'] = str(ds_dirs[0])
+
+            if subj_brainsight_dir.exists():
+                # patient has Brainsight completed, nothing to review
+                state['method'] = 'brainsight'
+                electrodes_path = subj_brainsight_dir / "Exported_Electrodes.txt"
+                if electrodes_path.is_file():
+                    state['trans_args'] = ['-elec_txt', str(electrodes_path)]
+                else:
+                    electrodes_path = subj_brainsight_dir / "Exported_Electrodes.tag"
+                    state['trans_args'] = ['-tagfile', str(electrodes_path)]
+                state['status'] = 'reviewed'
+
+            elif subj_research_brainsight_dir.exists():
+                # patient has Brainsight completed but the research scan was
+                # used, so the coordinates need to be transformed into the
+                # clinical space
+                state['method'] = 'research_brainsight'
+                shutil.copy(clinical_nii, work_dir)
+                shutil.copy(research_nii, work_dir)
+
+                # align research T1 to freesurfer T1 and save out transformation matrix
+                run_step(f'3dAllineate -base {clinical_nii.name} -input {research_scan} -cost lpa -prefix research_aligned2clinical -source_automask -cmass -autoweight -1Dmatrix_save transform.1D', work_dir, state, log)
+
+                # read in research coordinates
+                electrodes_path = subj_research_brainsight_dir / "Exported_Electrodes.txt"
+                coords_dict = coords_from_bsight_txt(electrodes_path)
+                fid_xyz_coords = np.array((
+                    (coords_dict['Nasion']),
+                    (coords_dict['Left Ear']),
+                    (coords_dict['Right Ear'])
+                ))
+                np.savetxt(work_dir / "research_fiducials.1D", X=fid_xyz_coords)
+
+                # transform research coordinates to clinical
+                with open(work_dir / 'clinical_fiducials.1D', 'w') as f:
+                    run_step("Vecwarp -matvec transform.1D -backward -input research_fiducials.1D", work_dir, state, log, stdout=f)
+
+                # prepend labels to each row
+                fids = ["'Nasion'","'Left Ear'","'Right Ear'"]
+                output_str = ""
+                with open(work_dir / 'clinical_fiducials.1D', 'r') as f:
+                    for i, line in enumerate(f):
+                        output_str += (fids[i] + ' ' + line)
+
+                # write out new clinical fiducials file
+                with open(work_dir / 'clinical_fiducials.tag','w') as f:
+                    f.write(output_str)
+                state['status'] = 'precomputed'
 
-    # get path to a .ds folder
-    if not subj_source_meg_dir.exists():
-        print(
-            Colors.RED,
-            f"++ {pnum} does not have MEG data stored in {subj_source_meg_dir}. ++",
-            Colors.END,
-        )
-        sys.exit(1)
+            else:
+                # fiducials have to be labelled by hand; prepare the clinical
+                # scan and, if available, the research scan aligned to it so
+                # the reviewer can use either
+                state['method'] = 'fiducials'
+                shutil.copy(clinical_nii, work_dir)
+                run_step(f"3dcopy {clinical_nii.name} t1+orig.", work_dir, state, log)
+
+                state['has_research'] = research_nii.is_file()
+                if state['has_research']:
+                    shutil.copy(research_nii, work_dir)
+                    run_step(f"3dcopy {research_scan} research+orig.", work_dir, state, log)
+                    run_step(f"3dcopy {clinical_nii.name} clinical+orig.", work_dir, state, log)
+
+                    # Align research T1 to clinical T1
+                    run_step("3dAllineate -base clinical+orig -input research+orig. -cost lpa -prefix research_aligned2clinical -source_automask -cmass -autoweight", work_dir, state, log)
+                state['status'] = 'precomputed'
+
+        except Exception as e:
+            # any error must settle the state, or the subject stays 'precomputing'
+            state['status'] = 'failed'
+            state['message'] = f'{type(e).__name__}: {e}'
+
+    write_state(work_dir, state)
+    if state['status'] == 'failed':
+        print(Colors.RED, f"++ Precompute failed for {pnum}: {state['message']} ++", Colors.END)
     else:
-        ds_dir = next(subj_source_meg_dir.glob("*.ds"))
+        print(Colors.GREEN, f"++ {pnum} is {state['status']} ++", Colors.END)
 
-    # check whether patient has Brainsight available
-    subj_brainsight_dir = meg_dir / f"Brainsight/{pnum}"
-    brainsight_used = False
-    if subj_brainsight_dir.exists():
-        brainsight_used = True
-
-    # check whether patient has research Brainsight available
-    if not brainsight_used:
-        subj_research_brainsight_dir = meg_dir / f"Brainsight/{pnum}_research"
-        research_brainsight_used = False
-        if subj_research_brainsight_dir.exists():
-            research_brainsight_used = True
-
-    if brainsight_used:
-        # patient has Brainsight completed
-        electrodes_path = subj_brainsight_dir / "Exported_Electrodes.txt"
-        if electrodes_path.is_file():
-            trans_cmd = shlex.split(
-                f"calc_mnetrans.py -subjects_dir {fs_dir} -subject {fs_subj} -dsname {ds_dir} -elec_txt {electrodes_path}"
+    return state
+
+
+def label_clinical(work_dir):
+    """Ask the operator to label fiducials on the clinical scan."""
+
+    create_null_tag_file(work_dir)
+    err = view_afni(
+        message=LABEL_MESSAGE.format('t1+orig'),
+        underlay='t1+orig.BRIK',
+        plugout=True,
+        cwd=work_dir,
+    )
+    os.remove(work_dir / "null.tag")
+
+    return err
+
+
+def review_research_brainsight(work_dir, state):
+
+    alignment = view_afni(
+        message="Check alignment, then press return when finished or type 'N' if failed.",
+        underlay=f"{state['fs_subj']}_rec-axialized_T1w.nii.gz",
+        overlay='research_aligned2clinical+orig.BRIK',
+        cwd=work_dir,
+    )
+    if alignment == 'N':
+        raise ReviewFailed(f"Alignment failed for {state['pnum']}.")
+
+    # view transformed dataset open clinical_fiducials.tag to make sure they look good, then save into header
+    err = view_afni(
+        message=(f"Open research_aligned2clinical+orig Dataset, type clinic"
+                "al_fiducials.tag in 'Tag File' and click 'Read', then che"
+                "ck that fiducials are correctly positioned. 'Save' to header when finished then press ret"
+                "urn or type 'N' if failed."),
+        underlay='research_aligned2clinical+orig.BRIK',
+        plugout=True,
+        cwd=work_dir,
+    )
+    check_failure(err)
+
+    return ['-afni_mri', 'research_aligned2clinical+orig.BRIK']
+
+
+def review_fiducials(work_dir, state):
+
+    aligned_stem = "research_aligned2clinical+orig"
+
+    # check for fiducial markers in clinical scan and label
+    err = label_clinical(work_dir)
+    use_clinical = True
+
+    # no fiducials are available in clinical scan, so check research scan
+    if err in NO_RESPONSES:
+
+        if not state.get('has_research'):
+            print(
+                Colors.YELLOW,
+                f"++ No research scan available. Opening clinical scan again to label fiducials.++",
+                Colors.END
             )
+            check_failure(label_clinical(work_dir), message=f"++ Quitting out. ++")
+
         else:
-            electrodes_path = subj_brainsight_dir / "Exported_Electrodes.tag"
-            trans_cmd = shlex.split(
-                f"calc_mnetrans.py -subjects_dir {fs_dir} -subject {fs_subj} -dsname {ds_dir} -tagfile {electrodes_path}"
+            # check if patient has fiducials in research scan
+            err = view_afni(
+                message="Does patient have fiducials? If yes, press return. Otherwise, type 'N' and press return.",
+                underlay='research+orig.BRIK',
+                cwd=work_dir,
             )
-        subprocess.run(trans_cmd)
-
-    elif research_brainsight_used:
-        # patient has Brainsight completed but the research scan was used
-        # therefore, the coordinates need to be transformed into the clinical
-        # space
-
-        # temporarily copy research into clinical directory
-        shutil.copy(
-            src=(subj_source_dir / f'ses-research{ses_suffix}' / 'anat' / f'sub-{pnum}_ses-research{ses_suffix}_rec-axialized_T1w.nii.gz'),
-            dst=fs_t1_dir
-        )
-
-        # align research T1 to freesurfer T1 and save out transformation matrix
-        os.chdir(fs_t1_dir)
-        allineate_cmd = shlex.split(f'3dAllineate -base {fs_subj}_rec-axialized_T1w.nii.gz -input sub-{pnum}_ses-research{ses_suffix}_rec-axialized_T1w.nii.gz -cost lpa -prefix research_aligned2clinical -source_automask -cmass -autoweight -1Dmatrix_save transform.1D')
-        subprocess.run(allineate_cmd)
-
-        alignment = view_afni(
-            message="Check alignment, then press return when finished or type 'N' if failed.",
-            underlay=f'{fs_subj}_rec-axialized_T1w.nii.gz',
-            overlay='research_aligned2clinical+orig.BRIK',
-        )
-        if alignment == 'N':
-            print(Colors.RED, f"Alignment failed for {pnum}. Delete files modified in {fs_t1_dir} ++", Colors.END)
-            sys.exit(1)
-
-        # read in research coordinates
-        electrodes_path = subj_research_brainsight_dir / "Exported_Electrodes.txt"
-        coords_dict = coords_from_bsight_txt(electrodes_path)
-        fid_xyz_coords = np.array((
-            (coords_dict['Nasion']),
-            (coords_dict['Left Ear']),
-            (coords_dict['Right Ear'])
-        ))
-        np.savetxt("research_fiducials.1D", X=fid_xyz_coords)
-
-        # transform research coordinates to clinical
-        with open('clinical_fiducials.1D', 'w') as f:
-            transform_cmd = shlex.split("Vecwarp -matvec transform.1D -backward -input research_fiducials.1D")
-            subprocess.run(transform_cmd, stdout=f)
-
-        # prepend labels to each row
-        fids = ["'Nasion'","'Left Ear'","'Right Ear'"]
-        output_str = ""
-        with open('clinical_fiducials.1D', 'r') as f:
-            for i, line in enumerate(f):
-                output_str += (fids[i] + ' ' + line)
-
-        # write out new clinical fiducials file
-        with open('clinical_fiducials.tag','w') as f:
-            f.write(output_str)
-
-        # view transformed dataset open clinical_fiducials.tag to make sure they look good, then save into header
-        err = view_afni(
-            message=(f"Open research_aligned2clinical+orig Dataset, type clinic"
-                    "al_fiducials.tag in 'Tag File' and click 'Read', then che"
-                    "ck that fiducials are correctly positioned. 'Save' to header when finished then press ret"
-                    "urn or type 'N' if failed."),
-            underlay='research_aligned2clinical+orig.BRIK',
-            plugout=True
-        )
-        check_failure(err)
-
-        # create -trans.fif file
-        trans_cmd = shlex.split(
-            f"calc_mnetrans.py -subjects_dir {fs_dir} -subject {fs_subj} -dsname {ds_dir} -afni_mri research_aligned2clinical+orig.BRIK"
-        )
-        subprocess.run(trans_cmd)
-
-        for file in fs_t1_dir.glob("*fiducials.*"):
-            os.remove(file)
-        for file in fs_t1_dir.glob("research_aligned2clinical+orig*"):
-            os.remove(file)
-        for file in fs_t1_dir.glob("transform.1D"):
-            os.remove(file)
-        os.remove(f'sub-{pnum}_ses-research{ses_suffix}_rec-axialized_T1w.nii.gz')
 
-    else:
-        
-        # change to subject t1 directory
-        os.chdir(fs_t1_dir)
-        create_null_tag_file()
-        nii_mri_file = f'{fs_subj}_rec-axialized_T1w.nii.gz'
-        mri_file_stem = 't1+orig'
-        # convert scan from .nii.gz to HEAD/BRIK format
-        copy_cmd = shlex.split(f"3dcopy {nii_mri_file} {mri_file_stem}.")
-        subprocess.run(copy_cmd)
-
-        # check for fiducial markers in clinical scan and label
-        err = view_afni(
-            message=(f"If fiducials are present, open {mri_file_stem} Dataset, type "
-                     "null.tag in 'Tag File' and click 'Read', reposition labe"
-                     "ls, 'Save' to header, then hit return in terminal when finished. O"
-                     "therwise, type 'N' and press return."),
-            underlay=f'{mri_file_stem}.BRIK',
-            plugout=True,
-        )
-
-        os.remove("null.tag")
-        use_clinical=True
-
-        # no fiducials are available in clinical scan, so check research scan
-        if err in ["N", "'N'", "n", "'n'"]:
-            
-            use_clinical=False
-            subj_research_dir = subj_source_dir / f'ses-research{ses_suffix}' / 'anat'
-            research_scan = f'sub-{pnum}_ses-research{ses_suffix}_rec-axialized_T1w.nii.gz'
-            research_scan_path = subj_research_dir / research_scan
-
-            # no research scans available
-            if not research_scan_path.is_file():
+            # no fiducials in research scan
+            if err in NO_RESPONSES:
                 print(
                     Colors.YELLOW,
-                    f"++ No research scan available. Opening clinical scan again to label fiducials.++",
+                    f"++ Opening clinical scan again to label fiducials.++",
                     Colors.END
                 )
-                os.chdir(fs_t1_dir)
-                create_null_tag_file()
-
-                # check for fiducial markers in clinical scan and label
-                err = view_afni(
-                    message=(f"If fiducials are present, open {mri_file_stem} Dataset, type "
-                            "null.tag in 'Tag File' and click 'Read', reposition labe"
-                            "ls, 'Save' to header, then hit return in terminal when finished. O"
-                            "therwise, type 'N' and press return."),
-                    underlay=f'{mri_file_stem}.BRIK',
-                    plugout=True,
-                )
-                
-                os.remove("null.tag")
-                
-                check_failure(
-                    err,
-                    message=f"++ Quitting out. ++",
-                )
-                use_clinical=True
-            
-            # research scan is available
+                check_failure(label_clinical(work_dir), message=f"++ Quitting out. ++")
             else:
-                # change to research directory
-                os.chdir(subj_research_dir)
+                use_clinical = False
+
+    if use_clinical:
+        return ['-afni_mri', 't1+orig.BRIK']
+
+    # label fiducials on the research scan aligned to the clinical scan
+    alignment = view_afni(
+        message="Check alignment, then press return when finished or type 'N' if failed.",
+        underlay='clinical+orig.BRIK',
+        overlay=f"{aligned_stem}.BRIK",
+        cwd=work_dir,
+    )
+    if alignment == "N":
+        raise ReviewFailed(f"Alignment failed for {state['pnum']}.")
+
+    create_null_tag_file(work_dir)
+    view_afni(
+        message=LABEL_MESSAGE.format(f'{aligned_stem}.BRIK'),
+        underlay=f"{aligned_stem}.BRIK",
+        plugout=True,
+        cwd=work_dir,
+    )
+    os.remove(work_dir / "null.tag")
+
+    return ['-afni_mri', f'{aligned_stem}.BRIK']
+
+
+def review_subject(work_dir, state):
+    """Run the AFNI checks for one precomputed subject and save the outcome."""
+
+    print(Colors.YELLOW, f"++ Reviewing {state['pnum']} ({state['method']}) ++", Colors.END)
+    try:
+        if state['method'] == 'research_brainsight':
+            state['trans_args'] = review_research_brainsight(work_dir, state)
+        else:
+            state['trans_args'] = review_fiducials(work_dir, state)
+        state['status'] = 'reviewed'
+    except ReviewFailed as e:
+        print(Colors.RED, e, Colors.END)
+        state['status'] = 'failed'
+        state['message'] = str(e)
 
-                # check if patient has fiducials in research scan
-                err = view_afni(
-                    message="Does patient have fiducials? If yes, press return. Otherwise, type 'N' and press return.",
-                    underlay=research_scan,
-                )
+    write_state(work_dir, state)
 
-                # no fiducials in research scan
-                if err in ["N", "'N'", "n", "'n'"]:
-                    print(
-                        Colors.YELLOW,
-                        f"++ Opening clinical scan again to label fiducials.++",
-                        Colors.END
-                    )
-                    os.chdir(fs_t1_dir)
-                    create_null_tag_file()
-
-                    # label clinical scan
-                    err = view_afni(
-                        message=(f"If fiducials are present, open {mri_file_stem} Dataset, type "
-                                "null.tag in 'Tag File' and click 'Read', reposition labe"
-                                "ls, 'Save' to header, then hit return in terminal when finished. O"
-                                "therwise, type 'N' and press return."),
-                        underlay=f'{mri_file_stem}.BRIK',
-                        plugout=True,
-                    )
-                    
-                    os.remove("null.tag")
-                    
-                    check_failure(
-                        err,
-                        message=f"++ Quitting out. ++",
-                    )
-                    
-                    use_clinical=True
-
-        # calculate trans from research t1
-        if not use_clinical:
-            
-            # change to research directory
-            os.chdir(subj_research_dir)
-            
-            # convert scan from .nii.gz to HEAD/BRIK format
-            copy_cmd = shlex.split(f"3dcopy {research_scan} research+orig.")
-            subprocess.run(copy_cmd)
-            # move clinical scan into research dir
-            copy_cmd = shlex.split(f"3dcopy {fs_t1_dir / nii_mri_file} clinical+orig.")
-            subprocess.run(copy_cmd)
-
-            # Align research T1 to clinical T1
-            aligned_stem = "research_aligned2clinical+orig"
-            allineate_cmd = shlex.split(
-                f"3dAllineate -base clinical+orig -input research+orig. -cost lpa -prefix research_aligned2clinical -source_automask -cmass -autoweight"
-            )
-            subprocess.run(allineate_cmd)
-            alignment = view_afni(
-                message="Check alignment, then press return when finished or type 'N' if failed.",
-                underlay=(fs_t1_dir / nii_mri_file),
-                overlay=f"{aligned_stem}.BRIK",
-            )
-            if alignment == "N":
-                print(
-                    Colors.RED, f"Alignment failed for {pnum}. Skipping ++", Colors.END
-                )
-                for suff in [".BRIK", ".HEAD"]:
-                    os.remove(f"{aligned_stem}{suff}")
-                for file in subj_research_dir.glob("research+orig*"):
-                    os.remove(file)
-                for file in subj_research_dir.glob("clinical+orig*"):
-                    os.remove(file)
-                sys.exit(1)
-
-            create_null_tag_file()
-
-            view_afni(
-                message=(f"If fiducials are present, open {aligned_stem}.BRIK Dataset, type "
-                        "null.tag in 'Tag File' and click 'Read', reposition labe"
-                        "ls, 'Save' to header, then hit return in terminal when finished. O"
-                        "therwise, type 'N' and press return."),
-                underlay=f"{aligned_stem}.BRIK",
-                plugout=True,
-            )
+    return state
 
-            os.remove("null.tag")
 
-            # create -trans.fif file
-            trans_cmd = shlex.split(
-                f"calc_mnetrans.py -subjects_dir {fs_dir} -subject {fs_subj} -dsname {ds_dir} -afni_mri {aligned_stem}.BRIK"
-            )
-            subprocess.run(trans_cmd)
-
-            for suff in [".BRIK", ".HEAD"]:
-                os.remove(f"{aligned_stem}{suff}")
-            for file in subj_research_dir.glob("research+orig*"):
-                os.remove(file)
-            for file in subj_research_dir.glob("clinical+orig*"):
-                os.remove(file)
-        
-        # calculate trans from clinical t1
-        else:
-            # create -trans.fif file
-            trans_cmd = shlex.split(
-                f"calc_mnetrans.py -subjects_dir {fs_dir} -subject {fs_subj} -dsname {ds_dir} -afni_mri {mri_file_stem}.BRIK"
+def finalize_subject(work_dir, state):
+    """Write the -trans.fif file for a reviewed subject and clean up."""
+
+    fs_subj = state['fs_subj']
+    with open(work_dir / 'finalize.log', 'w') as log:
+        try:
+            run_step(
+                f"calc_mnetrans.py -subjects_dir {fs_dir} -subject {fs_subj} -dsname {state['ds_dir']} "
+                + shlex.join(state['trans_args']),
+                work_dir, state, log
             )
-            subprocess.run(trans_cmd)
-            
-        for suff in [".BRIK", ".HEAD"]:
-            delete_file = fs_t1_dir / f'{mri_file_stem}{suff}'
-            os.remove(delete_file)
-
-    if trans_file.exists():
-        print(Colors.GREEN, f"++ Trans file created for {pnum} ++", Colors.END)
-    else:
-        print(Colors.RED, f"++ Trans file not created for {pnum} ++", Colors.END)
+        except subprocess.CalledProcessError:
+            pass
+
+    if trans_path(fs_subj).exists():
+        print(Colors.GREEN, f"++ Trans file created for {state['pnum']} ++", Colors.END)
+        shutil.rmtree(work_dir)
+        return True
+
+    print(Colors.RED, f"++ Trans file not created for {state['pnum']} (see {work_dir / 'finalize.log'}) ++", Colors.END)
+    state['status'] = 'failed'
+    state['message'] = 'calc_mnetrans.py did not create the trans file'
+    write_state(work_dir, state)
+
+    return False
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "create -trans.fif file"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("--pnum", nargs="+", default=[], help="subject p-number(s)")
+    parser.add_argument("--fs_subj", help="sub-{pnum}_ses-{session} (single subject only)")
+    parser.add_argument("--phase", choices=["all", "precompute", "review", "finalize"], default="all",
+                        help="precompute in parallel, review the queue, or write queued trans files (default: all)")
+    parser.add_argument("--n_jobs", type=int, default=4, help="subjects to precompute/finalize in parallel")
+    parser.add_argument("--force", action="store_true", help="redo precompute for pending subjects")
+    parser.add_argument("--retrieve", action="store_true",
+                        help="copy each subject's .ds into sourcedata before precomputing")
+
+    args = parser.parse_args()
+    if args.fs_subj and len(args.pnum) != 1:
+        parser.error("--fs_subj can only be used with a single --pnum")
+    if args.phase in ("all", "precompute") and not args.pnum:
+        parser.error(f"--phase {args.phase} needs --pnum")
+
+    n_failed = 0
+
+    if args.phase in ("all", "precompute"):
+        subjects = []
+        for pnum in args.pnum:
+            fs_subj = args.fs_subj or find_fs_subj(pnum)
+            if fs_subj is None:
+                print(Colors.RED, f"++ {pnum} does not have a Freesurfer directory ++", Colors.END)
+                n_failed += 1
+            else:
+                subjects.append((pnum, fs_subj))
+
+        def precompute(pnum, fs_subj):
+            if args.retrieve and not trans_path(fs_subj).exists():
+                retrieve_meg(pnum)
+            return precompute_subject(pnum, fs_subj, force=args.force)
+
+        with ThreadPoolExecutor(max_workers=args.n_jobs) as pool:
+            states = list(pool.map(lambda subject: precompute(*subject), subjects))
+        n_failed += sum(1 for state in states if state['status'] == 'failed')
+
+    if args.phase in ("all", "review"):
+        queue = queued_states('precomputed', args.pnum)
+        print(Colors.YELLOW, f"++ {len(queue)} subject(s) ready for review ++", Colors.END)
+        for work_dir, state in queue:
+            state = review_subject(work_dir, state)
+            n_failed += state['status'] == 'failed'
+
+    if args.phase in ("all", "finalize"):
+        queue = queued_states('reviewed', args.pnum)
+        with ThreadPoolExecutor(max_workers=args.n_jobs) as pool:
+            created = list(pool.map(lambda item: finalize_subject(*item), queue))
+        n_failed += created.count(False)
+
+    if n_failed:
+        sys.exit(1)
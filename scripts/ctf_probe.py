@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Read the metadata needed to select and classify CTF runs (duration, sampling
+rate, channel count, HPI availability) straight from the .ds files, without
+constructing an MNE reader. Only the fixed part of the .res4 header and the
+text .hc file are parsed; the number of recorded trials comes from the .meg4
+file sizes, like MNE does. Results are cached per .ds (keyed by the sizes and
+mtimes of those files) in sourcedata/meg_probe_cache.json.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import fcntl
+import json
+import os
+from pathlib import Path
+import re
+import struct
+import sys
+
+from neu_paths import sourcedata_dir
+
+cache_file = sourcedata_dir / 'meg_probe_cache.json'
+
+# fixed .res4 layout (big-endian); see mne/io/ctf/res4.py
+RES4_MAGIC = b'MEG4'
+NAVE_POS = 776
+DATA_TIME_POS, DATA_DATE_POS, DATE_LEN = 778, 1033, 255
+NSAMP_POS = 1288  # int32 nsamp, int16 nchan
+SFREQ_POS = 1296  # double sfreq, double epoch_time, int16 no_trials
+RDLEN_POS = 1838
+FUNNY_POS = 1844  # run description, filters and channel names follow
+NAME_LEN = 32
+MEG4_HEADER = 8
+# coils whose dewar positions MNE needs to build the device -> head transform
+HPI_COILS = ('nasion', 'left ear', 'right ear')
+SYSTEM_CLOCK_CHANNEL = 'SCLK01'
+
+
+def read_string(buf, pos, length):
+
+    return buf[pos:pos + length].split(b'\0', 1)[0].decode('latin-1').strip()
+
+
+def read_channel_names(buf, nchan):
+    """Channel names from the variable part of .res4 (None if it does not parse)."""
+
+    try:
+        rdlen, = struct.unpack_from('>i', buf, RDLEN_POS)
+        pos = FUNNY_POS + rdlen
+        nfilt, = struct.unpack_from('>h', buf, pos)
+        pos += 2
+        for _ in range(nfilt):
+            # frequency (double), class (int32), type (int32), then the parameters
+            npar, = struct.unpack_from('>h', buf, pos + 16)
+            pos += 18 + 8 * npar
+        names = [read_string(buf, pos + i * NAME_LEN, NAME_LEN) for i in range(nchan)]
+    except struct.error:
+        return None
+
+    if len(buf) < pos + nchan * NAME_LEN or not all(name.isprintable() and name for name in names):
+        return None
+
+    return names
+
+
+def read_res4(res4_file):
+    """Header fields of a .res4 file."""
+
+    with open(res4_file, 'rb') as f:
+        buf = f.read()
+    if not buf.startswith(RES4_MAGIC) or len(buf) < FUNNY_POS:
+        raise ValueError(f'{res4_file} is not a CTF res4 file')
+
+    nave, = struct.unpack_from('>h', buf, NAVE_POS)
+    nsamp, nchan = struct.unpack_from('>ih', buf, NSAMP_POS)
+    sfreq, epoch_time, no_trials = struct.unpack_from('>ddh', buf, SFREQ_POS)
+
+    return {
+        'nave': nave,
+        'nsamp': nsamp,
+        'nchan': nchan,
+        'sfreq': sfreq,
+        'epoch_time': epoch_time,
+        'no_trials': no_trials,
+        'data_date': read_string(buf, DATA_DATE_POS, DATE_LEN),
+        'data_time': read_string(buf, DATA_TIME_POS, DATE_LEN),
+        'ch_names': read_channel_names(buf, nchan),
+    }
+
+
+def read_hc(hc_file):
+    """coil -> [x, y, z] of the measured coil positions relative to the dewar."""
+
+    coils = {}
+    current = None
+    with open(hc_file, 'r', errors='ignore') as f:
+        for line in f:
+            line = line.strip().lower()
+            match = re.match(r'(\w+) (.+) coil position relative to (\w+)', line)
+            if match:
+                kind, coil, coord = match.groups()
+                current = coil if (kind, coord) == ('measured', 'dewar') else None
+                continue
+            match = re.match(r'([xyz])\s*=\s*(\S+)', line)
+            if match and current:
+                coils.setdefault(current, []).append(float(match.group(2)))
+
+    return coils
+
+
+def ds_files(ds_dir):
+    """The .res4, .hc and .meg4 files of a dataset that the probe depends on."""
+
+    ds_dir = Path(ds_dir)
+    res4 = ds_dir / f'{ds_dir.stem}.res4'
+    if not res4.is_file():
+        res4 = next(ds_dir.glob('*.res4'), res4)
+
+    return res4, res4.with_suffix('.hc'), sorted(ds_dir.glob('*meg4'))
+
+
+def signature(ds_dir):
+    """Sizes and mtimes of the probed files; the cache is valid while they match."""
+
+    res4, hc, meg4_files = ds_files(ds_dir)
+    sig = []
+    for path in [res4, hc] + meg4_files:
+        if path.is_file():
+            st = path.stat()
+            sig.append([path.name, st.st_size, st.st_mtime_ns])
+
+    return sig
+
+
+def probe(ds_dir):
+    """Metadata of one .ds; 'error' is set (and the rest None) if it cannot be read."""
+
+    res4, hc, meg4_files = ds_files(ds_dir)
+    info = {'duration': None, 'sfreq': None, 'nchan': None, 'n_trials': None,
+            'hpi': None, 'system_clock': None, 'data_date': None, 'data_time': None, 'error': ''}
+
+    try:
+        res = read_res4(res4)
+    except (OSError, ValueError, struct.error) as e:
+        info['error'] = str(e)
+        return info
+
+    # trials actually on disk; an aborted recording has fewer than the header says
+    trial_bytes = res['nchan'] * res['nsamp'] * 4
+    n_trials = sum((f.stat().st_size - MEG4_HEADER) // trial_bytes for f in meg4_files) if trial_bytes else 0
+
+    coils = read_hc(hc) if hc.is_file() else {}
+    hpi = all(len(coils.get(coil, [])) == 3 and any(coils[coil]) for coil in HPI_COILS)
+    if not coils and hc.is_file() and hc.stat().st_size:
+        # an .hc we cannot parse; leave the decision to MNE
+        hpi = None
+    info.update({
+        'sfreq': res['sfreq'],
+        'nchan': res['nchan'],
+        'n_trials': n_trials,
+        'duration': n_trials * res['nsamp'] / res['sfreq'] if res['sfreq'] > 0 else None,
+        'hpi': hpi,
+        'data_date': res['data_date'],
+        'data_time': res['data_time'],
+    })
+    if res['ch_names'] is not None:
+        info['system_clock'] = any(name.startswith(SYSTEM_CLOCK_CHANNEL) for name in res['ch_names'])
+    if not meg4_files:
+        info['error'] = 'no .meg4 data'
+
+    return info
+
+
+def read_cache():
+
+    if not cache_file.is_file():
+        return {}
+    try:
+        with open(cache_file, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def update_cache(entries):
+    """Merge entries into the cache file under a lock and write it atomically."""
+
+    cache_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(cache_file.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = read_cache()
+        cache.update(entries)
+        tmp_file = cache_file.with_name(f'.{cache_file.name}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(cache, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, cache_file)
+
+
+def probe_many(ds_dirs, n_jobs=8, use_cache=True):
+    """ds_dir -> probe info for many datasets, probing only those not cached."""
+
+    ds_dirs = [Path(d) for d in ds_dirs]
+    cache = read_cache() if use_cache else {}
+
+    results, stale = {}, {}
+    for ds_dir in ds_dirs:
+        key = str(ds_dir.resolve())
+        sig = signature(ds_dir)
+        entry = cache.get(key)
+        if entry and entry['signature'] == sig:
+            results[ds_dir] = entry['info']
+        else:
+            stale[ds_dir] = (key, sig)
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            for ds_dir, info in zip(stale, pool.map(probe, stale)):
+                results[ds_dir] = info
+        if use_cache:
+            update_cache({key: {'signature': sig, 'info': results[ds_dir]}
+                          for ds_dir, (key, sig) in stale.items()})
+
+    return results
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "print CTF run metadata (duration, sampling rate, channels, HPI) without MNE"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("ds_dirs", nargs="*", help=".ds directories")
+    parser.add_argument("--pnum", action="append", default=[],
+                        help="probe every .ds in the subject's sourcedata (repeatable)")
+    parser.add_argument("--all", action="store_true", help="probe every subject in sourcedata")
+    parser.add_argument("--n_jobs", type=int, default=8, help="parallel probes")
+    parser.add_argument("--no_cache", action="store_true", help="ignore and do not update the cache")
+
+    args = parser.parse_args()
+
+    ds_dirs = [Path(d) for d in args.ds_dirs]
+    for pnum in args.pnum:
+        ds_dirs += sorted((sourcedata_dir / f'sub-{pnum}' / 'ses-meg' / 'meg').glob('*.ds'))
+    if args.all:
+        ds_dirs += sorted(sourcedata_dir.glob('sub-*/ses-meg/meg/*.ds'))
+    if not ds_dirs:
+        parser.error("no datasets given")
+
+    results = probe_many(ds_dirs, n_jobs=args.n_jobs, use_cache=not args.no_cache)
+
+    columns = ['duration', 'sfreq', 'nchan', 'n_trials', 'hpi', 'system_clock', 'data_date', 'error']
+    print('\t'.join(['ds'] + columns))
+    for ds_dir in ds_dirs:
+        info = results[ds_dir]
+        if info['duration'] is not None:
+            info = dict(info, duration=f"{info['duration']:.1f}")
+        print('\t'.join([str(ds_dir)] + ['' if info[col] is None else str(info[col]) for col in columns]))
+
+    if any(info['error'] for info in results.values()):
+        sys.exit(1)
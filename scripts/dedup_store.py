@@ -0,0 +1,346 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Deduplicated copies into sourcedata. A file is cloned with a reflink where
+the filesystem supports it (FICLONE on Linux, clonefile on Mac OS), else
+hard-linked to its source, else linked to a content-addressed object in
+sourcedata/.dedup/objects (named by its SHA-256), so that identical files
+share one copy. Bytes are only copied when none of these apply. Hashes are
+kept in a path index (keyed by inode, size and mtime) so unchanged sources
+are not read again.
+
+Linked files share their data: anything placed here must be replaced (e.g.
+with staging.publish), never modified in place. Objects are made read-only
+so that an in-place write fails instead of changing every copy.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+import ctypes
+import errno
+import fcntl
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+import stat
+import sys
+
+from colors import Colors
+from neu_paths import sourcedata_dir
+
+store_dir = sourcedata_dir / '.dedup'
+objects_dir = store_dir / 'objects'
+index_file = store_dir / 'hash_index.json'
+
+# ioctl(2) request that clones a whole file on Btrfs/XFS (linux/fs.h)
+FICLONE = 0x40049409
+# errors that mean "this kind of link is not possible here", not a real failure
+LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EACCES, errno.EMLINK, errno.ENOTSUP,
+               errno.EOPNOTSUPP, errno.EINVAL, errno.ENOSYS, errno.ETXTBSY)
+CHUNK = 16 * 1024**2
+
+
+def reflink(src, dst):
+    """Clone src to the new file dst sharing its blocks; returns False if unsupported."""
+
+    if sys.platform == 'darwin':
+        clonefile = getattr(ctypes.CDLL(None, use_errno=True), 'clonefile', None)
+        return clonefile is not None and clonefile(os.fsencode(src), os.fsencode(dst), 0) == 0
+
+    try:
+        with open(src, 'rb') as f_in, open(dst, 'xb') as f_out:
+            try:
+                fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+            except OSError as e:
+                if e.errno not in LINK_ERRORS + (errno.ENOTTY,):
+                    raise
+                cloned = False
+            else:
+                cloned = True
+    except FileExistsError:
+        return False
+    if not cloned:
+        os.unlink(dst)
+        return False
+    shutil.copystat(src, dst)
+
+    return True
+
+
+def hard_link(src, dst):
+    """Hard-link src to dst; returns False if the filesystem or permissions do not allow it."""
+
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in LINK_ERRORS:
+            raise
+        return False
+
+    return True
+
+
+def read_index():
+
+    if not index_file.is_file():
+        return {}
+    try:
+        with open(index_file, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def update_index(entries, removed=()):
+    """Merge entries into the hash index under a lock and write it atomically."""
+
+    if not entries and not removed:
+        return
+    store_dir.mkdir(parents=True, exist_ok=True)
+    with open(index_file.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = read_index()
+        index.update(entries)
+        for key in removed:
+            index.pop(key, None)
+        tmp_file = index_file.with_name(f'.{index_file.name}.tmp')
+        with open(tmp_file, 'w') as f:
+            json.dump(index, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, index_file)
+
+
+def identity(st):
+
+    return [st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns]
+
+
+def file_hash(path, index, new_entries):
+    """SHA-256 of a file, from the index if the file is unchanged since it was hashed."""
+
+    key = str(Path(path).resolve())
+    ident = identity(os.stat(path))
+    entry = index.get(key) or new_entries.get(key)
+    if entry and entry['identity'] == ident:
+        return entry['sha256']
+
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            digest.update(chunk)
+    new_entries[key] = {'identity': ident, 'sha256': digest.hexdigest()}
+
+    return digest.hexdigest()
+
+
+def object_path(sha256):
+
+    return objects_dir / sha256[:2] / sha256
+
+
+def link_into_place(src, dst):
+    """Hard-link src to dst through a temporary name so dst appears complete."""
+
+    tmp = dst.with_name(f'.{dst.name}.dedup-{os.getpid()}')
+    if not hard_link(src, tmp):
+        return False
+    os.replace(tmp, dst)
+
+    return True
+
+
+def store_object(src, sha256, link_source=False):
+    """Make sure the object for sha256 exists, creating it from src if needed."""
+
+    obj = object_path(sha256)
+    if obj.exists():
+        return obj
+    obj.parent.mkdir(parents=True, exist_ok=True)
+
+    tmp = obj.with_name(f'.{sha256}.{os.getpid()}')
+    if not (link_source and hard_link(src, tmp)) and not reflink(src, tmp):
+        shutil.copy2(src, tmp)
+    os.chmod(tmp, stat.S_IMODE(os.stat(tmp).st_mode) & ~0o222)
+    try:
+        os.link(tmp, obj)
+    except FileExistsError:
+        # another process stored the same content first
+        pass
+    os.unlink(tmp)
+
+    return obj
+
+
+def clone_file(src, dst, index, new_entries, allow_hardlink=True):
+    """Place a copy of src at the new path dst; returns how ('reflink', 'hardlink', 'object' or 'copy')."""
+
+    src, dst = Path(src), Path(dst)
+    if reflink(src, dst):
+        return 'reflink'
+    if allow_hardlink and hard_link(src, dst):
+        return 'hardlink'
+
+    obj = store_object(src, file_hash(src, index, new_entries))
+    if link_into_place(obj, dst):
+        return 'object'
+    shutil.copy2(src, dst)
+
+    return 'copy'
+
+
+def absorb(path, index, new_entries):
+    """Replace a file by a link to the object with its content; returns True if space was saved."""
+
+    path = Path(path)
+    st = os.stat(path)
+    sha256 = file_hash(path, index, new_entries)
+    obj = object_path(sha256)
+    if obj.exists():
+        if os.path.samefile(obj, path):
+            return False
+        return link_into_place(obj, path)
+
+    if st.st_nlink > 1:
+        # already shared (e.g. hard-linked to its Raw_Data source, which must not become read-only)
+        return False
+
+    # the file becomes the object (no copy); it is read-only from now on
+    store_object(path, sha256, link_source=True)
+    if not os.path.samefile(obj, path):
+        # the object had to be copied, so link the file to it
+        link_into_place(obj, path)
+
+    return False
+
+
+def copy_tree(src_dir, dst_dir, allow_hardlink=True):
+    """Copy a directory tree (e.g. a .ds) with clone_file; returns a Counter of the methods used."""
+
+    src_dir, dst_dir = Path(src_dir), Path(dst_dir)
+    index = read_index()
+    new_entries = {}
+    methods = Counter()
+    try:
+        for root, _, files in os.walk(src_dir):
+            out_root = dst_dir / Path(root).relative_to(src_dir)
+            out_root.mkdir(parents=True, exist_ok=True)
+            for name in files:
+                src = Path(root) / name
+                if src.is_symlink():
+                    os.symlink(os.readlink(src), out_root / name)
+                    methods['symlink'] += 1
+                else:
+                    methods[clone_file(src, out_root / name, index, new_entries, allow_hardlink)] += 1
+        for root, _, _ in os.walk(src_dir, topdown=False):
+            shutil.copystat(root, dst_dir / Path(root).relative_to(src_dir))
+    finally:
+        update_index(new_entries)
+
+    return methods
+
+
+def absorb_paths(paths):
+    """absorb() every file below paths; returns (n_files, bytes saved)."""
+
+    index = read_index()
+    new_entries = {}
+    n_files, n_saved = 0, 0
+    try:
+        for path in paths:
+            path = Path(path)
+            files = [path] if path.is_file() else [
+                Path(root) / name for root, _, names in os.walk(path) for name in names
+            ]
+            for f in files:
+                if f.is_symlink() or not f.is_file() or store_dir in f.resolve().parents:
+                    continue
+                n_files += 1
+                size = f.stat().st_size
+                if absorb(f, index, new_entries):
+                    n_saved += size
+    finally:
+        update_index(new_entries)
+
+    return n_files, n_saved
+
+
+def collect_garbage():
+    """Remove objects nothing links to any more and index entries of missing files; returns bytes freed."""
+
+    freed = 0
+    if objects_dir.is_dir():
+        for obj in objects_dir.glob('??/*'):
+            st = obj.stat()
+            if st.st_nlink == 1:
+                freed += st.st_size
+                obj.unlink()
+
+    removed = []
+    for key, entry in read_index().items():
+        try:
+            if identity(os.stat(key)) != entry['identity']:
+                removed.append(key)
+        except FileNotFoundError:
+            removed.append(key)
+    update_index({}, removed)
+
+    return freed
+
+
+def store_stats():
+    """(objects, bytes stored, bytes saved by the links to them)."""
+
+    n_objects, n_bytes, n_saved = 0, 0, 0
+    if objects_dir.is_dir():
+        for obj in objects_dir.glob('??/*'):
+            st = obj.stat()
+            n_objects += 1
+            n_bytes += st.st_size
+            n_saved += (st.st_nlink - 2) * st.st_size if st.st_nlink > 2 else 0
+
+    return n_objects, n_bytes, n_saved
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "deduplicated copies into sourcedata (reflink, hardlink or content-addressed objects)"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    copy_parser = subparsers.add_parser("copy", help="copy a directory tree")
+    copy_parser.add_argument("src_dir")
+    copy_parser.add_argument("dst_dir")
+    copy_parser.add_argument("--no_hardlink", action="store_true",
+                             help="never hard-link to the source (use objects instead)")
+
+    absorb_parser = subparsers.add_parser("absorb", help="deduplicate files already in place")
+    absorb_parser.add_argument("paths", nargs="+", help="files or directories")
+
+    subparsers.add_parser("gc", help="remove unreferenced objects and stale index entries")
+    subparsers.add_parser("stats", help="print the size of the object store")
+
+    args = parser.parse_args()
+
+    if args.command == "copy":
+        if Path(args.dst_dir).exists():
+            sys.exit(f"++ {args.dst_dir} already exists ++")
+        methods = copy_tree(args.src_dir, args.dst_dir, allow_hardlink=not args.no_hardlink)
+        print(Colors.GREEN, f"++ Copied {args.src_dir} ({', '.join(f'{n} {m}' for m, n in methods.items())}) ++",
+              Colors.END)
+
+    elif args.command == "absorb":
+        n_files, n_saved = absorb_paths(args.paths)
+        print(Colors.GREEN, f"++ Checked {n_files} files, saved {n_saved / 1024**2:.1f} MiB ++", Colors.END)
+
+    elif args.command == "gc":
+        freed = collect_garbage()
+        print(Colors.GREEN, f"++ Freed {freed / 1024**2:.1f} MiB ++", Colors.END)
+
+    elif args.command == "stats":
+        n_objects, n_bytes, n_saved = store_stats()
+        print(f"++ {n_objects} objects, {n_bytes / 1024**3:.2f} GiB stored, "
+              f"{n_saved / 1024**3:.2f} GiB saved by shared links ++")
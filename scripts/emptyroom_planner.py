@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Match every subject's MEG session to its nearest empty-room recording in one
+pass, then download and convert the unique recordings the cohort still needs
+with a bounded pool, so convert_meg.py finds them all in sub-emptyroom.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import sys
+
+import numpy as np
+
+from colors import Colors
+from neu_paths import files_dir, sourcedata_dir
+from retrieve_emptyroom import (DateIndex, anonymize_date, emptyroom_dir, emptyroom_url, fetch_emptyroom,
+                                find_best_recording, list_page, read_daysback, retrieve_possibles,
+                                subject_meg_date)
+
+
+def plan(pnums, daysback):
+    """{raw empty-room date: {'url', 'ses_date', 'pnums'}} needed by pnums.
+
+    The main listing answers most subjects with one batched query; only
+    subjects whose nearest recording is the most recent one there need the
+    monthly pages (see find_best_recording).
+    """
+
+    goal_dates = {}
+    for pnum in pnums:
+        goal_date = subject_meg_date(pnum)
+        if goal_date is None:
+            print(Colors.YELLOW, f"++ {pnum} has no MEG data in sourcedata; skipping ++", Colors.END)
+        else:
+            goal_dates[pnum] = goal_date
+    if not goal_dates:
+        return {}
+
+    main_urls = list_page(emptyroom_url)
+    possible_dates, possible_urls = retrieve_possibles(main_urls)
+    best_idx = DateIndex(possible_dates).nearest_index(np.array(list(goal_dates.values())))
+
+    needed = {}
+    for (pnum, goal_date), idx in zip(goal_dates.items(), np.atleast_1d(best_idx)):
+        if idx == len(possible_dates) - 1:
+            best_date, best_url = find_best_recording(goal_date, main_urls)
+        else:
+            best_date, best_url = possible_dates[idx], possible_urls[idx]
+        entry = needed.setdefault(best_date, {'url': best_url, 'pnums': []})
+        entry['pnums'].append(pnum)
+
+    ses_dates = anonymize_date(np.array(list(needed)), daysback)
+    for entry, ses_date in zip(needed.values(), np.atleast_1d(ses_dates)):
+        entry['ses_date'] = int(ses_date)
+
+    return needed
+
+
+def fetch(best_date, entry, daysback):
+    """Download and convert one recording; returns True on success."""
+
+    try:
+        fetch_emptyroom(best_date, entry['url'], daysback)
+    except Exception as e:
+        print(Colors.RED, f"++ Emptyroom ses-{entry['ses_date']} failed ({', '.join(entry['pnums'])}): {e} ++",
+              Colors.END)
+        return False
+
+    print(Colors.GREEN, f"++ Emptyroom ses-{entry['ses_date']} ready ++", Colors.END)
+    return True
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "prefetch the emptyroom recordings needed by a cohort of MEG subjects"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("pnums", nargs="*", help="subject p-numbers (default: every subject with MEG sourcedata)")
+    parser.add_argument("-l", "--list", help="file with one subject per line")
+    parser.add_argument("--files_dir", default=files_dir, help="location of daysback.txt")
+    parser.add_argument("--n_jobs", type=int, default=4, help="concurrent downloads")
+    parser.add_argument("--dry_run", action="store_true", help="only show the plan")
+
+    args = parser.parse_args()
+
+    pnums = list(args.pnums)
+    if args.list:
+        with open(args.list, 'r') as f:
+            pnums += f.read().split()
+    if not pnums:
+        pnums = sorted(d.parents[1].name[len('sub-'):] for d in sourcedata_dir.glob('sub-*/ses-meg/meg'))
+
+    daysback = read_daysback(args.files_dir)
+    needed = plan(pnums, daysback)
+
+    missing = {}
+    for best_date, entry in sorted(needed.items()):
+        exists = (emptyroom_dir / f"ses-{entry['ses_date']}").exists()
+        status = 'present' if exists else 'missing'
+        print(f"ses-{entry['ses_date']}\t{status}\t{entry['url']}\t{' '.join(entry['pnums'])}")
+        if not exists:
+            missing[best_date] = entry
+
+    print(Colors.YELLOW, f"++ {len(needed)} emptyroom session(s) for {len(pnums)} subject(s); "
+          f"{len(missing)} to fetch ++", Colors.END)
+    if args.dry_run or not missing:
+        sys.exit()
+
+    with ThreadPoolExecutor(max_workers=args.n_jobs) as pool:
+        results = list(pool.map(lambda item: fetch(*item, daysback), missing.items()))
+
+    if not all(results):
+        sys.exit(1)
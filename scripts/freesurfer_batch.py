@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Run recon-all for many subjects at once. Subjects are gated on the QC status
+store and given T1/T2/FLAIR inputs with the same rules as freesurfer_proc.sh; jobs
+are spread over the node with -openmp/-parallel sized to the core count, and
+a ledger in the FreeSurfer directory records each subject's status so an
+interrupted batch picks up where it stopped. A batch claims a subject in the
+ledger before queueing it, so concurrent batches never run the same subject,
+and only subject directories the ledger saw recon-all create are removed.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+import csv
+from datetime import datetime
+import fcntl
+import os
+from pathlib import Path
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+
+from colors import Colors
+from instrument import logs_dir, run_command
+from neu_paths import bids_root, fs_dir
+from qc_status import get_status, load_status
+
+ledger_file = fs_dir / 'recon_ledger.tsv'
+LEDGER_COLUMNS = ['fs_subj', 'status', 'host', 'pid', 'threads', 'started', 'finished', 'returncode', 'message',
+                  'fs_dir_id']
+
+# recon-all peaks at a few GB; never run more jobs than memory allows
+MEM_PER_JOB = 4 * 1024**3
+# -parallel runs both hemispheres at once, which needs at least this many threads
+PARALLEL_MIN_THREADS = 4
+# seconds between checks for the subject directory recon-all creates
+DIR_POLL = 5
+
+
+def check_version():
+    """Exit unless FreeSurfer stable v6.0.0 is set up (as in freesurfer_proc.sh)."""
+
+    try:
+        version = subprocess.run(['recon-all', '-version'], capture_output=True, text=True).stdout
+    except OSError:
+        version = ''
+    if '-stable-pub-v6.0.0-' not in version:
+        print(Colors.RED, "++ Unrecognized FreeSurfer release. Please make sure Freesurfer "
+              "stable v6.0.0 is installed and setup. Exiting... ++", Colors.END)
+        sys.exit(1)
+
+
+def select_session(pnum, postop=False):
+    """Clinical session used for FreeSurfer (clinical, else altclinical)."""
+
+    ses_suffix = 'postop' if postop else ''
+    for session in (f'clinical{ses_suffix}', f'altclinical{ses_suffix}'):
+        if (bids_root / f'sub-{pnum}' / f'ses-{session}' / 'anat').is_dir():
+            return session
+
+    return None
+
+
+def qc_gate(pnum, session, cohort_status=None):
+    """None if registration QC passed for the session, else the reason it did not."""
+
+    status = get_status(pnum, session, cohort_status)
+    if status == 'success':
+        return None
+    if status == 'failure':
+        return f'registration failed for ses-{session}'
+    return f'no registration qc output for ses-{session} (run bids_qc.sh)'
+
+
+def recon_inputs(pnum, session):
+    """(description, recon-all input arguments) following freesurfer_proc.sh."""
+
+    stem = bids_root / f'sub-{pnum}' / f'ses-{session}' / 'anat' / f'sub-{pnum}_ses-{session}_rec-axialized'
+    t1 = Path(f'{stem}_T1w.nii.gz')
+    t2 = Path(f'{stem}_T2w.nii.gz')
+    flair = Path(f'{stem}_FLAIR.nii.gz')
+
+    if not t1.is_file():
+        return None, None
+    if t2.is_file():
+        return 'T1 and T2', ['-i', str(t1), '-T2', str(t2), '-T2pial', '-contrasurfreg']
+    if flair.is_file():
+        return 'T1 and FLAIR', ['-i', str(t1), '-FLAIR', str(flair), '-FLAIRpial', '-contrasurfreg']
+    return 'T1 only', ['-i', str(t1), '-contrasurfreg']
+
+
+def node_resources():
+    """(usable cores, physical memory in bytes) of this node."""
+
+    if hasattr(os, 'sched_getaffinity'):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    try:
+        memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError):
+        memory = None
+
+    return cores, memory
+
+
+def plan_threads(n_subjects, max_jobs=None, threads=None):
+    """(concurrent jobs, threads per job) for n_subjects on this node."""
+
+    cores, memory = node_resources()
+    if max_jobs is None:
+        threads = threads or PARALLEL_MIN_THREADS
+        max_jobs = max(1, cores // threads)
+        if memory:
+            max_jobs = min(max_jobs, max(1, memory // MEM_PER_JOB))
+    max_jobs = max(1, min(max_jobs, n_subjects or 1))
+    if threads is None:
+        threads = max(1, cores // max_jobs)
+
+    return max_jobs, threads
+
+
+def pid_alive(pid):
+
+    try:
+        os.kill(int(pid), 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def read_ledger():
+    """fs_subj -> ledger row."""
+
+    ledger = {}
+    if ledger_file.is_file():
+        with open(ledger_file, 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                ledger[row['fs_subj']] = row
+
+    return ledger
+
+
+@contextmanager
+def locked_ledger():
+    """Yield the ledger for modification and save it atomically on exit (safe across batches)."""
+
+    fs_dir.mkdir(parents=True, exist_ok=True)
+    with open(ledger_file.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        ledger = read_ledger()
+        yield ledger
+
+        tmp_file = ledger_file.with_name(f'.{ledger_file.name}.tmp')
+        with open(tmp_file, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=LEDGER_COLUMNS, delimiter='\t', extrasaction='ignore')
+            writer.writeheader()
+            for key in sorted(ledger):
+                writer.writerow(ledger[key])
+        os.replace(tmp_file, ledger_file)
+
+
+def set_fields(ledger, fs_subj, **fields):
+
+    row = ledger.setdefault(fs_subj, {col: '' for col in LEDGER_COLUMNS})
+    row['fs_subj'] = fs_subj
+    row.update({k: str(v) for k, v in fields.items()})
+
+
+def update_ledger(fs_subj, **fields):
+    """Update one subject's ledger row under the ledger lock."""
+
+    with locked_ledger() as ledger:
+        set_fields(ledger, fs_subj, **fields)
+
+
+def dir_identity(path):
+    """'device:inode' of a directory, or '' if it does not exist."""
+
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return ''
+
+    return f'{st.st_dev}:{st.st_ino}'
+
+
+def was_interrupted(row):
+    """True for a 'queued' or 'running' ledger entry whose process is gone."""
+
+    if row.get('status') not in ('queued', 'running'):
+        return False
+    if row.get('host') != socket.gethostname():
+        # cannot check processes on other nodes; trust the entry
+        return False
+    return not pid_alive(row.get('pid'))
+
+
+def prepare_job(pnum, postop, ledger, cohort_status=None, dry_run=False):
+    """(fs_subj, recon-all input args) to run, or None with the reason logged.
+
+    With dry_run nothing is written to the ledger or removed.
+    """
+
+    def record(fs_subj, **fields):
+        if not dry_run:
+            update_ledger(fs_subj, **fields)
+
+    session = select_session(pnum, postop)
+    if session is None:
+        ses_suffix = 'postop' if postop else ''
+        print(Colors.YELLOW, f"++ {pnum} does not have ses-clinical{ses_suffix} or "
+              f"ses-altclinical{ses_suffix} necessary to run Freesurfer. ++", Colors.END)
+        return None
+
+    fs_subj = f'sub-{pnum}_ses-{session}'
+    row = ledger.get(fs_subj, {})
+    subj_fs_dir = fs_dir / fs_subj
+
+    if row.get('status') == 'done' and subj_fs_dir.is_dir():
+        return None
+    if row.get('status') in ('queued', 'running') and not was_interrupted(row):
+        print(Colors.YELLOW, f"++ {fs_subj} is {row['status']} on {row['host']} ++", Colors.END)
+        return None
+
+    reason = qc_gate(pnum, session, cohort_status)
+    if reason:
+        print(Colors.YELLOW, f"++ Skipping {fs_subj}: {reason} ++", Colors.END)
+        record(fs_subj, status='skipped', message=reason)
+        return None
+
+    description, input_args = recon_inputs(pnum, session)
+    if input_args is None:
+        print(Colors.YELLOW, f"++ {fs_subj} has no axialized T1 ++", Colors.END)
+        record(fs_subj, status='skipped', message='no axialized T1')
+        return None
+
+    outcome, row = claim(fs_subj, subj_fs_dir, dry_run)
+    if outcome == 'done':
+        return None
+    if outcome == 'busy':
+        print(Colors.YELLOW, f"++ {fs_subj} is {row['status']} on {row['host']} ++", Colors.END)
+        return None
+    if outcome == 'existing':
+        print(Colors.YELLOW, f"++ Freesurfer has already been run for {fs_subj}. Please delete to rerun. ++", Colors.END)
+        return None
+    if outcome == 'restart':
+        # partial output of an earlier batch; start the subject again
+        print(Colors.YELLOW, f"++ Restarting interrupted/failed {fs_subj} ++", Colors.END)
+        if not dry_run:
+            shutil.rmtree(subj_fs_dir)
+
+    print(Colors.GREEN, f"++ Queued {fs_subj} with {description} images ++", Colors.END)
+
+    return fs_subj, input_args
+
+
+def claim(fs_subj, subj_fs_dir, dry_run=False):
+    """Check and claim fs_subj for this batch in one locked ledger update.
+
+    Returns (outcome, ledger row) where outcome is 'queued', 'restart' (the
+    partial directory recon-all made for the ledger must be removed first),
+    'done', 'busy' (claimed by a live batch) or 'existing' (a directory the
+    ledger did not create). With dry_run the ledger is only read.
+    """
+
+    with (nullcontext(read_ledger()) if dry_run else locked_ledger()) as ledger:
+        row = dict(ledger.get(fs_subj, {}))
+        if row.get('status') == 'done' and subj_fs_dir.is_dir():
+            return 'done', row
+        if row.get('status') in ('queued', 'running') and not was_interrupted(row):
+            return 'busy', row
+
+        outcome = 'queued'
+        if subj_fs_dir.is_dir():
+            if row.get('status') in ('queued', 'running', 'failed') and \
+                    row.get('fs_dir_id') and row['fs_dir_id'] == dir_identity(subj_fs_dir):
+                outcome = 'restart'
+            else:
+                set_fields(ledger, fs_subj, status='done', message='found existing directory')
+                return 'existing', row
+
+        # fs_dir_id stays until the directory is removed, so a crash in between can still restart it
+        set_fields(ledger, fs_subj, status='queued', host=socket.gethostname(), pid=os.getpid(), threads='',
+                   started='', finished='', returncode='', message='')
+
+    return outcome, row
+
+
+def watch_fs_dir(fs_subj, finished):
+    """Record the identity of the subject directory once recon-all has created it."""
+
+    subj_fs_dir = fs_dir / fs_subj
+    while not finished.wait(DIR_POLL):
+        fs_dir_id = dir_identity(subj_fs_dir)
+        if fs_dir_id:
+            update_ledger(fs_subj, fs_dir_id=fs_dir_id)
+            return
+
+
+def run_recon(fs_subj, input_args, threads):
+    """Run recon-all -all for one subject and record the outcome in the ledger."""
+
+    cmd = ['recon-all', '-s', fs_subj, '-sd', str(fs_dir), '-all'] + input_args
+    cmd += ['-openmp', str(threads)]
+    if threads >= PARALLEL_MIN_THREADS:
+        cmd.append('-parallel')
+
+    if (fs_dir / fs_subj).exists():
+        # made by someone else since the claim; it is not ours to use or remove
+        print(Colors.RED, f"++ {fs_subj} appeared before recon-all started ++", Colors.END)
+        update_ledger(fs_subj, status='failed', message='directory appeared before recon-all started',
+                      fs_dir_id='')
+        return 1
+
+    # the directory does not exist yet, so the one recon-all creates is ours
+    update_ledger(fs_subj, status='running', host=socket.gethostname(), pid=os.getpid(),
+                  threads=threads, started=datetime.now().isoformat(timespec='seconds'),
+                  finished='', returncode='', message='', fs_dir_id='')
+    finished = threading.Event()
+    watcher = threading.Thread(target=watch_fs_dir, args=(fs_subj, finished), daemon=True)
+    watcher.start()
+
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(logs_dir / f'recon-all_{fs_subj}.log', 'w') as log:
+            returncode = run_command(cmd, stage='recon-all', stdout=log, stderr=subprocess.STDOUT,
+                                     subject=fs_subj.split('_')[0][len('sub-'):],
+                                     session=fs_subj.split('_')[1])
+    finally:
+        finished.set()
+        watcher.join()
+
+    status = 'done' if returncode == 0 else 'failed'
+    with locked_ledger() as ledger:
+        fields = {'status': status, 'finished': datetime.now().isoformat(timespec='seconds'),
+                  'returncode': returncode}
+        if not ledger[fs_subj].get('fs_dir_id'):
+            fields['fs_dir_id'] = dir_identity(fs_dir / fs_subj)
+        set_fields(ledger, fs_subj, **fields)
+    color = Colors.GREEN if returncode == 0 else Colors.RED
+    print(color, f"++ recon-all {status} for {fs_subj} ++", Colors.END)
+
+    return returncode
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "run recon-all for many subjects in parallel"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("-p", "--postop", action="store_true", help="use the postop clinical sessions")
+    parser.add_argument("-l", "--list", help="file with one subject per line")
+    parser.add_argument("--max_jobs", type=int, help="concurrent recon-all jobs (default: sized to cores and memory)")
+    parser.add_argument("--threads", type=int, help="OpenMP threads per job (default: cores / jobs)")
+    parser.add_argument("--dry_run", action="store_true", help="only show what would run")
+    parser.add_argument("--status", action="store_true", help="print the ledger and exit")
+    parser.add_argument("subjects", nargs="*", help="subject p-numbers")
+
+    args = parser.parse_args()
+
+    if args.status:
+        for row in read_ledger().values():
+            print(f"{row['fs_subj']:<36}{row['status']:<10}{row['host']:<16}{row['finished'] or row['started']:<22}{row['message']}")
+        sys.exit()
+
+    pnums = list(args.subjects)
+    if args.list:
+        with open(args.list, 'r') as f:
+            pnums += f.read().split()
+    if not pnums:
+        parser.error("no subjects given")
+
+    if not args.dry_run:
+        check_version()
+
+    ledger = read_ledger()
+    cohort_status = load_status()
+    jobs = [job for job in (prepare_job(pnum, args.postop, ledger, cohort_status, args.dry_run)
+                            for pnum in pnums) if job]
+    max_jobs, threads = plan_threads(len(jobs), args.max_jobs, args.threads)
+    print(Colors.YELLOW, f"++ {len(jobs)} recon-all job(s): {max_jobs} at a time, {threads} thread(s) each ++", Colors.END)
+
+    if args.dry_run or not jobs:
+        sys.exit()
+
+    with ThreadPoolExecutor(max_workers=max_jobs) as pool:
+        returncodes = list(pool.map(lambda job: run_recon(*job, threads), jobs))
+
+    if any(returncodes):
+        sys.exit(1)
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Per-stage timing and resource records for the pipeline. Python stages use
+stage_timer(), shell tools are wrapped with `instrument.py run`, and every
+record (wall/CPU time, peak RSS, bytes read/written) is appended as one JSON
+line to the run log named by $BIDS_PROC_RUN_LOG.
+"""
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import csv
+from datetime import datetime
+import json
+import math
+import os
+from pathlib import Path
+import resource
+import socket
+import subprocess
+import sys
+import time
+
+from neu_paths import derivatives_dir
+
+logs_dir = derivatives_dir / 'pipeline_logs'
+stage_costs_file = logs_dir / 'stage_costs.tsv'
+
+# ru_maxrss is reported in kilobytes on Linux and in bytes on Mac OS
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def new_run_log():
+    """Path of a fresh JSONL log for this pipeline run."""
+
+    stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+    return logs_dir / f'run-{stamp}_{socket.gethostname()}_{os.getpid()}.jsonl'
+
+
+def run_log():
+    """Run log shared by all stages of this run (created on first use)."""
+
+    if not os.environ.get('BIDS_PROC_RUN_LOG'):
+        os.environ['BIDS_PROC_RUN_LOG'] = str(new_run_log())
+
+    return Path(os.environ['BIDS_PROC_RUN_LOG'])
+
+
+def read_proc_io(pid='self'):
+    """(read_bytes, write_bytes) from /proc/<pid>/io, or (None, None) if unavailable."""
+
+    try:
+        with open(f'/proc/{pid}/io', 'r') as f:
+            fields = dict(line.split(': ') for line in f.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def write_record(record):
+    """Append one stage record to the run log."""
+
+    log_file = run_log()
+    try:
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        # single small appends are atomic, so parallel stages can share a log
+        with open(log_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        print(f'++ Could not write stage timing to {log_file}: {e} ++', file=sys.stderr)
+
+
+def make_record(stage, labels, start, wall, cpu, max_rss, io_read, io_write, returncode):
+    """Build one log record; labels with a value of None are dropped."""
+
+    record = {
+        'stage': stage,
+        'start': start.isoformat(timespec='seconds'),
+        'host': socket.gethostname(),
+        'wall_s': round(wall, 3),
+        'cpu_s': round(cpu, 3),
+        'max_rss_bytes': max_rss,
+        'read_bytes': io_read,
+        'write_bytes': io_write,
+        'returncode': returncode,
+    }
+    record.update({k: v for k, v in labels.items() if v is not None})
+
+    return record
+
+
+@contextmanager
+def stage_timer(stage, **labels):
+    """Time a block of Python code (plus any children it waits for) as one stage.
+
+    Peak RSS is the high-water mark of this process and its children, so it
+    is an upper bound when several stages run in one interpreter.
+    """
+
+    start = datetime.now()
+    t0 = time.perf_counter()
+    self0 = resource.getrusage(resource.RUSAGE_SELF)
+    children0 = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read0, write0 = read_proc_io()
+    returncode = 0
+    try:
+        yield
+    except BaseException:
+        returncode = 1
+        raise
+    finally:
+        wall = time.perf_counter() - t0
+        self1 = resource.getrusage(resource.RUSAGE_SELF)
+        children1 = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read1, write1 = read_proc_io()
+        cpu = (self1.ru_utime + self1.ru_stime - self0.ru_utime - self0.ru_stime
+               + children1.ru_utime + children1.ru_stime
+               - children0.ru_utime - children0.ru_stime)
+        max_rss = max(self1.ru_maxrss, children1.ru_maxrss) * RSS_UNIT
+        io_read = read1 - read0 if read0 is not None else None
+        io_write = write1 - write0 if write0 is not None else None
+        write_record(make_record(stage, labels, start, wall, cpu, max_rss,
+                                 io_read, io_write, returncode))
+
+
+def run_command(cmd, stage=None, cwd=None, env=None, stdout=None, stderr=None, **labels):
+    """Run an external command, record its resource use and return its exit code.
+
+    The child's own rusage is collected with wait4, so this is exact even
+    when several commands run from threads of the same process.
+    """
+
+    stage = stage or Path(cmd[0]).name
+    start = datetime.now()
+    t0 = time.perf_counter()
+    try:
+        proc = subprocess.Popen(cmd, cwd=cwd, env=env, stdout=stdout, stderr=stderr)
+    except OSError as e:
+        # missing or non-executable binary: record it like the shell's 127
+        print(f'++ Could not run {cmd[0]}: {e} ++', file=sys.stderr)
+        write_record(make_record(stage, labels, start, time.perf_counter() - t0, 0.0, 0, None, None, 127))
+        return 127
+
+    io_read, io_write = None, None
+    if hasattr(os, 'waitid'):
+        # wait without reaping so /proc/<pid>/io can still be read
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        io_read, io_write = read_proc_io(proc.pid)
+    _, status, usage = os.wait4(proc.pid, 0)
+    wall = time.perf_counter() - t0
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    write_record(make_record(
+        stage, labels, start, wall, usage.ru_utime + usage.ru_stime,
+        usage.ru_maxrss * RSS_UNIT, io_read, io_write, proc.returncode
+    ))
+
+    return proc.returncode
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers."""
+
+    values = sorted(values)
+    rank = max(1, math.ceil(q / 100 * len(values)))
+    return values[rank - 1]
+
+
+def read_records(log_files):
+    """All stage records from a list of JSONL logs."""
+
+    records = []
+    for log_file in log_files:
+        with open(log_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        continue
+
+    return records
+
+
+def summarize(records, successful_only=True):
+    """Per-stage n and p50/p95 of wall time, CPU time, peak RSS and I/O."""
+
+    by_stage = {}
+    for record in records:
+        if successful_only and record.get('returncode') not in (0, None):
+            continue
+        by_stage.setdefault(record['stage'], []).append(record)
+
+    summary = []
+    for stage, stage_records in sorted(by_stage.items()):
+        row = {'stage': stage, 'n': len(stage_records)}
+        for key, name in [('wall_s', 'wall_s'), ('cpu_s', 'cpu_s'),
+                          ('max_rss_bytes', 'rss'), ('read_bytes', 'read'),
+                          ('write_bytes', 'write')]:
+            values = [r[key] for r in stage_records if r.get(key) is not None]
+            for q in (50, 95):
+                row[f'p{q}_{name}'] = percentile(values, q) if values else ''
+        summary.append(row)
+
+    return summary
+
+
+def format_bytes(n):
+    """Human readable byte count ('-' if unknown)."""
+
+    if n == '':
+        return '-'
+    for unit in ('B', 'K', 'M', 'G'):
+        if abs(n) < 1024:
+            return f'{n:.0f}{unit}'
+        n /= 1024
+    return f'{n:.1f}T'
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "record and summarize per-stage timing and resource use"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="run a command and record it as a stage")
+    run_parser.add_argument("--stage", help="stage name (default: command name)")
+    run_parser.add_argument("--subject", help="subject p-number")
+    run_parser.add_argument("--session", help="BIDS session")
+    run_parser.add_argument("cmd", nargs="+", help="command to run (after --)")
+
+    new_parser = subparsers.add_parser("new-log", help="print a fresh run log path")
+
+    summary_parser = subparsers.add_parser("summary", help="p50/p95 per stage across runs")
+    summary_parser.add_argument("logs", nargs="*", help=f"JSONL logs (default: all in {logs_dir})")
+    summary_parser.add_argument("--write_costs", action="store_true",
+                                help=f"also write median stage costs to {stage_costs_file}")
+
+    args = parser.parse_args()
+
+    if args.command == "run":
+        sys.exit(run_command(args.cmd, stage=args.stage, subject=args.subject, session=args.session))
+
+    elif args.command == "new-log":
+        print(new_run_log())
+
+    elif args.command == "summary":
+        log_files = args.logs or sorted(logs_dir.glob('run-*.jsonl'))
+        summary = summarize(read_records(log_files))
+        if not summary:
+            sys.exit("++ No stage records found. ++")
+
+        print(f"{'stage':<26}{'n':>6}{'wall p50':>11}{'wall p95':>11}{'cpu p50':>10}"
+              f"{'rss p95':>9}{'read p50':>10}{'write p50':>11}")
+        for row in summary:
+            print(f"{row['stage']:<26}{row['n']:>6}{row['p50_wall_s']:>10.1f}s{row['p95_wall_s']:>10.1f}s"
+                  f"{row['p50_cpu_s']:>9.1f}s{format_bytes(row['p95_rss']):>9}"
+                  f"{format_bytes(row['p50_read']):>10}{format_bytes(row['p50_write']):>11}")
+
+        if args.write_costs:
+            stage_costs_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(stage_costs_file, 'w', newline='') as f:
+                writer = csv.writer(f, delimiter='\t')
+                writer.writerow(['stage', 'n', 'p50_s', 'p95_s'])
+                for row in summary:
+                    writer.writerow([row['stage'], row['n'], row['p50_wall_s'], row['p95_wall_s']])
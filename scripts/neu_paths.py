@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Shared NEU share locations and path conventions used by the proc_* scripts.
+"""
+
+import os
+from pathlib import Path
+import sys
+
+from colors import Colors
+
+# check OS (NEU_DIR overrides the share location, e.g. for synthetic trees)
+if os.environ.get("NEU_DIR"):
+    neu_dir = Path(os.environ["NEU_DIR"])
+elif sys.platform == "darwin":
+    neu_dir = Path("/Volumes/shares/NEU")
+elif sys.platform == "linux":
+    neu_dir = Path("/shares/NEU")
+else:
+    print(Colors.RED, f"++ Unrecognized OS '{sys.platform}'; please run on ",
+          "either linux or Mac OS ++", Colors.END)
+    sys.exit(1)
+
+repo_dir = Path(__file__).resolve().parents[1]
+scripts_dir = repo_dir / 'scripts'
+files_dir = repo_dir / 'files'
+
+bids_root = neu_dir / 'Data'
+sourcedata_dir = bids_root / 'sourcedata'
+derivatives_dir = bids_root / 'derivatives'
+fs_dir = derivatives_dir / 'freesurfer-6.0.0'
+registration_qc_dir = derivatives_dir / 'registration_qc'
+
+raw_dir = neu_dir / 'Raw_Data'
+raw_research_dir = raw_dir / 'fMRI_DTI'
+raw_clinical_dir = raw_dir / 'Multicontrast_MRI'
+raw_altclinical_dir = raw_dir / 'Other_MRI'
+raw_meg_dir = raw_dir / 'MEG'
+
+pnum_key = neu_dir / 'Scripts_and_Parameters' / '14N0061_key'
+meg_key = neu_dir / 'Scripts_and_Parameters' / 'meg_key'
+
+
+def folder_types(pnum):
+    """Raw_Data folder types that can hold scans for pnum."""
+
+    if pnum.startswith('hv'):
+        return ['Healthy_Volunteers']
+    return ['Patients', 'Post-op']
+
+
+def ses_suffix(folder_type):
+    """Session suffix ('' or 'postop') for a Raw_Data folder type."""
+
+    return 'postop' if folder_type == 'Post-op' else ''
+
+
+def read_key(key_path):
+    """Read a key=value file (e.g. 14N0061_key) into a dictionary."""
+
+    key_dict = {}
+    with open(key_path, 'r') as f:
+        for line in f:
+            line = line.strip().replace('\r', '')
+            if '=' not in line:
+                continue
+            key, val = line.split('=', 1)
+            key_dict[key] = val
+
+    return key_dict
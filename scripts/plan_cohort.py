@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Dry-run planner: list the stage jobs bids_proc.sh would run for a cohort
+without touching any data. Raw_Data and the BIDS tree are each listed once
+with os.scandir and checked with the same path conventions as proc_*.sh;
+research series are matched by name with the series catalog rules.
+"""
+
+from argparse import ArgumentParser
+import csv
+import json
+import os
+from pathlib import Path
+import shlex
+import sys
+
+from anat_proc import SESSION_SPECS, bids_name
+from colors import Colors
+from instrument import stage_costs_file
+from neu_paths import (bids_root, folder_types, fs_dir,
+                       pnum_key, raw_altclinical_dir, raw_clinical_dir,
+                       raw_meg_dir, raw_research_dir, read_key, scripts_dir,
+                       ses_suffix)
+from series_catalog import select_series
+
+# rough per-job wall times (seconds), used until timings have been recorded
+DEFAULT_STAGE_COSTS = {
+    'research_anat': 900,
+    'clinical_anat': 900,
+    'altclinical_anat': 900,
+    'dwi': 300,
+    'perf': 120,
+    'rsfmri': 1200,
+    'create_trans_meg_precompute': 300,
+    'meg': 1500,
+}
+
+
+def list_dir(path):
+    """Names of the entries in path (empty set if it does not exist)."""
+
+    try:
+        with os.scandir(path) as it:
+            return {entry.name for entry in it}
+    except (FileNotFoundError, NotADirectoryError):
+        return set()
+
+
+def list_subdirs(path):
+    """Names of the sub-directories of path (empty list if it does not exist)."""
+
+    try:
+        with os.scandir(path) as it:
+            return sorted(entry.name for entry in it if entry.is_dir())
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+
+
+def index_bids_subject(pnum):
+    """Map 'ses-x/datatype' to the file names in it for one BIDS subject."""
+
+    index = {}
+    subj_dir = bids_root / f'sub-{pnum}'
+    for session in list_subdirs(subj_dir):
+        for datatype in list_subdirs(subj_dir / session):
+            index[f'{session}/{datatype}'] = list_dir(subj_dir / session / datatype)
+
+    return index
+
+
+def load_stage_costs(costs_file=stage_costs_file):
+    """Median stage wall times from recorded timings, else the defaults."""
+
+    costs = dict(DEFAULT_STAGE_COSTS)
+    if Path(costs_file).is_file():
+        with open(costs_file, 'r') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                costs[row['stage']] = float(row['p50_s'])
+
+    return costs
+
+
+def pending_anat(pnum, session, spec, entries, bids_files, claimed):
+    """Contrasts of an anat session spec that have raw data but no BIDS output."""
+
+    pending = []
+    for contrast in spec['contrasts']:
+        if 'role' in contrast:
+            if not select_series(contrast['role'], dict.fromkeys(entries)):
+                continue
+        elif not any(folder in entries for folder, _ in contrast['raw_folders']):
+            continue
+        out_name = bids_name(pnum, session, contrast, rec=True) + '.nii.gz'
+        if out_name not in bids_files and out_name not in claimed:
+            claimed.add(out_name)
+            pending.append(contrast['suffix'])
+
+    return pending
+
+
+def pending_rsfmri(pnum, session, entries, bids_files, claimed):
+    """Resting state tasks that the GE or Siemens branch of proc_rsfmri.sh would convert."""
+
+    series = dict.fromkeys(entries)
+    if select_series('fmap_ge_forward', series) and select_series('fmap_ge_reverse', series):
+        roles = {'resteyesopen': 'rest_ge_open', 'resteyesclosed': 'rest_ge_closed'}
+    elif select_series('fmap_siemens_forward', series) and select_series('fmap_siemens_reverse', series):
+        roles = {'resteyesopen': 'rest_siemens_open', 'resteyesclosed': 'rest_siemens_closed'}
+    else:
+        return []
+
+    pending = []
+    for task, role in roles.items():
+        runs = select_series(role, series)
+        out_name = f'sub-{pnum}_ses-{session}_task-{task}_run-1_echo-1_bold.nii.gz'
+        if runs and out_name not in bids_files and out_name not in claimed:
+            claimed.add(out_name)
+            pending.append(f'{task} ({len(runs)} runs)')
+
+    return pending
+
+
+def stage_command(script, *args):
+    """Shell command that runs one proc_*.sh stage."""
+
+    return ' '.join(shlex.quote(str(a)) for a in ('bash', scripts_dir / script) + args)
+
+
+def plan_research_session(pnum, folder_type, raw_session_dir, bids_index, claimed):
+    """Jobs for one raw research session directory."""
+
+    session = 'research' + ses_suffix(folder_type)
+    entries = list_dir(raw_session_dir)
+    jobs = []
+
+    def add(stage, detail, script):
+        jobs.append({
+            'subject': pnum,
+            'session': f'ses-{session}',
+            'stage': stage,
+            'detail': detail,
+            'raw': str(raw_session_dir),
+            'command': stage_command(script, '--folder_type', folder_type,
+                                     '--raw_session_dir', raw_session_dir, pnum),
+        })
+
+    anat_files = bids_index.get(f'ses-{session}/anat', set())
+    contrasts = pending_anat(pnum, session, SESSION_SPECS['research'], entries, anat_files, claimed)
+    if contrasts:
+        add('research_anat', ','.join(contrasts), 'proc_research_anat.sh')
+
+    series = dict.fromkeys(entries)
+    dwi_files = bids_index.get(f'ses-{session}/dwi', set())
+    if select_series('dwi_ge_down', series):
+        scanner = 'GE'
+    elif select_series('dwi_siemens', series):
+        scanner = 'Siemens'
+    else:
+        scanner = None
+    if scanner:
+        directions = []
+        for direction in ('up', 'down'):
+            out_name = f'sub-{pnum}_ses-{session}_acq-{scanner}_dir-{direction}_dwi.nii.gz'
+            if out_name not in dwi_files and out_name not in claimed:
+                claimed.add(out_name)
+                directions.append(direction)
+        if directions:
+            add('dwi', f"{scanner} dir-{','.join(directions)}", 'proc_dwi.sh')
+
+    perf_files = bids_index.get(f'ses-{session}/perf', set())
+    out_name = f'sub-{pnum}_ses-{session}_asl.nii.gz'
+    if select_series('asl', series) and out_name not in perf_files and out_name not in claimed:
+        claimed.add(out_name)
+        add('perf', 'asl', 'proc_perf.sh')
+
+    func_files = bids_index.get(f'ses-{session}/func', set())
+    tasks = pending_rsfmri(pnum, session, entries, func_files, claimed)
+    if tasks:
+        add('rsfmri', ','.join(tasks), 'proc_rsfmri.sh')
+
+    return jobs
+
+
+def plan_clinical_session(pnum, folder_type, subj_name, session_type, raw_subj_dir, bids_index, claimed):
+    """Jobs for a clinical or altclinical raw subject directory."""
+
+    session = session_type + ses_suffix(folder_type)
+    entries = list_dir(raw_subj_dir)
+    anat_files = bids_index.get(f'ses-{session}/anat', set())
+    contrasts = pending_anat(pnum, session, SESSION_SPECS[session_type], entries, anat_files, claimed)
+    if not contrasts:
+        return []
+
+    return [{
+        'subject': pnum,
+        'session': f'ses-{session}',
+        'stage': f'{session_type}_anat',
+        'detail': ','.join(contrasts),
+        'raw': str(raw_subj_dir),
+        'command': stage_command(f'proc_{session_type}_anat.sh', '--folder_type', folder_type,
+                                 '--subj_name', subj_name, pnum),
+    }]
+
+
+def plan_meg(pnum, folder_type, raw_subj_dir, bids_index, claimed):
+    """MEG jobs if the subject has raw MEG but no converted eyes closed run.
+
+    proc_meg.sh --batch only finalizes the trans file, so a precompute job
+    (copying the .ds first) is planned ahead of it.
+    """
+
+    meg_files = bids_index.get('ses-meg/meg', set())
+    out_name = f'sub-{pnum}_ses-meg_task-resteyesclosed_run-01_meg.fif'
+    if out_name in meg_files or out_name in claimed:
+        return []
+    claimed.add(out_name)
+
+    suffix = ses_suffix(folder_type)
+    fs_subjects = list_dir(fs_dir)
+    has_fs = bool({f'sub-{pnum}_ses-clinical{suffix}', f'sub-{pnum}_ses-altclinical{suffix}'} & fs_subjects)
+
+    jobs = []
+    if has_fs:
+        jobs.append({
+            'subject': pnum,
+            'session': 'ses-meg',
+            'stage': 'create_trans_meg_precompute',
+            'detail': 'retrieve and precompute',
+            'raw': str(raw_subj_dir),
+            'command': ' '.join(shlex.quote(str(a)) for a in (
+                'python', scripts_dir / 'create_trans_meg.py', '--phase', 'precompute', '--retrieve', '--pnum', pnum
+            )),
+        })
+
+    return jobs + [{
+        'subject': pnum,
+        'session': 'ses-meg',
+        'stage': 'meg',
+        'detail': 'convert' if has_fs else 'blocked: no freesurfer directory',
+        'raw': str(raw_subj_dir),
+        'command': stage_command('proc_meg.sh', '--folder_type', folder_type, '--batch', pnum),
+    }]
+
+
+def plan_subject(pnum, subj_name, raw_listings, modalities):
+    """All pending jobs for one subject, in bids_proc.sh order."""
+
+    bids_index = index_bids_subject(pnum)
+    claimed = set()
+    jobs = []
+
+    for folder_type in folder_types(pnum):
+        if 'research' in modalities and subj_name in raw_listings[('research', folder_type)]:
+            subj_raw_dir = raw_research_dir / folder_type / subj_name
+            for session_date in list_subdirs(subj_raw_dir):
+                jobs += plan_research_session(
+                    pnum, folder_type, subj_raw_dir / session_date, bids_index, claimed
+                )
+
+        if 'clinical' in modalities and subj_name in raw_listings[('clinical', folder_type)]:
+            jobs += plan_clinical_session(
+                pnum, folder_type, subj_name, 'clinical',
+                raw_clinical_dir / folder_type / subj_name / 'mri', bids_index, claimed
+            )
+
+        if 'altclinical' in modalities and subj_name in raw_listings[('altclinical', folder_type)]:
+            jobs += plan_clinical_session(
+                pnum, folder_type, subj_name, 'altclinical',
+                raw_altclinical_dir / folder_type / subj_name, bids_index, claimed
+            )
+
+        if 'meg' in modalities and subj_name in raw_listings[('meg', folder_type)]:
+            jobs += plan_meg(pnum, folder_type, raw_meg_dir / folder_type / subj_name, bids_index, claimed)
+
+    return jobs
+
+
+def plan_cohort(pnums, modalities=('research', 'clinical', 'altclinical', 'meg'), costs=None):
+    """Pending jobs for every subject in pnums, with estimated costs."""
+
+    pnum2name = read_key(pnum_key)
+    costs = costs or load_stage_costs()
+
+    # list each Raw_Data folder type once
+    raw_roots = {
+        'research': raw_research_dir,
+        'clinical': raw_clinical_dir,
+        'altclinical': raw_altclinical_dir,
+        'meg': raw_meg_dir,
+    }
+    raw_listings = {}
+    for modality, raw_root in raw_roots.items():
+        for folder_type in ('Patients', 'Post-op', 'Healthy_Volunteers'):
+            raw_listings[(modality, folder_type)] = list_dir(raw_root / folder_type)
+
+    jobs = []
+    for pnum in pnums:
+        if pnum not in pnum2name:
+            print(Colors.PURPLE, f'++ Subject {pnum} does not exist. ++', Colors.END, file=sys.stderr)
+            continue
+        jobs += plan_subject(pnum, pnum2name[pnum], raw_listings, modalities)
+
+    for job in jobs:
+        job['cost_s'] = costs.get(job['stage'], 0)
+
+    return jobs
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "list pending bids_proc.sh stage jobs without converting anything"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("--modality", choices=['research', 'clinical', 'altclinical', 'meg'],
+                        help="only plan one modality")
+    parser.add_argument("-l", "--list", dest="subj_list", help="file with one p-number per line")
+    parser.add_argument("--format", choices=['text', 'tsv', 'json'], default='text')
+    parser.add_argument("subjects", nargs="*", help="subject p-numbers (default: all in key)")
+
+    args = parser.parse_args()
+
+    if args.subj_list:
+        with open(args.subj_list, 'r') as f:
+            pnums = f.read().split()
+    elif args.subjects:
+        pnums = args.subjects
+    else:
+        pnums = sorted(read_key(pnum_key))
+
+    modalities = [args.modality] if args.modality else ['research', 'clinical', 'altclinical', 'meg']
+    jobs = plan_cohort(pnums, modalities)
+
+    if args.format == 'json':
+        json.dump(jobs, sys.stdout, indent=2)
+        print()
+    elif args.format == 'tsv':
+        fields = ['subject', 'session', 'stage', 'detail', 'cost_s', 'raw', 'command']
+        writer = csv.DictWriter(sys.stdout, fieldnames=fields, delimiter='\t')
+        writer.writeheader()
+        writer.writerows(jobs)
+    else:
+        current = None
+        for job in jobs:
+            if job['subject'] != current:
+                current = job['subject']
+                print(f"{Colors.PURPLE}++ {current} ++{Colors.END}")
+            print(f"   {job['session']:<24} {job['stage']:<28} {job['detail']:<40} ~{job['cost_s'] / 60:.0f} min")
+        total = sum(job['cost_s'] for job in jobs)
+        n_subj = len({job['subject'] for job in jobs})
+        print(f"{Colors.YELLOW}++ {len(jobs)} pending jobs for {n_subj} subjects, ~{total / 3600:.1f} h total ++{Colors.END}")
@@ -27,6 +27,11 @@ case "${unameOut}" in
 						 Exiting... ++\033[0m"; exit 1
 esac
 
+scripts_dir=${NEU_dir}/Users/price/dev/bids-proc/scripts
+instrument="python $scripts_dir/instrument.py run --subject $subj"
+series_catalog="python $scripts_dir/series_catalog.py"
+# output compression policy (level, pigz; see compression.py)
+dcm2niix_z=$(python $scripts_dir/compression.py dcm2niix)
 bids_root="${NEU_dir}/Data"
 
 #======================================================================================
@@ -40,13 +45,11 @@ fi
 ## PROCESS DWI SCANS
 subj_session_dwi_dir=$bids_root/sub-${subj}/ses-research${ses_suffix}/dwi
 
-# check for existence of GE DTI directory structure
-if [ -d $raw_session_dir/edti_2mm_45vols_bdown ]; then
+# check for existence of GE DTI series in the raw series catalog
+if $series_catalog has "$raw_session_dir" dwi_ge_down; then
 
     # check to make sure both directions have complete dataset of 3600 files
-    bdown_files=$(find $raw_session_dir/edti_2mm_45vols_bdown -iname "*.dcm" | wc -l | xargs)
-    bup_files=$(find $raw_session_dir/edti_2mm_45vols_bup -iname "*.dcm" | wc -l | xargs)
-    if [[ $bup_files != 3600 ]] || [[ $bdown_files != 3600 ]]; then
+    if ! $series_catalog has "$raw_session_dir" dwi_ge_up dwi_ge_down --complete; then
         exit
     fi
 
@@ -58,20 +61,27 @@ if [ -d $raw_session_dir/edti_2mm_45vols_bdown ]; then
     # dwi dicom to NIFTI
     for direction in "up" "down"; do
         if [ ! -f "$subj_session_dwi_dir"/sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}_dir-${direction}_dwi.nii.gz ]; then
+            # work on node-local scratch and only publish the final files
+            raw_dwi_folder=$($series_catalog find "$raw_session_dir" dwi_ge_${direction} --complete --first)
+            scratch_dir=$(python $scripts_dir/staging.py mkdir --prefix dwi_ --size_hint_dir "$raw_dwi_folder")
+            trap 'rm -rf "$scratch_dir"' EXIT
+
             # run dicom2nii conversion on blip up and blip down datasets
-            dcm2niix_afni -o "$subj_session_dwi_dir" -z y -f sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}_dir-${direction}_dwi "${raw_session_dir}"/edti_2mm_45vols_b${direction}
-            # .bvec and .bval files are already in bids_root directory, so remove them
-            rm -f $subj_session_dwi_dir/*.bv??
+            $instrument -- dcm2niix_afni -o "$scratch_dir" $dcm2niix_z -f sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}_dir-${direction}_dwi "$raw_dwi_folder"
+
+            # .bvec and .bval files are already in bids_root directory, so only publish image and sidecar
+            python $scripts_dir/staging.py publish --into "$subj_session_dwi_dir" \
+                "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}_dir-${direction}_dwi.json \
+                "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}_dir-${direction}_dwi.nii.gz
+            rm -rf "$scratch_dir"
         fi
     done
 
-# check for existence of SIEMENS DTI directory structure
-elif [ -d $raw_session_dir/nih_diff_2mm_45vol ]; then
+# check for existence of SIEMENS DTI series in the raw series catalog
+elif $series_catalog has "$raw_session_dir" dwi_siemens; then
 
-    all_files=$(find "$raw_session_dir"/nih_diff_2mm_45vol -iname "*.dcm" | wc -l | xargs)
-    if [ "$all_files" != 7200 ]; then
-        exit
-    fi
+    # check to make sure the series is complete (7200 files)
+    raw_dwi_folder=$($series_catalog find "$raw_session_dir" dwi_siemens --complete --first) || exit
 
     if [ ! -d $subj_session_dwi_dir ]; then
         mkdir -p $subj_session_dwi_dir
@@ -79,33 +89,10 @@ elif [ -d $raw_session_dir/nih_diff_2mm_45vol ]; then
 
     scanner=Siemens
 
-    for direction in "up" "down"; do
-        if [ ! -f "$subj_session_dwi_dir"/sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}_dir-${direction}_dwi.nii.gz ]; then
-            # move files to temporary folder
-            mkdir "$subj_session_dwi_dir"/temp
-
-            if [ $direction == 'up' ]; then
-                for i in "${raw_session_dir}"/nih_diff_2mm_45vol/*-?????.dcm; do ln -s "$i" "$subj_session_dwi_dir"/temp; done
-                cp "${raw_session_dir}"/nih_diff_2mm_45vol/README-Series.txt "$subj_session_dwi_dir"/temp
-            else
-                for i in "${raw_session_dir}"/nih_diff_2mm_45vol/*-?????_v*2.dcm; do ln -s "$i" "$subj_session_dwi_dir"/temp; done
-                cp "${raw_session_dir}"/nih_diff_2mm_45vol/README-Series_v*2.txt "$subj_session_dwi_dir"/temp
-            fi
-
-            # convert dicom to nifti
-            dcm2niix_afni -o "$subj_session_dwi_dir" -z y -f sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}_dir-${direction}_dwi "$subj_session_dwi_dir"/temp
-        
-            # clean directory
-            rm -rf "$subj_session_dwi_dir"/temp
-            rm -f "$subj_session_dwi_dir"/*.bv??
-
-            if [[ $direction == 'up' ]]; then
-                # manually override phase encoding direction in siemens blip up .json sidecar
-                json_file="$subj_session_dwi_dir"/sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}_dir-${direction}_dwi.json
-                jq '.PhaseEncodingDirection="j"' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
-            fi
-        fi
-    done
+    # split blip up/down into symlink views and convert both directions at once
+    # (directions already in the dwi directory are skipped)
+    $instrument --stage split_siemens_dwi -- python $scripts_dir/split_siemens_dwi.py \
+        "$raw_dwi_folder" "$subj_session_dwi_dir" sub-"${subj}"_ses-research${ses_suffix}_acq-${scanner}
 
 
 fi
\ No newline at end of file
@@ -9,6 +9,7 @@ while [ -n "$1" ]; do
 	# check case; if valid option found, toggle its respective variable on
     case "$1" in
         --folder_type)         folder_type=$2; shift ;;
+        --batch)               batch=1 ;;
 	    *) 				       subj=$1; break ;;
     esac
     shift 	# shift to next argument
@@ -50,6 +51,16 @@ bids_root="${NEU_dir}/Data"
 fs_dir="${bids_root}"/derivatives/freesurfer-6.0.0
 scripts_dir=${NEU_dir}/Users/price/dev/bids-proc/scripts
 files_dir=${NEU_dir}/Users/price/dev/bids-proc/files
+instrument="python $scripts_dir/instrument.py run --subject $subj"
+# heavy Python steps go through the warm worker when one is running (see worker_daemon.py)
+py_run="python $scripts_dir/worker_run.py"
+
+# in batch mode convert_meg.py never prompts (ambiguous subjects are queued for review)
+if [ -n "$batch" ]; then
+    batch_flag="--batch"
+else
+    batch_flag=""
+fi
 
 #======================================================================================
 
@@ -75,18 +86,21 @@ fi
 fs_subj=${subj_fs_dir##*/}
     
 # copy all .ds into meg folder
-python $scripts_dir/retrieve_meg.py "$subj"
+$instrument --stage retrieve_meg -- python $scripts_dir/retrieve_meg.py "$subj"
 
 # retrieve emptyroom and convert to bids format
-python $scripts_dir/retrieve_emptyroom.py \
+$instrument --stage retrieve_emptyroom -- $py_run $scripts_dir/retrieve_emptyroom.py \
     --pnum "$subj"  \
     --files_dir "$files_dir"
 
-# if subject does not have bem files, then run mne_watershed_bem
+# bem surfaces are normally made for the whole batch by bem_batch.py beforehand;
+# make them here only if they are still missing
 if [ ! -f "$subj_fs_dir/bem/inner_skull.surf" ]; then
-    mne watershed_bem \
-        -d $fs_dir \
-        -s "$fs_subj"
+    python $scripts_dir/bem_batch.py --fs_subj "$fs_subj"
+    if [ ! -f "$subj_fs_dir/bem/inner_skull.surf" ]; then
+        echo -e "\033[0;35m++ Bem surfaces could not be made for ${fs_subj}. Exiting... ++\033[0m"
+        exit 1
+    fi
 else
     echo -e "\033[1;33m ++ Bem surfaces already exist for ${subj} ++\033[0m"
 fi
@@ -94,17 +108,28 @@ fi
 # this line is necessary to allow running afni GUI from python script
 export DYLD_LIBRARY_PATH=${DYLD_LIBRARY_PATH}:/opt/X11/lib/flat_namespace
 
-# create .trans file
-python $scripts_dir/create_trans_meg.py \
-    --fs_subj "$fs_subj" \
-    --pnum "$subj"
+# create .trans file (in batch mode the inputs were precomputed for the whole
+# cohort by bids_proc.sh, so only reviewed subjects are finalized here; those
+# that need fiducials checked in AFNI wait for create_trans_meg.py --phase review)
+if [ -n "$batch" ]; then
+    $instrument --stage create_trans_meg_finalize -- python $scripts_dir/create_trans_meg.py \
+        --phase finalize \
+        --pnum "$subj"
+else
+    $instrument --stage create_trans_meg -- python $scripts_dir/create_trans_meg.py \
+        --fs_subj "$fs_subj" \
+        --pnum "$subj"
+fi
 
 if [ ! -f "$subj_meg_dir"/sub-"${subj}"_ses-meg_task-resteyesclosed_run-01_meg.fif ]; then
     # convert meg to bids format
-    python $scripts_dir/convert_meg.py \
+    $instrument --stage convert_meg -- $py_run $scripts_dir/convert_meg.py \
         --fs_subj "$fs_subj" \
         --pnum "$subj"  \
-        --files_dir "$files_dir"
+        --files_dir "$files_dir" \
+        $batch_flag
+elif [ -n "$batch" ]; then
+    echo -e "\033[1;33m ++ MEG already converted for ${subj}; skipping in batch mode ++\033[0m"
 else
     echo -e "\033[0;35m++ Do you want to delete and re-convert all MEG .ds to fif? Enter y if yes, n if not. ++\033[0m"
     read -r ynresponse
@@ -112,13 +137,12 @@ else
 
     if [ "$ynresponse" == "y" ]; then
 
-        rm -rf "$subj_session_meg_dir"
-
-        # convert meg to bids format
-        python $scripts_dir/convert_meg.py \
+        # convert meg to bids format (the current ses-meg is replaced only once all runs are converted)
+        $instrument --stage convert_meg -- $py_run $scripts_dir/convert_meg.py \
             --fs_subj "$fs_subj" \
             --pnum "$subj"  \
-            --files_dir "$files_dir"
+            --files_dir "$files_dir" \
+            --reconvert
     else
         exit 1
     fi
@@ -29,6 +29,14 @@ esac
 
 files_dir=${NEU_dir}/Users/price/dev/bids-proc/files
 scripts_dir=${NEU_dir}/Users/price/dev/bids-proc/scripts
+instrument="python $scripts_dir/instrument.py run --subject $subj"
+# heavy Python steps go through the warm worker when one is running (see worker_daemon.py)
+py_run="python $scripts_dir/worker_run.py"
+series_catalog="python $scripts_dir/series_catalog.py"
+# output compression policy (level, pigz, uncompressed intermediates; see compression.py)
+dcm2niix_z=$(python $scripts_dir/compression.py dcm2niix --intermediate)
+nii_ext=$(python $scripts_dir/compression.py ext --intermediate)
+gzip_cmd=$(python $scripts_dir/compression.py gzip)
 bids_root="${NEU_dir}/Data"
 
 #======================================================================================
@@ -43,34 +51,42 @@ fi
 
 subj_session_perf_dir=$bids_root/sub-${subj}/ses-research${ses_suffix}/perf
 
-# check for existence of GE ASL directory structure
-if [[ -d $raw_session_dir/3d_asl3.0mm ]] || [[ -d $raw_session_dir/3d_asl3.5mm ]]; then
+# check for existence of GE ASL series in the raw series catalog
+mapfile -t asl_folders < <($series_catalog find "$raw_session_dir" asl)
+if [[ ${#asl_folders[@]} -gt 0 ]]; then
 
     if [ ! -d $subj_session_perf_dir ]; then
         mkdir -p $subj_session_perf_dir
     fi
 
-    # iterate through different slice thicknesses
-    for asl_folder in 3d_asl3.0mm 3d_asl3.5mm; do
+    # iterate through different slice thicknesses (in order of preference)
+    for asl_folder in "${asl_folders[@]}"; do
         # asl dicom to NIFTI
-        if [[ ! -f "$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.nii.gz ]] && [[ -d $raw_session_dir/$asl_folder ]]; then
-            # run dicom2nii conversion on deltam and m0 dataset
-            dcm2niix_afni -o "$subj_session_perf_dir" -z y -f asl_temp "${raw_session_dir}"/$asl_folder
+        if [[ ! -f "$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.nii.gz ]]; then
+            # work on node-local scratch and only publish the final files
+            scratch_dir=$(python $scripts_dir/staging.py mkdir --prefix asl_ --size_hint_dir "$asl_folder")
+            trap 'rm -rf "$scratch_dir"' EXIT
+
+            # run dicom2nii conversion on deltam and m0 dataset (uncompressed with BIDS_PROC_INTERMEDIATE=none)
+            $instrument -- dcm2niix_afni -o "$scratch_dir" $dcm2niix_z -f asl_temp "$asl_folder"
             
             # reshape 4D NIFTI to avoid bids-validation error
-            python "${scripts_dir}"/reshape_ge_asl.py \
-                --in_file "$subj_session_perf_dir"/asl_temp_reala.nii.gz    \
-                --out_file "$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.nii.gz
-
-            # clean directory
-            mv "$subj_session_perf_dir"/asl_temp_real.nii.gz "$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.nii.gz
-            mv "$subj_session_perf_dir"/asl_temp_real.json "$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.json
-            rm -f "$subj_session_perf_dir"/asl_temp_reala.nii.gz
-            mv "$subj_session_perf_dir"/asl_temp_reala.json "$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.json
-            cp $files_dir/ge_aslcontext.tsv "$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_aslcontext.tsv
+            $instrument --stage reshape_ge_asl -- $py_run "${scripts_dir}"/reshape_ge_asl.py \
+                --in_file "$scratch_dir"/asl_temp_reala${nii_ext}    \
+                --out_file "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.nii.gz
+
+            # rename outputs
+            if [[ $nii_ext == ".nii" ]]; then
+                $gzip_cmd < "$scratch_dir"/asl_temp_real.nii > "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.nii.gz
+            else
+                mv "$scratch_dir"/asl_temp_real.nii.gz "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.nii.gz
+            fi
+            mv "$scratch_dir"/asl_temp_real.json "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.json
+            mv "$scratch_dir"/asl_temp_reala.json "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.json
+            cp $files_dir/ge_aslcontext.tsv "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_aslcontext.tsv
 
             # modify .json files
-            json_file="$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.json
+            json_file="$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.json
             jq '.ArterialSpinLabelingType="PCASL"' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
             jq '.M0Type="Separate"' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
             jq '.BackgroundSuppression=true' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
@@ -78,12 +94,24 @@ if [[ -d $raw_session_dir/3d_asl3.0mm ]] || [[ -d $raw_session_dir/3d_asl3.5mm ]
             jq '.VascularCrushing=false' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
             jq '.PulseSequenceDetails="GE product 3DASL sequence"' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
 
-            slicemm=${asl_folder:6:3}
+            asl_name=${asl_folder##*/}
+            slicemm=${asl_name:6:3}
             jq '.AcquisitionVoxelSize=['$slicemm','$slicemm','$slicemm']' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
 
-            json_file="$subj_session_perf_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.json
+            json_file="$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.json
             jq '.RepetitionTimePreparation=4.7' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
             jq '.AcquisitionVoxelSize=['$slicemm','$slicemm','$slicemm']' "$json_file" > "${json_file}".tmp && mv "${json_file}".tmp "$json_file"
+
+            # publish into bids tree (asl.nii.gz last, since it marks the session as done)
+            python $scripts_dir/staging.py publish --into "$subj_session_perf_dir" \
+                "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.nii.gz \
+                "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_m0scan.json \
+                "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.json \
+                "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_aslcontext.tsv \
+                "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_asl.nii.gz
+
+            # clean directory
+            rm -rf "$scratch_dir"
         fi
     done
 fi
\ No newline at end of file
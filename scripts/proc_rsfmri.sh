@@ -34,6 +34,13 @@ if [ "$cmd_output" == '' ]; then
 fi
 
 scripts_dir=${NEU_dir}/Users/price/dev/bids-proc/scripts
+instrument="python $scripts_dir/instrument.py run --subject $subj"
+# heavy Python steps go through the warm worker when one is running (see worker_daemon.py)
+py_run="python $scripts_dir/worker_run.py"
+series_catalog="python $scripts_dir/series_catalog.py"
+# output compression policy (level, pigz; see compression.py)
+dcm2niix_z=$(python $scripts_dir/compression.py dcm2niix)
+gzip_cmd=$(python $scripts_dir/compression.py gzip)
 files_dir=${NEU_dir}/Users/price/dev/bids-proc/files
 bids_root="${NEU_dir}/Data"
 
@@ -49,8 +56,8 @@ fi
 subj_session_func_dir=$bids_root/sub-${subj}/ses-research${ses_suffix}/func
 subj_session_fmap_dir=$bids_root/sub-${subj}/ses-research${ses_suffix}/fmap
 
-# check for existence of GE fMRI directory structure
-if [[ -d $raw_session_dir/epi_3_mm_forward_blip ]] && [[ -d $raw_session_dir/epi_3_mm_reverse_blip ]]; then
+# check for existence of GE fMRI series in the raw series catalog
+if $series_catalog has "$raw_session_dir" fmap_ge_forward fmap_ge_reverse; then
 
     if [ ! -d $subj_session_func_dir ]; then
         mkdir -p $subj_session_func_dir
@@ -64,56 +71,52 @@ if [[ -d $raw_session_dir/epi_3_mm_forward_blip ]] && [[ -d $raw_session_dir/epi
     # eyes open
     if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-1_echo-1_bold.nii.gz ]; then
         cd "$raw_session_dir" || exit
-        eyes_open_runs=( epi_3_mm_rest_run_? )
+        mapfile -t eyes_open_runs < <($series_catalog find "$raw_session_dir" rest_ge_open --names)
         run_num=0
         for run_name in "${eyes_open_runs[@]}"; do
-            if [ -d "$run_name" ]; then
-                ((run_num+=1))
-
-                # run Vinai's sortme script and dicom2nii conversion
-                raw_func_folder=$raw_session_dir/$run_name
-                if [ -d "$raw_func_folder"/echo_0001 ]; then
-                    python $scripts_dir/sortme.py "$raw_func_folder" 'dcm' 'true'
-                else
-                    python $scripts_dir/sortme.py "$raw_func_folder"
-                fi
+            ((run_num+=1))
 
-                for echo_num in 1 2 3; do
-                    if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.nii.gz ]; then
-                        new_files=true
-                        mv $raw_func_folder/echo_000${echo_num}.json "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.json
-                        mv $raw_func_folder/echo_000${echo_num}.nii.gz "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.nii.gz
-                    fi
-                done
+            # run Vinai's sortme script and dicom2nii conversion
+            raw_func_folder=$raw_session_dir/$run_name
+            if [ -d "$raw_func_folder"/echo_0001 ]; then
+                $instrument --stage sortme -- $py_run $scripts_dir/sortme.py "$raw_func_folder" 'dcm' 'true'
+            else
+                $instrument --stage sortme -- $py_run $scripts_dir/sortme.py "$raw_func_folder"
             fi
+
+            for echo_num in 1 2 3; do
+                if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.nii.gz ]; then
+                    new_files=true
+                    mv $raw_func_folder/echo_000${echo_num}.json "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.json
+                    mv $raw_func_folder/echo_000${echo_num}.nii.gz "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.nii.gz
+                fi
+            done
         done
     fi
 
     # eyes closed
     if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-1_echo-1_bold.nii.gz ]; then
         cd "$raw_session_dir" || exit
-        eyes_closed_runs=( epi_3_mm_rest_run_?_eyes_closed )
+        mapfile -t eyes_closed_runs < <($series_catalog find "$raw_session_dir" rest_ge_closed --names)
         run_num=0
         for run_name in "${eyes_closed_runs[@]}"; do
-            if [ -d "$run_name" ]; then
-                ((run_num+=1))
-
-                # run Vinai's sortme script and dicom2nii conversion
-                raw_func_folder=$raw_session_dir/$run_name
-                if [ -d "$raw_func_folder"/echo_0001 ]; then
-                    python $scripts_dir/sortme.py "$raw_func_folder" 'dcm' 'true'
-                else
-                    python $scripts_dir/sortme.py "$raw_func_folder"
-                fi
+            ((run_num+=1))
 
-                for echo_num in 1 2 3; do
-                    if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.nii.gz ]; then
-                        new_files=true
-                        mv $raw_func_folder/echo_000${echo_num}.json "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.json
-                        mv $raw_func_folder/echo_000${echo_num}.nii.gz "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.nii.gz
-                    fi
-                done
+            # run Vinai's sortme script and dicom2nii conversion
+            raw_func_folder=$raw_session_dir/$run_name
+            if [ -d "$raw_func_folder"/echo_0001 ]; then
+                $instrument --stage sortme -- $py_run $scripts_dir/sortme.py "$raw_func_folder" 'dcm' 'true'
+            else
+                $instrument --stage sortme -- $py_run $scripts_dir/sortme.py "$raw_func_folder"
             fi
+
+            for echo_num in 1 2 3; do
+                if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.nii.gz ]; then
+                    new_files=true
+                    mv $raw_func_folder/echo_000${echo_num}.json "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.json
+                    mv $raw_func_folder/echo_000${echo_num}.nii.gz "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.nii.gz
+                fi
+            done
         done
     fi
 
@@ -133,20 +136,16 @@ if [[ -d $raw_session_dir/epi_3_mm_forward_blip ]] && [[ -d $raw_session_dir/epi
         # fmap dicom to NIFTI
         for direction in "reverse" "forward"; do
             if [ ! -f "$subj_session_fmap_dir"/sub-"${subj}"_ses-research${ses_suffix}_dir-${direction}_epi.nii.gz ]; then
-                # run Vinai's sortme script and dicom2nii conversion
-                raw_fmap_folder=$raw_session_dir/epi_3_mm_${direction}_blip
+                # run Vinai's sortme script and dicom2nii conversion (only the first echo is used)
+                raw_fmap_folder=$($series_catalog find "$raw_session_dir" fmap_ge_${direction} --first)
                 if [ -d "$raw_fmap_folder"/echo_0001 ]; then
-                    python $scripts_dir/sortme.py "$raw_fmap_folder" 'dcm' 'true'
+                    $instrument --stage sortme -- $py_run $scripts_dir/sortme.py --echoes 1 "$raw_fmap_folder" 'dcm' 'true'
                 else
-                    python $scripts_dir/sortme.py "$raw_fmap_folder"
+                    $instrument --stage sortme -- $py_run $scripts_dir/sortme.py --echoes 1 "$raw_fmap_folder"
                 fi
 
                 mv $raw_fmap_folder/echo_0001.json "$subj_session_fmap_dir"/sub-"${subj}"_ses-research${ses_suffix}_dir-${direction}_epi.json
                 mv $raw_fmap_folder/echo_0001.nii.gz "$subj_session_fmap_dir"/sub-"${subj}"_ses-research${ses_suffix}_dir-${direction}_epi.nii.gz
-
-                # clean directory
-                rm $raw_fmap_folder/echo_0002.json; rm $raw_fmap_folder/echo_0002.nii.gz
-                rm $raw_fmap_folder/echo_0003.json; rm $raw_fmap_folder/echo_0003.nii.gz
             fi
         done
 
@@ -187,7 +186,7 @@ if [[ -d $raw_session_dir/epi_3_mm_forward_blip ]] && [[ -d $raw_session_dir/epi
                 if [ "$n_timepoints" == 19375 ]; then
                     ((open_run_num+=1))
                     if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-${open_run_num}_physio.tsv.gz ]; then
-                        paste "$ecg_file" "$resp_file" | gzip > "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-${open_run_num}_physio.tsv.gz
+                        paste "$ecg_file" "$resp_file" | $gzip_cmd > "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-${open_run_num}_physio.tsv.gz
                         cp $files_dir/ge_physio.json "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-${open_run_num}_physio.json
                     fi
                 fi
@@ -196,7 +195,7 @@ if [[ -d $raw_session_dir/epi_3_mm_forward_blip ]] && [[ -d $raw_session_dir/epi
                 if [ "$n_timepoints" == 38750 ]; then
                     ((closed_run_num+=1))
                     if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-${open_run_num}_physio.tsv.gz ]; then
-                        paste "$ecg_file" "$resp_file" | gzip > "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-${open_run_num}_physio.tsv.gz
+                        paste "$ecg_file" "$resp_file" | $gzip_cmd > "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-${open_run_num}_physio.tsv.gz
                         cp $files_dir/ge_physio.json "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-${open_run_num}_physio.json
                     fi
                 fi
@@ -208,8 +207,8 @@ if [[ -d $raw_session_dir/epi_3_mm_forward_blip ]] && [[ -d $raw_session_dir/epi
         fi
     fi
 
-# check for existence of SIEMENS fMRI directory structure
-elif [[ -d $raw_session_dir/epi_forward ]] && [[ -d $raw_session_dir/epi_reverse ]]; then
+# check for existence of SIEMENS fMRI series in the raw series catalog
+elif $series_catalog has "$raw_session_dir" fmap_siemens_forward fmap_siemens_reverse; then
 
     if [ ! -d $subj_session_func_dir ]; then
         mkdir -p $subj_session_func_dir
@@ -218,57 +217,65 @@ elif [[ -d $raw_session_dir/epi_forward ]] && [[ -d $raw_session_dir/epi_reverse
         mkdir -p $subj_session_fmap_dir
     fi
 
-    # func dicom to NIFTI
+    # func dicom to NIFTI (converted on node-local scratch, then published)
     cd "$raw_session_dir" || exit
+    scratch_dir=$(python $scripts_dir/staging.py mkdir --prefix rsfmri_)
+    trap 'rm -rf "$scratch_dir"' EXIT
 
     new_files=false
 
     # eyes open
-    eyes_open_runs=( rest_run? )
+    # the catalog only lists runs that have all three echoes (-e02 and -e03 folders)
+    mapfile -t eyes_open_runs < <($series_catalog find "$raw_session_dir" rest_siemens_open --names)
     run_num=0
     for run_name in "${eyes_open_runs[@]}"; do
-        if [[ -d "$run_name" ]] && [[ -d "${run_name}-e02" ]] && [[ -d "${run_name}-e03" ]]; then
-            ((run_num+=1))
-            if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-1_bold.nii.gz ]; then
+        ((run_num+=1))
+        if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-1_bold.nii.gz ]; then
+            # run dicom2nii conversion
+            $instrument -- dcm2niix_afni -o "$scratch_dir" $dcm2niix_z -f sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-1_bold "$run_name"
+        fi
+
+        for echo_num in 2 3; do
+            if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.nii.gz ]; then
                 # run dicom2nii conversion
-                dcm2niix_afni -o "$subj_session_func_dir" -z y -f sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-1_bold "$run_name"
+                $instrument -- dcm2niix_afni -o "$scratch_dir" $dcm2niix_z -f sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold "$run_name"-e0${echo_num}
+                new_files=true
+                mv "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold_e${echo_num}.nii.gz "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.nii.gz
+                mv "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold_e${echo_num}.json "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.json
             fi
-
-            for echo_num in 2 3; do
-                if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.nii.gz ]; then
-                    # run dicom2nii conversion
-                    dcm2niix_afni -o "$subj_session_func_dir" -z y -f sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold "$run_name"-e0${echo_num}
-                    new_files=true
-                    mv "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold_e${echo_num}.nii.gz "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.nii.gz
-                    mv "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold_e${echo_num}.json "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesopen_run-"${run_num}"_echo-${echo_num}_bold.json
-                fi
-            done
-        fi
+        done
     done
 
     # eyes closed
-    eyes_closed_runs=( rest_run?_eyes_closed )
+    # the catalog only lists runs that have all three echoes (-e02 and -e03 folders)
+    mapfile -t eyes_closed_runs < <($series_catalog find "$raw_session_dir" rest_siemens_closed --names)
     run_num=0
     for run_name in "${eyes_closed_runs[@]}"; do
-        if [[ -d "$run_name" ]] && [[ -d "${run_name}-e02" ]] && [[ -d "${run_name}-e03" ]]; then
-            ((run_num+=1))
-            if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-1_bold.nii.gz ]; then
+        ((run_num+=1))
+        if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-1_bold.nii.gz ]; then
+            # run dicom2nii conversion
+            $instrument -- dcm2niix_afni -o "$scratch_dir" $dcm2niix_z -f sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-1_bold "$run_name"
+        fi
+
+        for echo_num in 2 3; do
+            if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.nii.gz ]; then
                 # run dicom2nii conversion
-                dcm2niix_afni -o "$subj_session_func_dir" -z y -f sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-1_bold "$run_name"
+                $instrument -- dcm2niix_afni -o "$scratch_dir" $dcm2niix_z -f sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold "$run_name"-e0${echo_num}
+                new_files=true
+                mv "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold_e${echo_num}.nii.gz "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.nii.gz
+                mv "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold_e${echo_num}.json "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.json
             fi
-
-            for echo_num in 2 3; do
-                if [ ! -f "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.nii.gz ]; then
-                    # run dicom2nii conversion
-                    dcm2niix_afni -o "$subj_session_func_dir" -z y -f sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold "$run_name"-e0${echo_num}
-                    new_files=true
-                    mv "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold_e${echo_num}.nii.gz "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.nii.gz
-                    mv "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold_e${echo_num}.json "$subj_session_func_dir"/sub-"${subj}"_ses-research${ses_suffix}_task-resteyesclosed_run-"${run_num}"_echo-${echo_num}_bold.json
-                fi
-            done
-        fi
+        done
     done
 
+    # publish converted runs into bids tree
+    shopt -s nullglob
+    converted_files=( "$scratch_dir"/*.json "$scratch_dir"/*.nii.gz )
+    shopt -u nullglob
+    if [[ ${#converted_files[@]} -gt 0 ]]; then
+        python $scripts_dir/staging.py publish --into "$subj_session_func_dir" "${converted_files[@]}"
+    fi
+
     # only update .json files and create fmap files if new resting state files are created
     if [[ $new_files == 'true' ]]; then
         # update .json file taskname attributes
@@ -286,7 +293,11 @@ elif [[ -d $raw_session_dir/epi_forward ]] && [[ -d $raw_session_dir/epi_reverse
         for direction in "forward" "reverse"; do
             if [ ! -f "$subj_session_fmap_dir"/sub-"${subj}"_ses-research${ses_suffix}_dir-${direction}_epi.nii.gz ]; then
                 # run dicom2nii conversion on epi_forward and epi_reverse datasets
-                dcm2niix_afni -o "$subj_session_fmap_dir" -z y -f sub-"${subj}"_ses-research${ses_suffix}_dir-${direction}_epi "$raw_session_dir"/epi_${direction}
+                raw_fmap_folder=$($series_catalog find "$raw_session_dir" fmap_siemens_${direction} --first)
+                $instrument -- dcm2niix_afni -o "$scratch_dir" $dcm2niix_z -f sub-"${subj}"_ses-research${ses_suffix}_dir-${direction}_epi "$raw_fmap_folder"
+                python $scripts_dir/staging.py publish --into "$subj_session_fmap_dir" \
+                    "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_dir-${direction}_epi.json \
+                    "$scratch_dir"/sub-"${subj}"_ses-research${ses_suffix}_dir-${direction}_epi.nii.gz
             fi
         done
 
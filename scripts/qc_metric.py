@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Quantitative pre-screen for registration QC. Each registered T2w/FLAIR/fatsat
+image is compared with the session's axialized T1 over brain voxels
+(normalized mutual information and local Pearson correlation). Sessions
+whose metrics are in line with the rest of the cohort are marked as passed
+in the QC status store; only outliers are left for review in bids_qc.sh.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import csv
+import os
+
+import nibabel as nib
+import numpy as np
+
+from colors import Colors
+from neu_paths import registration_qc_dir
+from qc_sheets import qc_sessions
+from qc_status import set_statuses
+
+metrics_file = registration_qc_dir / 'registration_metrics.tsv'
+METRIC_COLUMNS = ['participant_id', 'session', 'contrast', 'nmi', 'local_r', 'n_voxels', 'flagged']
+
+HIST_BINS = 32
+# edge length (voxels) of the blocks used for the local correlation
+BLOCK = 8
+# a metric this many robust SDs below the cohort median is an outlier
+MAX_ROBUST_Z = 3.5
+# below this many reference values per contrast nothing is auto-passed
+MIN_REFERENCE = 10
+
+
+def load_data(path):
+    """Image data as an array (the first volume of 4D images)."""
+
+    img = nib.load(str(path))
+    data = np.asanyarray(img.dataobj)
+    if data.ndim > 3:
+        data = data[..., 0]
+
+    return data
+
+
+def brain_mask(t1, moving):
+    """Voxels inside the head on the T1 that also have signal in the moving image."""
+
+    t1_thresh = 0.2 * np.percentile(t1[t1 > 0], 98) if (t1 > 0).any() else 0
+    return (t1 > t1_thresh) & (moving > 0)
+
+
+def normalized_mutual_information(a, b, bins=HIST_BINS):
+    """(H(A) + H(B)) / H(A,B); 1 for independent images, 2 for identical ones."""
+
+    joint, _, _ = np.histogram2d(a, b, bins=bins)
+    joint /= joint.sum()
+    pa, pb = joint.sum(axis=1), joint.sum(axis=0)
+
+    def entropy(p):
+        p = p[p > 0]
+        return -np.sum(p * np.log(p))
+
+    return (entropy(pa) + entropy(pb)) / entropy(joint.ravel())
+
+
+def local_pearson(a, b, mask, block=BLOCK):
+    """Mean absolute Pearson correlation over blocks that are mostly brain.
+
+    The absolute value is used since T1 and T2/FLAIR contrasts are inverted.
+    """
+
+    shape = [s - s % block for s in mask.shape]
+    a, b, mask = (x[:shape[0], :shape[1], :shape[2]] for x in (a, b, mask))
+
+    def blocks(x):
+        x = x.reshape(shape[0] // block, block, shape[1] // block, block, shape[2] // block, block)
+        return x.transpose(0, 2, 4, 1, 3, 5).reshape(-1, block**3)
+
+    a, b, mask = blocks(a.astype(np.float64)), blocks(b.astype(np.float64)), blocks(mask)
+    keep = mask.mean(axis=1) > 0.9
+    a, b = a[keep], b[keep]
+    if not len(a):
+        return np.nan
+
+    a = a - a.mean(axis=1, keepdims=True)
+    b = b - b.mean(axis=1, keepdims=True)
+    denom = np.sqrt((a**2).sum(axis=1) * (b**2).sum(axis=1))
+    valid = denom > 0
+
+    return float(np.mean(np.abs((a * b).sum(axis=1)[valid] / denom[valid])))
+
+
+def contrast_name(path):
+    """Contrast label of a registered image, e.g. T2w, FLAIR or acq-fatsat_T2w."""
+
+    entities = path.name.replace('.nii.gz', '').split('_')
+    acq = [e for e in entities if e.startswith('acq-')]
+
+    return '_'.join(acq + [entities[-1]])
+
+
+def session_metrics(pnum, session, anat_dir):
+    """Metric rows for every registered contrast of one session."""
+
+    t1_files = [f for f in anat_dir.glob('*_rec-axialized_T1w.nii.gz') if '_acq-' not in f.name]
+    if not t1_files:
+        # the session must not pass: nothing could be checked against a T1
+        return [{'participant_id': f'sub-{pnum}', 'session': session, 'contrast': 'T1w',
+                 'nmi': np.nan, 'local_r': np.nan, 'n_voxels': 0}]
+    t1 = load_data(t1_files[0])
+
+    rows = []
+    for moving_path in sorted(anat_dir.glob('*_rec-axialized_*.nii.gz')):
+        if moving_path == t1_files[0]:
+            continue
+        row = {'participant_id': f'sub-{pnum}', 'session': session,
+               'contrast': contrast_name(moving_path), 'nmi': np.nan, 'local_r': np.nan, 'n_voxels': 0}
+        moving = load_data(moving_path)
+        if moving.shape == t1.shape:
+            mask = brain_mask(t1, moving)
+            row['n_voxels'] = int(mask.sum())
+            if row['n_voxels']:
+                row['nmi'] = normalized_mutual_information(t1[mask], moving[mask])
+                row['local_r'] = local_pearson(t1, moving, mask)
+        rows.append(row)
+
+    return rows
+
+
+def read_metrics():
+    """All metric rows recorded so far, keyed by (participant, session, contrast)."""
+
+    metrics = {}
+    if metrics_file.is_file():
+        with open(metrics_file, 'r', newline='') as f:
+            for row in csv.DictReader(f, delimiter='\t'):
+                for key in ('nmi', 'local_r'):
+                    row[key] = float(row[key]) if row[key] not in ('', 'nan') else np.nan
+                metrics[(row['participant_id'], row['session'], row['contrast'])] = row
+
+    return metrics
+
+
+def write_metrics(metrics):
+    """Write the metric table atomically."""
+
+    metrics_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = metrics_file.with_name(f'.{metrics_file.name}.tmp')
+    with open(tmp_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=METRIC_COLUMNS, delimiter='\t', extrasaction='ignore')
+        writer.writeheader()
+        for key in sorted(metrics):
+            row = dict(metrics[key])
+            for col in ('nmi', 'local_r'):
+                row[col] = '' if np.isnan(row[col]) else f'{row[col]:.4f}'
+            writer.writerow(row)
+    os.replace(tmp_file, metrics_file)
+
+
+def session_group(session):
+    """Sessions are compared with others of the same kind (clinical, altclinical, research)."""
+
+    return session[len('ses-'):].replace('postop', '')
+
+
+def flag_outliers(metrics):
+    """Set row['flagged'] to a reason (or '') using median/MAD per session kind and contrast."""
+
+    groups = {}
+    for key, row in metrics.items():
+        groups.setdefault((session_group(row['session']), row['contrast']), []).append(row)
+
+    for (group, contrast), rows in groups.items():
+        for row in rows:
+            row['flagged'] = ''
+            if contrast == 'T1w':
+                row['flagged'] = 'no axialized T1'
+            elif np.isnan(row['nmi']) or np.isnan(row['local_r']):
+                row['flagged'] = 'metric not computable'
+        if contrast == 'T1w':
+            continue
+        if len(rows) < MIN_REFERENCE:
+            for row in rows:
+                row['flagged'] = row['flagged'] or f'fewer than {MIN_REFERENCE} {group} {contrast} to compare'
+            continue
+
+        for metric in ('nmi', 'local_r'):
+            values = np.array([row[metric] for row in rows])
+            median = np.nanmedian(values)
+            mad = 1.4826 * np.nanmedian(np.abs(values - median))
+            if not mad:
+                continue
+            for row in rows:
+                z = (row[metric] - median) / mad
+                # only poor similarity is suspicious
+                if z < -MAX_ROBUST_Z and not row['flagged']:
+                    row['flagged'] = f'{metric} {row[metric]:.3f} (cohort median {median:.3f})'
+
+    return metrics
+
+
+def prescreen(pnums, n_jobs=4, autopass=True):
+    """Compute metrics for pnums, flag outliers and auto-pass clear sessions.
+
+    Sessions without registered images are reported as having nothing to
+    check and get no status. Returns {(participant_id, session): [reasons]}
+    for sessions left for review.
+    """
+
+    jobs = [(pnum, session, anat_dir) for pnum in pnums for session, anat_dir in qc_sessions(pnum)]
+    if not jobs:
+        return {}
+
+    metrics = read_metrics()
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        for (pnum, session, _), rows in zip(jobs, pool.map(session_metrics, *zip(*jobs))):
+            # drop stale rows of the session before adding the new ones
+            for key in [k for k in metrics if k[:2] == (f'sub-{pnum}', session)]:
+                del metrics[key]
+            for row in rows:
+                metrics[(row['participant_id'], row['session'], row['contrast'])] = row
+
+    flag_outliers(metrics)
+    write_metrics(metrics)
+
+    flagged = {}
+    passed = []
+    unchecked = []
+    for pnum, session, _ in jobs:
+        rows = [row for key, row in metrics.items() if key[:2] == (f'sub-{pnum}', session)]
+        reasons = [f"{row['contrast']}: {row['flagged']}" for row in rows if row['flagged']]
+        if not rows:
+            # only a T1: there is no registration to pass or review
+            unchecked.append((f'sub-{pnum}', session))
+        elif reasons:
+            flagged[(f'sub-{pnum}', session)] = reasons
+        else:
+            passed.append((pnum, session, 'success'))
+
+    if autopass:
+        # never override a reviewer's decision
+        for subj, session, _ in set_statuses(passed, source='qc_metric', overwrite=False):
+            print(Colors.GREEN, f"++ {subj}/{session} passed the pre-screen ++", Colors.END)
+
+    for subj, session in unchecked:
+        print(Colors.LIGHT_GRAY, f"++ {subj}/{session} has no registered images: nothing to check ++", Colors.END)
+
+    for (subj, session), reasons in sorted(flagged.items()):
+        print(Colors.YELLOW, f"++ {subj}/{session} needs review: {'; '.join(reasons)} ++", Colors.END)
+
+    return flagged
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "pre-screen registrations and flag sessions that need a human look"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("pnums", nargs="+", help="subject p-numbers")
+    parser.add_argument("--n_jobs", type=int, default=4, help="parallel processes")
+    parser.add_argument("--no_autopass", action="store_true",
+                        help="only report outliers; do not record passes")
+    parser.add_argument("--render", action="store_true",
+                        help="render QC montages for flagged subjects (see qc_sheets.py)")
+
+    args = parser.parse_args()
+
+    flagged = prescreen(args.pnums, n_jobs=args.n_jobs, autopass=not args.no_autopass)
+
+    if args.render and flagged:
+        from qc_sheets import render, write_index
+        render(sorted({subj[len('sub-'):] for subj, _ in flagged}), n_jobs=args.n_jobs)
+        print(Colors.GREEN, f"++ Review at {write_index()} ++", Colors.END)
@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Headless registration QC. Renders montages of each session's T1 with the
+edges of the registered T2/FLAIR/fatsat images on top, collects them in one
+static HTML page where a reviewer marks every session pass/fail, and turns
+the exported decisions into the QC status store (qc_status.py).
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import html
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import nibabel as nib
+import numpy as np
+
+from colors import Colors
+from neu_paths import bids_root, registration_qc_dir
+from qc_status import load_status, set_statuses
+
+index_file = registration_qc_dir / 'index.html'
+
+# slice positions (fraction of the field of view) shown in every view
+SLICE_FRACTIONS = (0.3, 0.4, 0.5, 0.6, 0.7)
+# voxels with a gradient above this percentile (within the head) are edges
+EDGE_PERCENTILE = 90
+
+
+def qc_sessions(pnum):
+    """(session, anat dir) of every anat session to QC, in bids_qc.sh order."""
+
+    ses_suffixes = [''] if pnum.startswith('hv') else ['', 'postop']
+    sessions = []
+    for ses_suffix in ses_suffixes:
+        for session in (f'clinical{ses_suffix}', f'altclinical{ses_suffix}', f'research{ses_suffix}'):
+            anat_dir = bids_root / f'sub-{pnum}' / f'ses-{session}' / 'anat'
+            if anat_dir.is_dir():
+                sessions.append((f'ses-{session}', anat_dir))
+
+    return sessions
+
+
+def load_canonical(path):
+    """Image data in RAS+ orientation as float32."""
+
+    img = nib.as_closest_canonical(nib.load(str(path)))
+    return np.asanyarray(img.dataobj, dtype=np.float32)
+
+
+def edge_mask(data):
+    """Boolean mask of strong intensity edges."""
+
+    grad = np.sqrt(sum(g**2 for g in np.gradient(data)))
+    head = data > np.percentile(data, 50)
+    if not head.any():
+        return np.zeros(data.shape, dtype=bool)
+
+    return grad > np.percentile(grad[head], EDGE_PERCENTILE)
+
+
+def slice_views(data):
+    """2D slices (sagittal, coronal, axial rows) at SLICE_FRACTIONS."""
+
+    views = []
+    for axis in range(3):
+        row = []
+        for fraction in SLICE_FRACTIONS:
+            index = int(round(fraction * (data.shape[axis] - 1)))
+            row.append(np.rot90(np.take(data, index, axis=axis)))
+        views.append(row)
+
+    return views
+
+
+def render_contrast(t1_path, moving_path, png_path):
+    """Save a montage of the T1 with the edges of moving_path overlaid.
+
+    With moving_path None the T1 is shown on its own.
+    """
+
+    t1 = load_canonical(t1_path)
+    vmax = np.percentile(t1, 99.5) or 1
+    title = t1_path.name
+    edges = None
+
+    if moving_path is not None:
+        moving = load_canonical(moving_path)
+        title = f'{moving_path.name} edges on T1'
+        if moving.shape[:3] == t1.shape[:3]:
+            edges = slice_views(edge_mask(moving[..., 0] if moving.ndim > 3 else moving))
+        else:
+            title += ' (grid differs from T1, edges not shown)'
+
+    t1_views = slice_views(t1[..., 0] if t1.ndim > 3 else t1)
+    fig, axes = plt.subplots(3, len(SLICE_FRACTIONS), figsize=(2.4 * len(SLICE_FRACTIONS), 7.5),
+                             facecolor='black')
+    for row in range(3):
+        for col in range(len(SLICE_FRACTIONS)):
+            ax = axes[row, col]
+            ax.imshow(t1_views[row][col], cmap='gray', vmin=0, vmax=vmax, interpolation='nearest')
+            if edges is not None:
+                ax.imshow(np.ma.masked_where(~edges[row][col], edges[row][col]),
+                          cmap='autumn', alpha=0.9, interpolation='nearest')
+            ax.axis('off')
+    fig.suptitle(title, color='white', fontsize=10)
+    fig.tight_layout()
+
+    png_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = png_path.with_name(f'.{png_path.name}.tmp')
+    fig.savefig(tmp_path, format='png', dpi=80, facecolor='black')
+    plt.close(fig)
+    os.replace(tmp_path, png_path)
+
+    return png_path
+
+
+def session_jobs(pnum, session, anat_dir, force=False):
+    """(t1, moving, png) render jobs for one session; up-to-date montages are skipped."""
+
+    t1_files = [f for f in anat_dir.glob('*_rec-axialized_T1w.nii.gz') if '_acq-' not in f.name]
+    if not t1_files:
+        return []
+    t1_path = t1_files[0]
+
+    moving_files = sorted(f for f in anat_dir.glob('*_rec-axialized_*.nii.gz') if f != t1_path)
+    out_dir = registration_qc_dir / f'sub-{pnum}' / 'montages'
+
+    jobs = []
+    for moving_path in (moving_files or [None]):
+        stem = (moving_path or t1_path).name.replace('.nii.gz', '')
+        png_path = out_dir / f'{stem}_qc.png'
+        inputs = [t1_path] + ([moving_path] if moving_path else [])
+        if not force and png_path.is_file() and \
+                png_path.stat().st_mtime > max(f.stat().st_mtime for f in inputs):
+            continue
+        jobs.append((t1_path, moving_path, png_path))
+
+    return jobs
+
+
+def render(pnums, n_jobs=4, force=False):
+    """Render montages for every session of pnums in a process pool."""
+
+    jobs = []
+    for pnum in pnums:
+        for session, anat_dir in qc_sessions(pnum):
+            jobs += session_jobs(pnum, session, anat_dir, force=force)
+
+    print(Colors.YELLOW, f"++ Rendering {len(jobs)} QC montage(s) ++", Colors.END)
+    n_failed = 0
+    with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+        futures = [(job, pool.submit(render_contrast, *job)) for job in jobs]
+        for job, future in futures:
+            try:
+                future.result()
+            except Exception as e:
+                print(Colors.RED, f"++ Could not render {job[2].name}: {e} ++", Colors.END)
+                n_failed += 1
+
+    return n_failed
+
+
+def write_index():
+    """Write the static review page for every subject with montages."""
+
+    cohort_status = load_status()
+    sections = []
+    for subj_dir in sorted(registration_qc_dir.glob('sub-*')):
+        pnum = subj_dir.name[len('sub-'):]
+        for session, _ in qc_sessions(pnum):
+            pngs = sorted((subj_dir / 'montages').glob(f'{subj_dir.name}_{session}_*_qc.png'))
+            if not pngs:
+                continue
+            key = f'{subj_dir.name}/{session}'
+            status = cohort_status.get((subj_dir.name, session), {}).get('status', '')
+            images = '\n'.join(
+                f'<img src="{html.escape(str(png.relative_to(registration_qc_dir)))}" loading="lazy">'
+                for png in pngs
+            )
+            radios = ' '.join(
+                f'<label><input type="radio" name="{key}" value="{value}"'
+                f'{" checked" if status == value else ""}> {label}</label>'
+                for value, label in (('success', 'pass'), ('failure', 'fail'))
+            )
+            sections.append(
+                f'<section data-key="{key}" class="{status}">\n<h2>{key} {radios}</h2>\n{images}\n</section>'
+            )
+
+    page = f"""<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Registration QC</title>
+<style>
+body {{ background: #111; color: #ddd; font-family: sans-serif; }}
+section {{ border-left: 6px solid #555; margin: 1em 0; padding-left: 1em; }}
+section.success {{ border-color: #2a2; }}
+section.failure {{ border-color: #c22; }}
+img {{ max-width: 48%; margin: 2px; }}
+#bar {{ position: sticky; top: 0; background: #111; padding: .5em 0; }}
+</style>
+</head>
+<body>
+<div id="bar">
+<button onclick="exportDecisions()">Export decisions</button>
+<span id="count"></span>
+</div>
+{chr(10).join(sections)}
+<script>
+function exportDecisions() {{
+  const lines = [];
+  document.querySelectorAll('input[type=radio]:checked').forEach(r => lines.push(r.name + '=' + r.value));
+  const blob = new Blob([lines.join('\\n') + '\\n'], {{type: 'text/plain'}});
+  const a = document.createElement('a');
+  a.href = URL.createObjectURL(blob);
+  a.download = 'qc_decisions.txt';
+  a.click();
+}}
+function update() {{
+  const total = document.querySelectorAll('section').length;
+  const done = document.querySelectorAll('input[type=radio]:checked').length;
+  document.getElementById('count').textContent = done + ' / ' + total + ' sessions marked';
+}}
+document.querySelectorAll('input[type=radio]').forEach(r => r.addEventListener('change', e => {{
+  e.target.closest('section').className = e.target.value;
+  update();
+}}));
+update();
+</script>
+</body>
+</html>
+"""
+
+    registration_qc_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = index_file.with_name(f'.{index_file.name}.tmp')
+    with open(tmp_file, 'w') as f:
+        f.write(page)
+    os.replace(tmp_file, index_file)
+
+    return index_file
+
+
+def ingest(decisions_file):
+    """Record exported 'sub-X/ses-Y=status' lines in the QC status store."""
+
+    decisions = []
+    with open(decisions_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            key, status = line.split('=', 1)
+            subj, session = key.split('/', 1)
+            if status not in ('success', 'failure'):
+                sys.exit(f"++ Bad status '{status}' for {key} in {decisions_file} ++")
+            decisions.append((subj, session, status))
+
+    set_statuses(decisions, source='qc_sheets')
+    print(Colors.GREEN, f"++ Recorded {len(decisions)} QC decision(s) ++", Colors.END)
+
+    return decisions
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "render registration QC montages and record pass/fail decisions"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render_parser = subparsers.add_parser("render", help="render montages and rebuild the index page")
+    render_parser.add_argument("pnums", nargs="+", help="subject p-numbers")
+    render_parser.add_argument("--n_jobs", type=int, default=4, help="parallel render processes")
+    render_parser.add_argument("--force", action="store_true", help="re-render up-to-date montages")
+
+    ingest_parser = subparsers.add_parser("ingest", help="record exported decisions in the QC status store")
+    ingest_parser.add_argument("decisions_file", help="qc_decisions.txt exported from the index page")
+
+    args = parser.parse_args()
+
+    if args.command == "render":
+        n_failed = render(args.pnums, n_jobs=args.n_jobs, force=args.force)
+        print(Colors.GREEN, f"++ Review at {write_index()} ++", Colors.END)
+        if n_failed:
+            sys.exit(1)
+    elif args.command == "ingest":
+        ingest(args.decisions_file)
+        write_index()
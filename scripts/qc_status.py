@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Cohort-wide registration QC status: one row per subject/session in
+derivatives/registration_qc/qc_status.tsv, updated atomically under a file
+lock. bids_qc.sh, the headless QC tools and the FreeSurfer launchers read and
+write QC decisions through this module (or its CLI). Each subject's
+qc_output.txt is rewritten from the store so older readers keep working.
+"""
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import csv
+from datetime import datetime
+import fcntl
+import os
+from pathlib import Path
+import sys
+
+from neu_paths import fs_dir, registration_qc_dir
+
+status_file = registration_qc_dir / 'qc_status.tsv'
+STATUS_COLUMNS = ['participant_id', 'session', 'status', 'source', 'updated']
+STATUSES = ('success', 'failure')
+
+
+def subject_id(subj):
+    """'sub-<pnum>' for either a p-number or a participant id."""
+
+    return subj if subj.startswith('sub-') else f'sub-{subj}'
+
+
+def session_id(session):
+    """'ses-<session>' for either a session label or a session id."""
+
+    return session if session.startswith('ses-') else f'ses-{session}'
+
+
+def read_qc_output(qc_output_file):
+    """session -> success/failure from a qc_output.txt file (last line wins)."""
+
+    statuses = {}
+    if Path(qc_output_file).is_file():
+        with open(qc_output_file, 'r') as f:
+            for line in f:
+                line = line.strip().replace('\r', '')
+                if '=' in line:
+                    session, status = line.split('=', 1)
+                    statuses[session] = status
+
+    return statuses
+
+
+def write_qc_output(qc_output_file, statuses):
+    """Write session=status lines atomically."""
+
+    qc_output_file = Path(qc_output_file)
+    qc_output_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = qc_output_file.with_name(f'.{qc_output_file.name}.tmp')
+    with open(tmp_file, 'w') as f:
+        for session, status in statuses.items():
+            f.write(f'{session}={status}\n')
+    os.replace(tmp_file, qc_output_file)
+
+
+def import_qc_outputs():
+    """Rows built from every subject's qc_output.txt (used to seed the store)."""
+
+    rows = {}
+    for qc_output_file in sorted(registration_qc_dir.glob('sub-*/qc_output.txt')):
+        subj = qc_output_file.parent.name
+        updated = datetime.fromtimestamp(qc_output_file.stat().st_mtime).isoformat(timespec='seconds')
+        for session, status in read_qc_output(qc_output_file).items():
+            rows[(subj, session)] = {'participant_id': subj, 'session': session, 'status': status,
+                                     'source': 'qc_output.txt', 'updated': updated}
+
+    return rows
+
+
+def read_status_file():
+
+    rows = {}
+    with open(status_file, 'r', newline='') as f:
+        for row in csv.DictReader(f, delimiter='\t'):
+            rows[(row['participant_id'], row['session'])] = row
+
+    return rows
+
+
+def write_status_file(rows):
+
+    registration_qc_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = status_file.with_name(f'.{status_file.name}.tmp')
+    with open(tmp_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=STATUS_COLUMNS, delimiter='\t', extrasaction='ignore')
+        writer.writeheader()
+        for key in sorted(rows):
+            writer.writerow(rows[key])
+    os.replace(tmp_file, status_file)
+
+
+def load_status():
+    """(participant_id, session) -> row for the whole cohort.
+
+    The first call on a tree without a store seeds it from the qc_output.txt files.
+    """
+
+    if not status_file.is_file():
+        with locked_status() as rows:
+            return dict(rows)
+
+    return read_status_file()
+
+
+@contextmanager
+def locked_status():
+    """Yield the cohort rows for modification and save them atomically on exit."""
+
+    registration_qc_dir.mkdir(parents=True, exist_ok=True)
+    with open(status_file.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        rows = read_status_file() if status_file.is_file() else import_qc_outputs()
+        yield rows
+        write_status_file(rows)
+
+
+def sync_qc_output(subj, rows):
+    """Rewrite a subject's qc_output.txt (deduplicated) from the store."""
+
+    statuses = {session: row['status'] for (s, session), row in sorted(rows.items()) if s == subj}
+    qc_output_file = registration_qc_dir / subj / 'qc_output.txt'
+    if statuses:
+        write_qc_output(qc_output_file, statuses)
+    elif qc_output_file.is_file():
+        qc_output_file.unlink()
+
+
+def set_statuses(updates, source='manual', overwrite=True):
+    """Record (subject, session, status) decisions in one atomic update.
+
+    With overwrite False, sessions that already have a status are left alone.
+    Returns the updates that were applied.
+    """
+
+    applied = []
+    updated = datetime.now().isoformat(timespec='seconds')
+    with locked_status() as rows:
+        for subj, session, status in updates:
+            if status not in STATUSES:
+                raise ValueError(f"bad QC status '{status}' (expected one of {', '.join(STATUSES)})")
+            key = (subject_id(subj), session_id(session))
+            if not overwrite and key in rows:
+                continue
+            rows[key] = {'participant_id': key[0], 'session': key[1], 'status': status,
+                         'source': source, 'updated': updated}
+            applied.append(key + (status,))
+        for subj in {key[0] for key in applied}:
+            sync_qc_output(subj, rows)
+
+    return applied
+
+
+def set_status(subj, session, status, source='manual', overwrite=True):
+    """Record one QC decision; returns True if it was applied."""
+
+    return bool(set_statuses([(subj, session, status)], source=source, overwrite=overwrite))
+
+
+def clear_subject(subj):
+    """Remove every QC decision for a subject."""
+
+    subj = subject_id(subj)
+    with locked_status() as rows:
+        for key in [key for key in rows if key[0] == subj]:
+            del rows[key]
+        sync_qc_output(subj, rows)
+
+
+def get_status(subj, session, rows=None):
+    """'success', 'failure' or None for one subject/session."""
+
+    rows = load_status() if rows is None else rows
+    row = rows.get((subject_id(subj), session_id(session)))
+
+    return row['status'] if row else None
+
+
+def passed_without_freesurfer(rows=None):
+    """Passed clinical/altclinical sessions that have no FreeSurfer directory yet.
+
+    FreeSurfer uses the clinical session when there is one, so a passed
+    altclinical session only counts if the subject has no clinical one.
+    """
+
+    rows = load_status() if rows is None else rows
+    fs_subjects = set(os.listdir(fs_dir)) if fs_dir.is_dir() else set()
+
+    pending = []
+    for (subj, session), row in sorted(rows.items()):
+        label = session[len('ses-'):]
+        if row['status'] != 'success' or label.replace('postop', '') not in ('clinical', 'altclinical'):
+            continue
+        if label.startswith('alt') and (subj, 'ses-' + label[len('alt'):]) in rows:
+            continue
+        if f'{subj}_{session}' not in fs_subjects:
+            pending.append((subj, session))
+
+    return pending
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "query and update the cohort registration QC status"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    get_parser = subparsers.add_parser("get", help="print the status of one session (exit 0 success, 1 failure, 2 none)")
+    get_parser.add_argument("subj")
+    get_parser.add_argument("session")
+
+    set_parser = subparsers.add_parser("set", help="record a QC decision")
+    set_parser.add_argument("subj")
+    set_parser.add_argument("session")
+    set_parser.add_argument("status", choices=STATUSES)
+    set_parser.add_argument("--source", default="manual", help="who made the decision")
+
+    clear_parser = subparsers.add_parser("clear", help="remove all decisions for a subject")
+    clear_parser.add_argument("subj")
+
+    list_parser = subparsers.add_parser("list", help="print the cohort table")
+    list_parser.add_argument("--status", choices=STATUSES)
+    list_parser.add_argument("--subj")
+
+    subparsers.add_parser("pending-freesurfer", help="sessions that passed QC but have no FreeSurfer run")
+    subparsers.add_parser("import", help="(re)build the store from the qc_output.txt files")
+
+    args = parser.parse_args()
+
+    if args.command == "get":
+        status = get_status(args.subj, args.session)
+        print(status or '')
+        sys.exit({'success': 0, 'failure': 1}.get(status, 2))
+
+    elif args.command == "set":
+        set_status(args.subj, args.session, args.status, source=args.source)
+
+    elif args.command == "clear":
+        clear_subject(args.subj)
+
+    elif args.command == "list":
+        for row in load_status().values():
+            if args.status and row['status'] != args.status:
+                continue
+            if args.subj and row['participant_id'] != subject_id(args.subj):
+                continue
+            print('\t'.join(row[col] for col in STATUS_COLUMNS))
+
+    elif args.command == "pending-freesurfer":
+        for subj, session in passed_without_freesurfer():
+            print(f'{subj}\t{session}')
+
+    elif args.command == "import":
+        with locked_status() as rows:
+            imported = import_qc_outputs()
+            rows.clear()
+            rows.update(imported)
+        print(f"++ Imported {len(imported)} session(s) into {status_file} ++")
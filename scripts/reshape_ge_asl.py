@@ -3,6 +3,8 @@
 import nibabel as nb
 from argparse import ArgumentParser
 
+from compression import save_nifti
+
 if __name__ == "__main__":
 
     # parse arguments
@@ -20,4 +22,4 @@ if __name__ == "__main__":
 
     img = nb.load(in_fname)
     reshaped = img.slicer[:, :, :, None]
-    reshaped.to_filename(out_fname)
\ No newline at end of file
+    save_nifti(reshaped, out_fname)
\ No newline at end of file
@@ -7,7 +7,7 @@ Created on Tue Apr 18 2023
 """
 
 from argparse import ArgumentParser
-from datetime import datetime, timedelta
+from functools import lru_cache
 import os
 from pathlib import Path
 import requests
@@ -21,6 +21,7 @@ from mne_bids import BIDSPath, write_raw_bids
 import numpy as np
 
 from colors import Colors
+from neu_paths import bids_root, files_dir, sourcedata_dir
 
 try:
     from bs4 import BeautifulSoup
@@ -32,15 +33,82 @@ except ModuleNotFoundError:
     )
     sys.exit(1)
 
+emptyroom_url = "https://kurage.nimh.nih.gov/EmptyRoom/"
+emptyroom_dir = bids_root / 'sub-emptyroom'
 
-def nearest(items, pivot):
-    """Returns the datetime in items that is nearest to pivot."""
 
-    datetime_items = [datetime.strptime(str(val), "%Y%m%d") for val in items]
-    date_pivot = datetime.strptime(str(pivot), "%Y%m%d")
-    closest_datetime = min(datetime_items, key=lambda x: abs(x - date_pivot))
+def to_datetime64(dates):
+    """YYYYMMDD ints (scalar or array) -> datetime64[D], without string parsing."""
+
+    dates = np.asarray(dates, dtype=np.int64)
+    years, months, days = dates // 10000, dates // 100 % 100, dates % 100
+    month_start = ((years - 1970) * 12 + months - 1).astype('datetime64[M]')
+    out = month_start.astype('datetime64[D]') + (days - 1)
+
+    # reject what strptime would (month 13, Feb 30, ...) instead of rolling over
+    if np.any((months < 1) | (months > 12) | (days < 1) |
+              (out.astype('datetime64[M]') != month_start)):
+        raise ValueError(f"invalid YYYYMMDD date in {dates}")
+
+    return out
+
+
+def from_datetime64(days):
+    """datetime64[D] (scalar or array) -> YYYYMMDD ints."""
+
+    days = np.asarray(days, dtype='datetime64[D]')
+    months = days.astype('datetime64[M]')
+    years = months.astype('datetime64[Y]').astype(np.int64) + 1970
+    month_of_year = months.astype(np.int64) % 12 + 1
+    day_of_month = (days - months.astype('datetime64[D]')).astype(np.int64) + 1
+
+    return years * 10000 + month_of_year * 100 + day_of_month
+
+
+class DateIndex:
+    """Candidate dates (YYYYMMDD ints) sorted once for nearest-date queries.
+
+    Queries take a single date or an array of dates; of candidates equally
+    near, the first in the original list wins (as min() over the list did).
+    """
+
+    def __init__(self, dates):
 
-    return int(closest_datetime.strftime("%Y%m%d"))
+        self.dates = np.asarray(dates, dtype=np.int64)
+        if not self.dates.size:
+            raise ValueError("no candidate dates")
+        days = to_datetime64(self.dates)
+        order = np.argsort(days, kind='stable')
+        # one entry per distinct date, keeping its first position in the list
+        self.days, first = np.unique(days[order], return_index=True)
+        self.order = order[first]
+
+    def nearest_index(self, pivots):
+        """Position(s) in the original dates of the candidate nearest to pivots."""
+
+        pivot_days = to_datetime64(pivots)
+        right = np.clip(np.searchsorted(self.days, pivot_days), 0, len(self.days) - 1)
+        left = np.clip(right - 1, 0, len(self.days) - 1)
+        left_distance = np.abs(pivot_days - self.days[left])
+        right_distance = np.abs(self.days[right] - pivot_days)
+        use_left = (left_distance < right_distance) | \
+            ((left_distance == right_distance) & (self.order[left] < self.order[right]))
+        index = self.order[np.where(use_left, left, right)]
+
+        return int(index) if np.ndim(index) == 0 else index
+
+    def nearest(self, pivots):
+        """Candidate date(s) nearest to pivots."""
+
+        nearest_dates = self.dates[self.nearest_index(pivots)]
+
+        return int(nearest_dates) if np.ndim(nearest_dates) == 0 else nearest_dates
+
+
+def nearest(items, pivot):
+    """Returns the date in items that is nearest to pivot (dates as YYYYMMDD ints)."""
+
+    return DateIndex(items).nearest(pivot)
 
 
 def retrieve_possibles(search_urls):
@@ -76,46 +144,31 @@ def download_and_unzip(url_link, output_dir):
     tgz_file = url_link.split("/")[-1]
     if response.status_code == 200:
         with open((output_dir / tgz_file), "wb") as f:
-            f.write(response.raw.read())
+            shutil.copyfileobj(response.raw, f, 16 * 1024**2)
 
-    os.chdir(output_dir)
+    # extract with cwd instead of os.chdir so downloads can run in threads
     cmd = shlex.split(f"tar -xvzf {output_dir / tgz_file}")
-    subprocess.run(cmd)
+    subprocess.run(cmd, cwd=output_dir)
     os.remove((output_dir / tgz_file))
 
 
-def anonymize_date(date, daysback):
-    
-    new_date = datetime.strptime(str(date), "%Y%m%d") - timedelta(daysback)
-    return int(new_date.strftime("%Y%m%d"))
+@lru_cache(maxsize=None)
+def list_page(url_link):
+    """Links of an empty-room listing page (each page is only fetched once)."""
 
-if __name__ == "__main__":
+    return tuple(retrieve_urls(url_link))
 
-    # parse arguments
-    purpose = "download emptyroom recording with closest date to subject MEG session"
-    parser = ArgumentParser(description=purpose)
-    parser.add_argument("--pnum", help="subject p-number")
-    parser.add_argument("--files_dir", help="location of daysback.txt")
 
-    args = parser.parse_args()
-    files_dir = Path(args.files_dir)
-    pnum = args.pnum
+def find_best_recording(goal_date, main_urls):
+    """(date, url) of the empty-room recording nearest to goal_date.
 
-    neu_dir = Path("/Volumes/shares/NEU")
-    bids_root = neu_dir / 'Data'
-    emptyroom_dir = bids_root / 'sub-emptyroom'
-    subj_source_meg_dir = bids_root / 'sourcedata' / f'sub-{pnum}' / 'ses-meg' / 'meg'
+    The main listing is searched first; if its last (most recent) recording
+    is the best, the monthly pages around goal_date are searched as well.
+    """
 
-    emptyroom_url = "https://kurage.nimh.nih.gov/EmptyRoom/"
-    main_urls = retrieve_urls(emptyroom_url)
     possible_dates, possible_urls = retrieve_possibles(main_urls)
-
-    goal_date = int(
-        next(subj_source_meg_dir.glob(f"*_epilepsy_????????_*.ds")).stem.split("_")[2]
-    )
-
-    best_date = nearest(possible_dates, goal_date)
-    best_idx = possible_dates.index(best_date)
+    best_idx = DateIndex(possible_dates).nearest_index(goal_date)
+    best_date = possible_dates[best_idx]
     best_url = possible_urls[best_idx]
 
     # if the best possible date is the last one, then must search other .htmls
@@ -127,46 +180,48 @@ if __name__ == "__main__":
 
                 # if month_url is within one of month_goal, then search into it
                 if (abs(month_goal - int(url[:-5])) <= 1) or (main_urls[-1] == url):
-                    sub_urls = retrieve_urls(f"{emptyroom_url}{url}")
+                    sub_urls = list_page(f"{emptyroom_url}{url}")
                     possible_sub_dates, possible_sub_urls = retrieve_possibles(sub_urls)
-                    best_sub_date = nearest(possible_sub_dates, goal_date)
-                    best_sub_idx = possible_sub_dates.index(best_sub_date)
-
-                    idx_choice = [best_date, best_sub_date].index(
-                        nearest([best_date, best_sub_date], goal_date)
-                    )
+                    best_sub_idx = DateIndex(possible_sub_dates).nearest_index(goal_date)
+                    best_sub_date = possible_sub_dates[best_sub_idx]
 
-                    # previous was better
-                    if idx_choice == 0:
+                    # previous was better (or as good)
+                    distance = np.abs(to_datetime64([best_date, best_sub_date]) - to_datetime64(goal_date))
+                    if distance[1] >= distance[0]:
                         break
                     else:
                         best_date = best_sub_date
                         best_url = possible_sub_urls[best_sub_idx]
 
-    daysback=int(np.loadtxt((files_dir / 'daysback.txt')))
-    best_date = anonymize_date(best_date, daysback)
+    return best_date, best_url
 
-    # check for existing files
-    emptyroom_date_dir = emptyroom_dir / f'ses-{best_date}'
-    temp_output_dir = emptyroom_dir / f'temp_{best_date}'
+
+def fetch_emptyroom(best_date, best_url, daysback):
+    """Download the recording at best_url and write it as sub-emptyroom/ses-<anonymized date>.
+
+    Returns the session directory; raises RuntimeError if the download failed.
+    """
+
+    ses_date = anonymize_date(best_date, daysback)
+    emptyroom_date_dir = emptyroom_dir / f'ses-{ses_date}'
     if emptyroom_date_dir.exists():
-        print(Colors.YELLOW, f"++ {pnum} already has Emptyroom data in {emptyroom_date_dir}++", Colors.END)
-        sys.exit(1)
-    else:
-        temp_output_dir.mkdir(parents=True, exist_ok=True)
-        download_and_unzip(
-            url_link=f"{emptyroom_url}{best_url}", 
-            output_dir=temp_output_dir
-        )
+        return emptyroom_date_dir
+
+    temp_output_dir = emptyroom_dir / f'temp_{ses_date}'
+    temp_output_dir.mkdir(parents=True, exist_ok=True)
+    download_and_unzip(
+        url_link=f"{emptyroom_url}{best_url}",
+        output_dir=temp_output_dir
+    )
 
     # check for existing files
     ds_list = list(temp_output_dir.glob("MEG_EmptyRoom*.ds"))
     if len(ds_list) == 0:
-        print(Colors.RED, f"++ Emptyroom recording failed to download for {pnum} ++", Colors.END)
-        sys.exit(1)
-    
+        shutil.rmtree(temp_output_dir)
+        raise RuntimeError(f"emptyroom recording {best_url} failed to download")
+
     ## convert files to bids format
-    
+
     try:
         raw = read_raw_ctf(
             directory=ds_list[0],
@@ -179,23 +234,89 @@ if __name__ == "__main__":
             system_clock='ignore'
         )
     raw.info['line_freq'] = 60
-    
-    temp_bids_dir = bids_root / f'temp_{best_date}'
+
+    temp_bids_dir = bids_root / f'temp_{ses_date}'
     bids_path = BIDSPath(
         subject='emptyroom',
-        session=str(best_date),
+        session=str(ses_date),
         task='noise',
         root=temp_bids_dir
     )
-    
+
     write_raw_bids(
         raw=raw,
         bids_path=bids_path,
         anonymize={'daysback':daysback,'keep_his':False}
     )
 
-    temp_ses_dir = temp_bids_dir / f'sub-emptyroom' / f'ses-{best_date}'
+    temp_ses_dir = temp_bids_dir / f'sub-emptyroom' / f'ses-{ses_date}'
     temp_ses_dir.rename(emptyroom_date_dir)
-    
+
     shutil.rmtree(temp_output_dir)
-    shutil.rmtree(temp_bids_dir)
\ No newline at end of file
+    shutil.rmtree(temp_bids_dir)
+
+    return emptyroom_date_dir
+
+
+def subject_meg_date(pnum):
+    """Recording date (YYYYMMDD) of the subject's first .ds in sourcedata (None if none)."""
+
+    subj_source_meg_dir = sourcedata_dir / f'sub-{pnum}' / 'ses-meg' / 'meg'
+    ds_dirs = sorted(subj_source_meg_dir.glob("*_epilepsy_????????_*.ds"))
+    if not ds_dirs:
+        return None
+
+    return int(ds_dirs[0].stem.split("_")[2])
+
+
+def read_daysback(files_dir=files_dir):
+
+    return int(np.loadtxt((Path(files_dir) / 'daysback.txt')))
+
+
+def anonymize_date(date, daysback):
+    """Shift YYYYMMDD date(s) back by daysback days."""
+
+    new_date = from_datetime64(to_datetime64(date) - np.timedelta64(int(daysback), 'D'))
+
+    return int(new_date) if np.ndim(new_date) == 0 else new_date
+
+
+def update_daysback(current_date, new_date=19050101):
+    """Days between YYYYMMDD dates current_date and new_date."""
+
+    difference = to_datetime64(current_date) - to_datetime64(new_date)
+
+    return difference.astype(np.int64) if np.ndim(difference) else int(difference.astype(np.int64))
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "download emptyroom recording with closest date to subject MEG session"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("--pnum", help="subject p-number")
+    parser.add_argument("--files_dir", default=files_dir, help="location of daysback.txt")
+
+    args = parser.parse_args()
+    pnum = args.pnum
+
+    goal_date = subject_meg_date(pnum)
+    if goal_date is None:
+        print(Colors.RED, f"++ {pnum} has no MEG data in sourcedata ++", Colors.END)
+        sys.exit(1)
+
+    best_date, best_url = find_best_recording(goal_date, list_page(emptyroom_url))
+
+    daysback = read_daysback(args.files_dir)
+
+    # check for existing files
+    emptyroom_date_dir = emptyroom_dir / f'ses-{anonymize_date(best_date, daysback)}'
+    if emptyroom_date_dir.exists():
+        print(Colors.YELLOW, f"++ {pnum} already has Emptyroom data in {emptyroom_date_dir}++", Colors.END)
+        sys.exit(1)
+
+    try:
+        fetch_emptyroom(best_date, best_url, daysback)
+    except RuntimeError:
+        print(Colors.RED, f"++ Emptyroom recording failed to download for {pnum} ++", Colors.END)
+        sys.exit(1)
@@ -16,6 +16,7 @@ import sys
 import pandas as pd
 
 from colors import Colors
+from dedup_store import copy_tree
 
 neu_dir = Path("/Volumes/shares/NEU")
 raw_dir = neu_dir / "Raw_Data/MEG/Patients"
@@ -55,20 +56,21 @@ if __name__ == "__main__":
     # iterate through raw session dates
     for raw_session in [d for d in subj_raw_dir.iterdir() if d.is_dir()]:
 
-        # move .ds directories into orig dir
+        # move .ds directories into orig dir (reflinked, hard-linked or deduplicated where possible)
         for src_dir in raw_session.glob(f"{meg_code}_epilepsy_????????_*.ds"):
-            shutil.copytree(src_dir, (subj_source_dir / (src_dir.stem + src_dir.suffix)))
+            copy_tree(src_dir, (subj_source_dir / (src_dir.stem + src_dir.suffix)))
 
         # if EEGImpedance files exist, move them into separate directory
         impedance_dir = subj_source_dir / "EEG"
         for src_dir in raw_session.glob("*EEGImpedance*.ds"):
             impedance_dir.mkdir(exist_ok=True, parents=True)
-            shutil.copytree(src_dir, (impedance_dir / (src_dir.stem + src_dir.suffix)))
+            copy_tree(src_dir, (impedance_dir / (src_dir.stem + src_dir.suffix)))
 
-        # unzip .meg4 files in each .ds dir
+        # unzip .meg4 files in each .ds dir (-f since the .bz2 may be linked to
+        # its Raw_Data original; only this link is removed)
         zipped_files = subj_source_dir.glob("*.ds/*.meg4.bz2")
         for zipped_file in zipped_files:
-            cmd = shlex.split(f"bzip2 -d {zipped_file}")
+            cmd = shlex.split(f"bzip2 -d -f {zipped_file}")
             subprocess.run(cmd)
 
         # check to see if patient has been Markerfiles
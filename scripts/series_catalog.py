@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Catalog of the series in a raw research session. The session directory is
+listed once and one DICOM header is read per series (SeriesDescription,
+ProtocolName, manufacturer, echoes) next to its number of files. The result
+is cached per session in derivatives/series_catalog (Raw_Data is never
+written to), and only series whose directory changed since are scanned
+again. Series are mapped to roles (t1w, asl, rest_ge_open, ...) by
+files/series_rules.json, so the proc_* scripts ask for a role instead of
+probing folder names, and a new folder name only needs a new rule.
+
+A rule lists folder name patterns in order of preference and may add
+'n_files' (file count of a complete series), 'companions' (folders that must
+exist next to it, e.g. '{name}-e02') and 'dcm_suffix' (what dcm2niix appends
+to the output name for a folder). The header fields are only shown by
+'show'; they do not select series.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+from functools import lru_cache
+import hashlib
+import json
+import os
+from pathlib import Path
+import sys
+
+from neu_paths import derivatives_dir, files_dir, raw_dir
+
+rules_file = files_dir / 'series_rules.json'
+catalog_dir = derivatives_dir / 'series_catalog'
+# bump when the entry layout changes so that old manifests are rebuilt
+CATALOG_VERSION = 1
+HEADER_TAGS = {
+    'series_description': (0x0008, 0x103e),
+    'protocol_name': (0x0018, 0x1030),
+    'manufacturer': (0x0008, 0x0070),
+    'series_number': (0x0020, 0x0011),
+    'echoes': (0x0019, 0x10a9),  # GE number of echoes
+}
+# private creator needed to decode (0019,10a9) in implicit VR files
+GE_PRIVATE_CREATOR = (0x0019, 0x0010)
+
+
+@lru_cache(maxsize=None)
+def load_rules(path=rules_file):
+    """role -> rule from series_rules.json."""
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def is_dicom(name):
+
+    return name.lower().endswith('.dcm')
+
+
+def list_series_files(series_dir):
+    """DICOM files of a series, including those sortme.py moved into echo_####."""
+
+    files = []
+    with os.scandir(series_dir) as it:
+        for entry in it:
+            if entry.is_dir() and fnmatchcase(entry.name, 'echo_[0-9][0-9][0-9][0-9]'):
+                with os.scandir(entry.path) as echo_it:
+                    files += [echo_entry.path for echo_entry in echo_it if is_dicom(echo_entry.name)]
+            elif is_dicom(entry.name):
+                files.append(entry.path)
+
+    return sorted(files)
+
+
+def read_header(dicom_file):
+    """Catalog fields from one DICOM header (None where missing or unreadable)."""
+
+    import pydicom
+
+    info = dict.fromkeys(HEADER_TAGS)
+    try:
+        ds = pydicom.dcmread(dicom_file, stop_before_pixels=True,
+                             specific_tags=list(HEADER_TAGS.values()) + [GE_PRIVATE_CREATOR])
+    except (OSError, pydicom.errors.InvalidDicomError):
+        return info
+
+    for key, tag in HEADER_TAGS.items():
+        if tag not in ds or ds[tag].value in (None, ''):
+            continue
+        value = ds[tag].value
+        if key in ('series_number', 'echoes'):
+            try:
+                info[key] = int(float(value))
+            except (TypeError, ValueError):
+                pass
+        else:
+            info[key] = str(value)
+
+    return info
+
+
+def scan_series(series_dir):
+    """Catalog entry of one series directory."""
+
+    files = list_series_files(series_dir)
+    info = read_header(files[0]) if files else dict.fromkeys(HEADER_TAGS)
+    info['n_files'] = len(files)
+
+    return info
+
+
+def catalog_path(raw_session_dir):
+    """Cache file of a session, named by a hash of its path below Raw_Data (no subject names)."""
+
+    session = os.path.abspath(raw_session_dir)
+    if session.startswith(f'{raw_dir}{os.sep}'):
+        session = os.path.relpath(session, raw_dir)
+
+    return catalog_dir / f'{hashlib.sha1(session.encode()).hexdigest()[:20]}.json'
+
+
+def read_catalog(catalog_file):
+
+    try:
+        with open(catalog_file, 'r') as f:
+            catalog = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if catalog.get('version') != CATALOG_VERSION:
+        return {}
+
+    return catalog['series']
+
+
+def write_catalog(catalog_file, series):
+    """Write the manifest atomically; it is left uncached if derivatives is not writable."""
+
+    tmp_file = catalog_file.with_name(f'{catalog_file.name}.{os.getpid()}.tmp')
+    try:
+        catalog_dir.mkdir(parents=True, exist_ok=True)
+        with open(tmp_file, 'w') as f:
+            json.dump({'version': CATALOG_VERSION, 'series': series}, f, indent=1, sort_keys=True)
+        os.replace(tmp_file, catalog_file)
+    except OSError:
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+
+def scan_session(raw_session_dir, rescan=False, n_jobs=8):
+    """series name -> catalog entry for a raw session directory.
+
+    Series whose directory mtime matches the cached manifest are not read
+    again; an empty dict is returned if the directory does not exist.
+    """
+
+    raw_session_dir = Path(raw_session_dir)
+    catalog_file = catalog_path(raw_session_dir)
+    cached = {} if rescan else read_catalog(catalog_file)
+
+    series, stale = {}, {}
+    try:
+        with os.scandir(raw_session_dir) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                mtime_ns = entry.stat().st_mtime_ns
+                if entry.name in cached and cached[entry.name]['mtime_ns'] == mtime_ns:
+                    series[entry.name] = cached[entry.name]
+                else:
+                    stale[entry.name] = mtime_ns
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+    if stale:
+        with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+            infos = pool.map(scan_series, [raw_session_dir / name for name in stale])
+            for (name, mtime_ns), info in zip(stale.items(), infos):
+                series[name] = dict(info, mtime_ns=mtime_ns)
+    if stale or set(cached) != set(series):
+        write_catalog(catalog_file, series)
+
+    return series
+
+
+def match_rank(rule, name):
+    """Preference rank of a series for a rule (None if it does not match)."""
+
+    for rank, pattern in enumerate(rule['folders']):
+        if fnmatchcase(name, pattern):
+            return rank
+
+    return None
+
+
+def select_series(role, series, complete=False):
+    """Names of the series that fill a role, best first.
+
+    series maps names to catalog entries; entries may be None (names only),
+    in which case n_files cannot be checked.
+    """
+
+    rule = load_rules()[role]
+    ranked = []
+    for name, info in series.items():
+        rank = match_rank(rule, name)
+        if rank is None:
+            continue
+        if any(companion.format(name=name) not in series for companion in rule.get('companions', [])):
+            continue
+        if complete and rule.get('n_files') and (info or {}).get('n_files') != rule['n_files']:
+            continue
+        ranked.append((rank, name))
+
+    return [name for _, name in sorted(ranked)]
+
+
+def find_series(raw_session_dir, role, complete=False, series=None):
+    """Paths of the series in a raw session that fill a role, best first."""
+
+    series = scan_session(raw_session_dir) if series is None else series
+
+    return [Path(raw_session_dir) / name for name in select_series(role, series, complete)]
+
+
+def output_suffix(role, name):
+    """Suffix dcm2niix appends to the output name for a series folder."""
+
+    return load_rules()[role].get('dcm_suffix', {}).get(name, '')
+
+
+if __name__ == "__main__":
+
+    roles = sorted(load_rules())
+
+    # parse arguments
+    purpose = "catalog the series of raw research sessions and look them up by role"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = subparsers.add_parser("build", help="scan sessions and update their manifests")
+    build_parser.add_argument("raw_session_dirs", nargs="+")
+    build_parser.add_argument("--rescan", action="store_true", help="ignore the cached manifests")
+
+    show_parser = subparsers.add_parser("show", help="print the catalog of a session")
+    show_parser.add_argument("raw_session_dir")
+    show_parser.add_argument("--rescan", action="store_true", help="ignore the cached manifest")
+
+    find_parser = subparsers.add_parser("find", help="print the series that fill a role (exit 1 if none)")
+    find_parser.add_argument("raw_session_dir")
+    find_parser.add_argument("role", choices=roles)
+    find_parser.add_argument("--complete", action="store_true", help="only series with the expected file count")
+    find_parser.add_argument("--first", action="store_true", help="only the preferred series")
+    find_parser.add_argument("--names", action="store_true", help="print folder names instead of paths")
+
+    has_parser = subparsers.add_parser("has", help="exit 0 if every role has a series, else 1")
+    has_parser.add_argument("raw_session_dir")
+    has_parser.add_argument("roles", nargs="+", choices=roles)
+    has_parser.add_argument("--complete", action="store_true", help="only series with the expected file count")
+
+    args = parser.parse_args()
+
+    if args.command == "build":
+        for raw_session_dir in args.raw_session_dirs:
+            series = scan_session(raw_session_dir, rescan=args.rescan)
+            print(f"++ {len(series)} series in {raw_session_dir} ++")
+
+    elif args.command == "show":
+        series = scan_session(args.raw_session_dir, rescan=args.rescan)
+        matched = {role: select_series(role, series) for role in roles}
+        columns = ['n_files', 'echoes', 'manufacturer', 'series_description', 'protocol_name']
+        print('\t'.join(['series', 'roles'] + columns))
+        for name, info in sorted(series.items()):
+            name_roles = ','.join(role for role in roles if name in matched[role])
+            print('\t'.join([name, name_roles] + ['' if info[col] is None else str(info[col]) for col in columns]))
+
+    elif args.command == "find":
+        paths = find_series(args.raw_session_dir, args.role, complete=args.complete)
+        if args.first:
+            paths = paths[:1]
+        for path in paths:
+            print(path.name if args.names else path)
+        if not paths:
+            sys.exit(1)
+
+    elif args.command == "has":
+        series = scan_session(args.raw_session_dir)
+        if not all(select_series(role, series, complete=args.complete) for role in args.roles):
+            sys.exit(1)
@@ -7,6 +7,15 @@ Created on Wed Aug 15 13:58:08 2018
 """
 
 import os, sys, numpy, pydicom, json, datetime
+import compression
+
+# Sidecar fields dcm2niix writes that --direct does not: GE echo spacing and
+# phase polarity come from vendor-private tags that only dcm2niix decodes.
+# Series that need them (e.g. for distortion correction) should be converted
+# without --direct.
+directMissingKeys = ['EffectiveEchoSpacing', 'TotalReadoutTime', 'PhaseEncodingDirection',
+                     'TriggerDelayTime', 'InstitutionalDepartmentName', 'PulseSequenceType',
+                     'BidsGuess', 'ConversionSoftwareVersion']
 
 def printHelp(argv): # ========================================================
     # Print help
@@ -15,7 +24,7 @@ def printHelp(argv): # ========================================================
     print("and on a shell script, both of which were provided by Wen-Ming Luh.")
     print("")
     print("Usage:")
-    print(argv[0] + " <dicomdir> [file extension] [isSorted]")
+    print(argv[0] + " [--direct] [--echoes N[,N...]] <dicomdir> [file extension] [isSorted]")
     print("")
     print("Inputs:")
     print("- dicomdir       : Directory containing DICOM files.")
@@ -25,6 +34,16 @@ def printHelp(argv): # ========================================================
     print("- isSorted?      : A True/False to indicate whether multi-echo")
     print("                   have been sorted by an earlier run of this")
     print("                   program. Default: False")
+    print("- --direct       : Write the multi-echo NIFTI files directly from the")
+    print("                   DICOM pixel data (one read per file) instead of")
+    print("                   running dcm2niix once per echo. Falls back to")
+    print("                   dcm2niix if the series cannot be assembled.")
+    print("                   The JSON sidecar lacks these dcm2niix fields:")
+    print("                   %s" % ", ".join(directMissingKeys))
+    print("- --echoes       : Comma-separated echo numbers (1-based) to convert,")
+    print("                   e.g. --echoes 1 for fieldmaps. Files of all echoes")
+    print("                   are still sorted into echo_####.")
+    print("                   Default: all echoes.")
     print("")
     print("Files are reorganized (moved) into echo_####.")
     print("")
@@ -48,7 +67,21 @@ def processOptions(argv): # ===================================================
     workDir  = "."
     fileExt  = "dcm"
     isSorted = False
+    direct   = False
+    echoes   = None
     # -------------------------------------------------------------------------
+    if '--direct' in argv:
+        direct = True
+        argv   = [arg for arg in argv if arg != '--direct']
+    if '--echoes' in argv:
+        optIdx = argv.index('--echoes')
+        try:
+            echoes = sorted(set(int(e) for e in argv[optIdx+1].split(',')))
+        except (IndexError, ValueError):
+            sys.exit("Error: --echoes needs a comma-separated list of echo numbers.")
+        if echoes[0] < 1:
+            sys.exit("Error: echo numbers start at 1.")
+        argv = argv[:optIdx] + argv[optIdx+2:]
     if(len(argv) <= 1):
        printHelp(argv)
        sys.exit(0)
@@ -58,7 +91,7 @@ def processOptions(argv): # ===================================================
     if len(argv) > 3:
         if argv[3].lower() == 'true':
             isSorted = True
-    return(workDir, fileExt, isSorted)
+    return(workDir, fileExt, isSorted, direct, echoes)
 
 def updateProgress(progress): # ===============================================
     barLength = 50
@@ -93,8 +126,38 @@ def returnTagValue(x, tag): # =================================================
         tagValue = None
     return tagValue
 
-def sortMultiEcho(allFileNames): # ============================================
+# Tags read by indexHeaders; the private creators are needed to decode the
+# private tags of implicit VR files.
+indexTags = [(0x0008,0x0018), (0x0019,0x0010), (0x0019,0x10a2),
+             (0x0020,0x0013), (0x0020,0x0032)]
+
+def indexHeaders(allFileNames): # =============================================
+    # Read every header once, parsing only the tags needed for sorting.
+    # Returns a dictionary: file name -> [SOP instance UID, slice index,
+    #                                     instance number, image position]
+    headerIndex = dict()
+    nFiles = len(allFileNames)
+    print("Reading %s DICOM headers." % nFiles)
+    for fileCount, fileName in enumerate(allFileNames, 1):
+        dicomHdr = pydicom.read_file(fileName, stop_before_pixels=True,
+                                     specific_tags=indexTags)
+        imagePosition = returnTagValue(dicomHdr, ('0020','0032'))
+        if imagePosition is not None:
+            imagePosition = tuple(float(v) for v in imagePosition)
+        instanceNumber = returnTagValue(dicomHdr, ('0020','0013'))
+        headerIndex[fileName] = [returnTagValue(dicomHdr, ('0008','0018')),
+                                 int(returnTagValue(dicomHdr, ('0019','10a2'))),
+                                 int(instanceNumber) if instanceNumber is not None else fileCount,
+                                 imagePosition]
+        # Give some indication of progress
+        if (fileCount % max(1, round(nFiles/100)) == 0) or (fileCount == nFiles):
+            updateProgress(fileCount/nFiles)
+    print("")
+    return headerIndex
+
+def sortMultiEcho(allFileNames, headerIndex=None): # ==========================
     # Sort the DICOM files from the working directory
+    # Returns a list (one entry per echo) of the moved file names.
     dicomHdr     = pydicom.read_file(allFileNames[0], stop_before_pixels=True)
     nImages      = int      (returnTagValue(dicomHdr, ('0020','1002')))
     nRepetitions = int      (returnTagValue(dicomHdr, ('0020','0105')))
@@ -114,18 +177,20 @@ def sortMultiEcho(allFileNames): # ============================================
     print("Number of images in directory:       %s"   % nImagesDir)
     print("Time of first echo (ms):             %s"   % EchoTime0)
     print("Time difference between echoes (ms): %s\n" % echoTimeDiff)
-    
-    # Each slice an index number. The following while loop reads files until it 
-    # finds nImages distinct index numbers
-    sliceIndexList = list()
-    fileCount = 0
-    while len(sliceIndexList) < nImages:
+
+    # All tags needed below come from one read of each header
+    if headerIndex is None:
+        headerIndex = indexHeaders(allFileNames)
+
+    # Each slice an index number. The following loop goes through the files
+    # until it finds nImages distinct index numbers
+    sliceIndexSet = set()
+    for file2Process in allFileNames:
         # sliceIndex is the counter from the first to last of nImages (across echoes and slices and volumes)
-        sliceIndex = int(returnTagValue(allFileNames[fileCount], ('0019','10a2')))
-        if sliceIndex not in sliceIndexList:
-            sliceIndexList.append(sliceIndex)
-        fileCount += 1
-    sliceIndexList.sort()
+        sliceIndexSet.add(headerIndex[file2Process][1])
+        if len(sliceIndexSet) == nImages:
+            break
+    sliceIndexList = sorted(sliceIndexSet)
 
     if( nImages % nSlices ):  # i.e. if there is a remainder from this division
         sys.exit("Error: There seem to be some un-accounted for slices.\n" \
@@ -134,28 +199,26 @@ def sortMultiEcho(allFileNames): # ============================================
     else:
         sliceIndexList = numpy.reshape(sliceIndexList, [nEchoes, nImages//nEchoes])
 
+    # Echo of every slice index
+    echoOfSliceIndex = dict()
+    for EchoIdx in range(0, nEchoes):
+        for sliceIndex in sliceIndexList[EchoIdx]:
+            echoOfSliceIndex[int(sliceIndex)] = EchoIdx
+
     # Track all SOP instance UIDs.
     if len(allFileNames) > (nImages*nRepetitions):
         print("Warning: Sometimes GE multi-echo DICOM series have replicated slices.")
         print("         These will be sorted out below.")
 
-    imageInstanceUIDList     = list()
     multiEchoFilesSortedDict = dict()
-    imageCount = 1
     for file2Process in allFileNames:
-        imageInstanceUID = returnTagValue(file2Process, ('0008','0018'))
-        sliceIndex       = returnTagValue(file2Process, ('0019','10a2'))
-        if imageInstanceUID not in imageInstanceUIDList:
-            imageInstanceUIDList.append(imageInstanceUID)
+        imageInstanceUID = headerIndex[file2Process][0]
+        sliceIndex       = headerIndex[file2Process][1]
+        if imageInstanceUID not in multiEchoFilesSortedDict:
             multiEchoFilesSortedDict[imageInstanceUID] = [file2Process, sliceIndex]
-        # Give some indication of progress
-        if (imageCount % round(nImagesExp/100) == 0) or (imageCount == nImagesExp):
-            updateProgress(imageCount/nImagesExp)
-        imageCount += 1
-    print("")
 
     if len(allFileNames) > (nImages*nRepetitions):
-        print("After sorting out duplicates, number of images is: %s" % len(imageInstanceUIDList))
+        print("After sorting out duplicates, number of images is: %s" % len(multiEchoFilesSortedDict))
         print("Number of entries in dictionary is:                %s" % len(multiEchoFilesSortedDict))
 
     # At this time, we should have a dictionary of all of the files we need to
@@ -164,27 +227,167 @@ def sortMultiEcho(allFileNames): # ============================================
     # files.  At this point, we should not need to read anything from disk, but
     # should be able to move files to their correct locations / echo directories.
     print("Sorting images by echo and moving into sub-directories.")
+    echoFileLists = list()
     for EchoIdx in range(0, nEchoes):
         dirName = "echo_%04d" % (EchoIdx + 1)
         os.mkdir(dirName)
+        echoFileLists.append(list())
     imageCount = 1
     for sopIDs in multiEchoFilesSortedDict.keys():
+        fileName   = multiEchoFilesSortedDict[sopIDs][0]
         sliceIndex = multiEchoFilesSortedDict[sopIDs][1]
-        for EchoIdx in range(0, nEchoes):
+        if sliceIndex in echoOfSliceIndex:
+            EchoIdx = echoOfSliceIndex[sliceIndex]
             dirName = "echo_%04d" % (EchoIdx + 1)
-            if sliceIndex in sliceIndexList[EchoIdx]:
-                os.rename(multiEchoFilesSortedDict[sopIDs][0],
-                          os.path.join(dirName, multiEchoFilesSortedDict[sopIDs][0]))
-                break
+            os.rename(fileName, os.path.join(dirName, fileName))
+            echoFileLists[EchoIdx].append(os.path.join(dirName, fileName))
+            headerIndex[os.path.join(dirName, fileName)] = headerIndex[fileName]
         # Give some indication of progress
-        if (imageCount % round(nImagesExp/100) == 0) or (imageCount == nImagesExp):
+        if (imageCount % max(1, round(nImagesExp/100)) == 0) or (imageCount == nImagesExp):
             updateProgress(imageCount/nImagesExp)
         imageCount += 1
     print("")
+    return echoFileLists
+
+def writeNiftiDirect(echoFiles, headerIndex, niftiName, # =====================
+                     EchoTime=None, AcqDateTime=None):
+    # Assemble one echo into a 4D NIFTI (plus JSON) in Python, reading the
+    # pixel data of every file once. Slices are placed by their position along
+    # the slice normal and volumes by instance number. Like dcm2niix, the row
+    # axis is flipped so that the output has the same orientation.
+    # Returns False (nothing written) if the files do not form a full series.
+    import nibabel
+
+    dicomHdr = pydicom.read_file(echoFiles[0], stop_before_pixels=True)
+    orientation = returnTagValue(dicomHdr, ('0020','0037'))
+    pixelSpacing = returnTagValue(dicomHdr, ('0028','0030'))
+    if orientation is None or pixelSpacing is None or \
+            any(headerIndex[f][3] is None for f in echoFiles):
+        print("Warning: geometry tags missing; cannot assemble %s directly." % niftiName)
+        return False
+    rowCosines = numpy.array(orientation[:3], dtype=float)
+    colCosines = numpy.array(orientation[3:], dtype=float)
+    sliceNormal = numpy.cross(rowCosines, colCosines)
+
+    # Slice number of every file from its position along the slice normal,
+    # and volume number from its rank by instance number within the slice.
+    # The (0019,10a2) index sortMultiEcho uses is in acquisition order, whose
+    # slice/volume nesting varies by sequence, so it only separates echoes.
+    positions = numpy.array([headerIndex[f][3] for f in echoFiles])
+    distances = numpy.round(positions @ sliceNormal, 3)
+    sliceDistances, sliceOfFile = numpy.unique(distances, return_inverse=True)
+    nSlices = len(sliceDistances)
+    nVolumes = len(echoFiles) // nSlices
+    if nVolumes * nSlices != len(echoFiles) or \
+            numpy.any(numpy.bincount(sliceOfFile, minlength=nSlices) != nVolumes):
+        print("Warning: slices are missing; cannot assemble %s directly." % niftiName)
+        return False
+    order = numpy.lexsort(([headerIndex[f][2] for f in echoFiles], sliceOfFile))
+    volumeOfFile = numpy.empty(len(echoFiles), dtype=int)
+    volumeOfFile[order] = numpy.tile(numpy.arange(nVolumes), nSlices)
+
+    nRows, nCols = int(dicomHdr.Rows), int(dicomHdr.Columns)
+    data = None
+    triggerTimes = [None] * nSlices
+    for fileIdx, fileName in enumerate(echoFiles):
+        dicomImg = pydicom.read_file(fileName)
+        pixels = dicomImg.pixel_array
+        if data is None:
+            data = numpy.zeros((nCols, nRows, nSlices, nVolumes), dtype=pixels.dtype)
+        data[:, :, sliceOfFile[fileIdx], volumeOfFile[fileIdx]] = pixels.T
+        if volumeOfFile[fileIdx] == 0:
+            triggerTimes[sliceOfFile[fileIdx]] = returnTagValue(dicomImg, ('0018','1060'))
+    data = data[:, ::-1]
+
+    # Voxel -> patient (LPS) coordinates, then to NIFTI's RAS
+    firstPosition = positions[numpy.argmin(distances)]
+    if nSlices > 1:
+        sliceStep = (positions[numpy.argmax(distances)] - firstPosition) / (nSlices - 1)
+    else:
+        sliceStep = sliceNormal * float(returnTagValue(dicomHdr, ('0018','0050')) or 1)
+    affine = numpy.eye(4)
+    affine[:3, 0] = rowCosines * float(pixelSpacing[1])
+    affine[:3, 1] = -colCosines * float(pixelSpacing[0])
+    affine[:3, 2] = sliceStep
+    affine[:3, 3] = firstPosition + colCosines * float(pixelSpacing[0]) * (nRows - 1)
+    affine = numpy.diag([-1, -1, 1, 1]) @ affine
+
+    img = nibabel.Nifti1Image(data, affine)
+    img.header.set_xyzt_units('mm', 'sec')
+    repetitionTime = returnTagValue(dicomHdr, ('0018','0080'))
+    if repetitionTime is not None:
+        img.header['pixdim'][4] = float(repetitionTime) / 1000
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    slope = returnTagValue(dicomHdr, ('0028','1053'))
+    if slope is not None:
+        img.header.set_slope_inter(float(slope), float(returnTagValue(dicomHdr, ('0028','1052')) or 0))
+
+    # Sidecar with the fields dcm2niix takes from these headers
+    json_data = dict()
+    for key, tag in (('Modality',               ('0008','0060')),
+                     ('MagneticFieldStrength',  ('0018','0087')),
+                     ('ImagingFrequency',       ('0018','0084')),
+                     ('Manufacturer',           ('0008','0070')),
+                     ('ManufacturersModelName', ('0008','1090')),
+                     ('InstitutionName',        ('0008','0080')),
+                     ('StationName',            ('0008','1010')),
+                     ('BodyPart',               ('0018','0015')),
+                     ('PatientPosition',        ('0018','5100')),
+                     ('SoftwareVersions',       ('0018','1020')),
+                     ('SeriesDescription',      ('0008','103e')),
+                     ('ProtocolName',           ('0018','1030')),
+                     ('ScanningSequence',       ('0018','0020')),
+                     ('SequenceVariant',        ('0018','0021')),
+                     ('ScanOptions',            ('0018','0022')),
+                     ('SequenceName',           ('0018','0024')),
+                     ('SeriesNumber',           ('0020','0011')),
+                     ('SliceThickness',         ('0018','0050')),
+                     ('SpacingBetweenSlices',   ('0018','0088')),
+                     ('PixelBandwidth',         ('0018','0095')),
+                     ('FlipAngle',              ('0018','1314'))):
+        value = returnTagValue(dicomHdr, tag)
+        if isinstance(value, pydicom.multival.MultiValue):
+            # dcm2niix keeps multi-valued strings joined by backslashes
+            value = '\\'.join(str(v) for v in value)
+        if value is not None and value != '':
+            json_data[key] = value if isinstance(value, str) else float(value)
+    if 'SeriesNumber' in json_data:
+        json_data['SeriesNumber'] = int(json_data['SeriesNumber'])
+    if json_data.get('Manufacturer') == 'GE MEDICAL SYSTEMS':
+        json_data['Manufacturer'] = 'GE'
+    imageType = returnTagValue(dicomHdr, ('0008','0008'))
+    if imageType is not None:
+        json_data['ImageType'] = [imageType] if isinstance(imageType, str) else list(imageType)
+    if repetitionTime is not None:
+        json_data['RepetitionTime'] = float(repetitionTime) / 1000
+    if EchoTime != None:
+        json_data['EchoTime'] = EchoTime/1000
+    if AcqDateTime != None:
+        json_data['AcquisitionDateTime'] = AcqDateTime
+    phaseDirection = returnTagValue(dicomHdr, ('0018','1312'))
+    if phaseDirection in ('ROW', 'COL'):
+        json_data['ReconMatrixPE'] = nCols if phaseDirection == 'ROW' else nRows
+        json_data['PhaseEncodingAxis'] = 'i' if phaseDirection == 'ROW' else 'j'
+    json_data['ImageOrientationPatientDICOM'] = [float(v) for v in orientation]
+    if phaseDirection is not None:
+        json_data['InPlanePhaseEncodingDirectionDICOM'] = phaseDirection
+    # Slice times (s) from the trigger times of the first volume
+    if all(t is not None for t in triggerTimes):
+        json_data['SliceTiming'] = [float(t) / 1000 for t in triggerTimes]
+    json_data['ConversionSoftware'] = 'sortme.py'
+
+    print("Writing %s.nii.gz directly from the DICOM files." % niftiName)
+    compression.save_nifti(img, '%s.tmp.nii.gz' % niftiName)
+    os.replace('%s.tmp.nii.gz' % niftiName, '%s.nii.gz' % niftiName)
+    with open('%s.json' % niftiName, 'w') as f:
+        json.dump(json_data, f, indent=2)
+    return True
 
 def convertToNifti(dirName, niftiName, # ======================================
                    EchoTime=None, AcqDateTime=None, MoveFile=False): 
-    cmd = "dcm2niix -z y -b y -ba y -f %s %s" % (niftiName, dirName)
+    cmd = "dcm2niix %s -b y -ba y -f %s %s" % (" ".join(compression.dcm2niix_args()),
+                                                niftiName, dirName)
     print("Converting to NIFTI.")
     print("Running the following command:\n%s" % cmd)
     status = os.system(cmd)
@@ -227,11 +430,12 @@ if __name__ == '__main__':
         def sync():
            libc.sync()
            
-    (workDir, fileExt, isSorted) = processOptions(sys.argv[0:])
+    (workDir, fileExt, isSorted, direct, echoes) = processOptions(sys.argv[0:])
     sys.stderr.write('Processing %s files in directory %s\n' % (fileExt, workDir))
     os.chdir(workDir)
+    firstEchoDir = "echo_%04d" % (echoes[0] if echoes else 1)
     if isSorted:
-        allFileNames = [f for f in os.listdir('echo_0001') if f.endswith(".%s" % fileExt)]
+        allFileNames = [f for f in os.listdir(firstEchoDir) if f.endswith(".%s" % fileExt)]
     else:
         allFileNames = [f for f in os.listdir('.')         if f.endswith(".%s" % fileExt)]
     
@@ -242,7 +446,7 @@ if __name__ == '__main__':
     
     # Test manufacturer
     if isSorted:
-        dicomHdr = pydicom.read_file(os.path.join('echo_0001',allFileNames[0]), stop_before_pixels=True)
+        dicomHdr = pydicom.read_file(os.path.join(firstEchoDir,allFileNames[0]), stop_before_pixels=True)
     else:
         dicomHdr = pydicom.read_file(allFileNames[0], stop_before_pixels=True)
     Manufacturer = returnTagValue(dicomHdr, ('0008','0070'))
@@ -260,7 +464,7 @@ if __name__ == '__main__':
     nEchoes = int(float(returnTagValue(dicomHdr, ('0019','10a9'))))
     if nEchoes == None or nEchoes <= 1:
         if isSorted:
-            dirName   = 'echo_0001'
+            dirName   = firstEchoDir
             niftiName = dirName
             MoveFile  = True
         else:
@@ -273,11 +477,32 @@ if __name__ == '__main__':
     else:
         EchoTime0    = float(returnTagValue(dicomHdr, ('0018','0081')))
         echoTimeDiff = float(returnTagValue(dicomHdr, ('0019','10ac')))
+        if echoes is None:
+            echoes = list(range(1, nEchoes + 1))
+        elif echoes[-1] > nEchoes:
+            sys.exit("Error: echo %s requested but the series has %s echoes." % (echoes[-1], nEchoes))
         if not isSorted:
-            sortMultiEcho(allFileNames)
-        for EchoIdx in range(0, nEchoes):
+            # every echo is sorted into its echo_#### folder; only the
+            # requested ones are converted below
+            headerIndex   = indexHeaders(allFileNames)
+            echoFileLists = sortMultiEcho(allFileNames, headerIndex)
+        elif direct:
+            echoFileLists = list()
+            for EchoIdx in range(0, nEchoes):
+                dirName = "echo_%04d" % (EchoIdx + 1)
+                if (EchoIdx + 1) in echoes:
+                    echoFileLists.append(sorted(os.path.join(dirName, f) for f in os.listdir(dirName)
+                                                if f.endswith(".%s" % fileExt)))
+                else:
+                    echoFileLists.append(list())
+            headerIndex = indexHeaders([f for echoFiles in echoFileLists for f in echoFiles])
+        for EchoIdx in [e - 1 for e in echoes]:
             dirName   = "echo_%04d" % (EchoIdx + 1)
             niftiName = dirName
+            if direct and writeNiftiDirect(echoFileLists[EchoIdx], headerIndex, niftiName,
+                                           EchoTime=EchoTime0 + EchoIdx*echoTimeDiff,
+                                           AcqDateTime=AcqDateTime):
+                continue
             convertToNifti(dirName, niftiName,
                            EchoTime=EchoTime0 + EchoIdx*echoTimeDiff,
                            AcqDateTime=AcqDateTime, MoveFile=True)
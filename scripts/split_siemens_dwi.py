@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Split a Siemens nih_diff_2mm_45vol series into its blip-up and blip-down
+halves and convert both with dcm2niix_afni at the same time. The series
+directory is listed once; each direction gets a scratch folder of symlinks
+(plus its README) built in this process, and only the finished image and
+sidecar are published into the subject's dwi directory.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatchcase
+import json
+import os
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+
+from colors import Colors
+from compression import dcm2niix_args
+from instrument import logs_dir, run_command
+from staging import publish, scratch_dir
+
+# file name patterns of each direction (blip down files carry a _v2 suffix)
+DIRECTION_PATTERNS = {
+    'up': ('*-?????.dcm', 'README-Series.txt'),
+    'down': ('*-?????_v*2.dcm', 'README-Series_v*2.txt'),
+}
+
+
+def split_series(raw_dwi_dir, directions):
+    """direction -> (dicom paths, readme paths) from one listing of raw_dwi_dir."""
+
+    views = {direction: ([], []) for direction in directions}
+    with os.scandir(raw_dwi_dir) as it:
+        for entry in it:
+            for direction in directions:
+                dicom_pattern, readme_pattern = DIRECTION_PATTERNS[direction]
+                if fnmatchcase(entry.name, dicom_pattern):
+                    views[direction][0].append(entry.path)
+                elif fnmatchcase(entry.name, readme_pattern):
+                    views[direction][1].append(entry.path)
+
+    return views
+
+
+def link_view(dicom_files, readme_files, view_dir):
+    """Folder of symlinks to one direction's files (READMEs are copied, as before)."""
+
+    view_dir.mkdir()
+    for path in dicom_files:
+        os.symlink(path, view_dir / os.path.basename(path))
+    for path in readme_files:
+        shutil.copy(path, view_dir)
+
+
+def convert_direction(view_dir, out_name, direction, labels):
+    """Run dcm2niix_afni on one view; returns (direction, returncode)."""
+
+    cmd = ['dcm2niix_afni', '-o', str(view_dir.parent)] + dcm2niix_args() + ['-f', out_name, str(view_dir)]
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    with open(logs_dir / f'dcm2niix_{out_name}.log', 'w') as log:
+        returncode = run_command(cmd, stage='dcm2niix_afni', stdout=log, stderr=subprocess.STDOUT, **labels)
+
+    if returncode == 0 and direction == 'up':
+        # manually override phase encoding direction in siemens blip up .json sidecar
+        json_file = view_dir.parent / f'{out_name}.json'
+        with open(json_file, 'r') as f:
+            sidecar = json.load(f)
+        sidecar['PhaseEncodingDirection'] = 'j'
+        with open(json_file, 'w') as f:
+            json.dump(sidecar, f, indent=2)
+
+    return direction, returncode
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "convert the blip up and blip down halves of a Siemens DWI series"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("raw_dwi_dir", help="nih_diff_2mm_45vol directory")
+    parser.add_argument("dwi_dir", help="BIDS dwi directory of the session")
+    parser.add_argument("stem", help="output name up to _dir-, e.g. sub-p001_ses-research_acq-Siemens")
+    parser.add_argument("--directions", nargs="+", choices=list(DIRECTION_PATTERNS),
+                        default=list(DIRECTION_PATTERNS), help="directions to convert")
+
+    args = parser.parse_args()
+
+    dwi_dir = Path(args.dwi_dir)
+    out_names = {direction: f'{args.stem}_dir-{direction}_dwi' for direction in args.directions}
+    # directions already in the BIDS tree are not converted again
+    todo = [direction for direction in args.directions
+            if not (dwi_dir / f'{out_names[direction]}.nii.gz').is_file()]
+    if not todo:
+        sys.exit()
+
+    views = split_series(args.raw_dwi_dir, todo)
+    for direction in todo:
+        if not views[direction][0]:
+            print(Colors.RED, f"++ No blip {direction} files in {args.raw_dwi_dir} ++", Colors.END)
+            sys.exit(1)
+
+    subject, session = args.stem.split('_')[:2]
+    labels = {'subject': subject[len('sub-'):], 'session': session[len('ses-'):]}
+
+    with scratch_dir(prefix='dwi_') as scratch:
+        for direction in todo:
+            link_view(*views[direction], scratch / direction)
+
+        with ThreadPoolExecutor(max_workers=len(todo)) as pool:
+            results = list(pool.map(lambda d: convert_direction(scratch / d, out_names[d], d, labels), todo))
+
+        failed = False
+        for direction, returncode in results:
+            if returncode != 0:
+                failed = True
+                print(Colors.RED, f"++ dcm2niix_afni failed for blip {direction} "
+                      f"(see {logs_dir}/dcm2niix_{out_names[direction]}.log) ++", Colors.END)
+                continue
+            # publish image and sidecar (.bvec and .bval files are already in bids_root directory)
+            for suffix in ('.json', '.nii.gz'):
+                publish(scratch / f'{out_names[direction]}{suffix}', dwi_dir / f'{out_names[direction]}{suffix}')
+            print(Colors.GREEN, f"++ Converted blip {direction} to {out_names[direction]}.nii.gz ++", Colors.END)
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Node-local scratch staging for conversion steps. Work happens in /dev/shm
+(when the job fits) or $TMPDIR, and only finished outputs are published into
+the BIDS/sourcedata tree on the share with an atomic rename.
+"""
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import ctypes
+import errno
+import os
+from pathlib import Path
+import shutil
+import sys
+import tempfile
+
+# /dev/shm is only used if it keeps this much free space after the job
+SHM_HEADROOM = 2 * 1024**3
+# outputs (uncompressed intermediates etc.) are assumed to be this many times
+# larger than the staged inputs
+SIZE_FACTOR = 3
+# renameat2(2) flag and the "current directory" fd for its path arguments
+RENAME_EXCHANGE = 2
+AT_FDCWD = -100
+
+
+def dir_size(path):
+    """Total size in bytes of the files below path."""
+
+    total = 0
+    stack = [str(path)]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    total += entry.stat().st_size
+
+    return total
+
+
+def scratch_base(size_hint=0):
+    """Pick the scratch base directory for a job of roughly size_hint bytes.
+
+    BIDS_PROC_SCRATCH forces a location; otherwise /dev/shm is used when the
+    job fits with headroom to spare, then $TMPDIR, then the system default.
+    """
+
+    if os.environ.get("BIDS_PROC_SCRATCH"):
+        return Path(os.environ["BIDS_PROC_SCRATCH"])
+
+    shm = Path("/dev/shm")
+    if size_hint and shm.is_dir() and os.access(shm, os.W_OK):
+        if shutil.disk_usage(shm).free > size_hint * SIZE_FACTOR + SHM_HEADROOM:
+            return shm
+
+    return Path(tempfile.gettempdir())
+
+
+def make_scratch(prefix='bids_proc_', size_hint=0):
+    """Create and return a new scratch directory."""
+
+    base = scratch_base(size_hint)
+    base.mkdir(parents=True, exist_ok=True)
+
+    return Path(tempfile.mkdtemp(prefix=prefix, dir=base))
+
+
+@contextmanager
+def scratch_dir(prefix='bids_proc_', size_hint=0):
+    """Context manager yielding a scratch directory that is removed on exit."""
+
+    path = make_scratch(prefix, size_hint)
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def publish(src, dst):
+    """Atomically place src at dst.
+
+    src is renamed directly when it is on the same filesystem; otherwise it is
+    copied to a hidden partial file next to dst, flushed, and renamed over dst
+    so readers never see a half-written output.
+    """
+
+    src, dst = Path(src), Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+
+    try:
+        os.replace(src, dst)
+        return dst
+    except OSError as e:
+        # only a rename across filesystems falls back to copying
+        if e.errno != errno.EXDEV:
+            raise
+
+    partial = dst.parent / f'.{dst.name}.partial-{os.getpid()}'
+    try:
+        with open(src, 'rb') as f_in, open(partial, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 16 * 1024**2)
+            f_out.flush()
+            os.fsync(f_out.fileno())
+        shutil.copystat(src, partial)
+        os.replace(partial, dst)
+    finally:
+        if partial.exists():
+            partial.unlink()
+    os.remove(src)
+
+    return dst
+
+
+def exchange(a, b):
+    """Swap two paths in one renameat2(RENAME_EXCHANGE) call.
+
+    Returns False where this is not supported (non-Linux, old C library, or a
+    filesystem without RENAME_EXCHANGE, e.g. some network shares).
+    """
+
+    if sys.platform != 'linux':
+        return False
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), 'renameat2', None)
+    if renameat2 is None:
+        return False
+
+    return renameat2(AT_FDCWD, os.fsencode(a), AT_FDCWD, os.fsencode(b), RENAME_EXCHANGE) == 0
+
+
+def replace_dir(src, dst):
+    """Put directory src in place of dst (same filesystem) and remove the old dst.
+
+    An existing dst is swapped with src atomically where the filesystem
+    allows it; otherwise it is renamed aside and src renamed in right after,
+    so dst is missing only between two renames.
+    """
+
+    src, dst = Path(src), Path(dst)
+    dst.parent.mkdir(parents=True, exist_ok=True)
+
+    if not dst.exists():
+        os.rename(src, dst)
+        return dst
+
+    if exchange(src, dst):
+        # src now holds the old tree
+        shutil.rmtree(src)
+        return dst
+
+    old = dst.with_name(f'.{dst.name}.old-{os.getpid()}')
+    os.rename(dst, old)
+    try:
+        os.rename(src, dst)
+    except OSError:
+        os.rename(old, dst)
+        raise
+    shutil.rmtree(old)
+
+    return dst
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "stage conversion work on node-local scratch (for use from shell scripts)"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    mkdir_parser = subparsers.add_parser("mkdir", help="create a scratch dir and print its path")
+    mkdir_parser.add_argument("--prefix", default="bids_proc_")
+    mkdir_parser.add_argument("--size_hint_dir", action="append", default=[],
+                              help="input directory used to estimate the job size")
+
+    publish_parser = subparsers.add_parser("publish", help="atomically move files into a directory")
+    publish_parser.add_argument("--into", required=True, help="destination directory")
+    publish_parser.add_argument("files", nargs="+")
+
+    args = parser.parse_args()
+
+    if args.command == "mkdir":
+        size_hint = sum(dir_size(d) for d in args.size_hint_dir if Path(d).is_dir())
+        print(make_scratch(args.prefix, size_hint))
+    elif args.command == "publish":
+        missing = [f for f in args.files if not Path(f).is_file()]
+        for f in args.files:
+            if Path(f).is_file():
+                publish(f, Path(args.into) / Path(f).name)
+        if missing:
+            sys.exit(f"++ Not published (missing): {' '.join(missing)} ++")
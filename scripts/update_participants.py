@@ -7,238 +7,187 @@ Created on Fri Apr 28 2023
 """
 
 from argparse import ArgumentParser
-from pathlib import Path
-import sys
 
 import pandas as pd
 
 from colors import Colors
+from neu_paths import bids_root
 
-# check OS
-if sys.platform == "darwin":
-    neu_dir = Path("/Volumes/Shares/NEU")
-elif sys.platform == "linux":
-    neu_dir = Path("/shares/NEU")
-else:
-    print(Colors.RED, f"++ Unrecognized OS '{sys.platform}'; please run on ",
-          "either linux or Mac OS ++", Colors.END)
-    sys.exit()
+participants_file = bids_root / 'participants.tsv'
 
-bids_root = neu_dir / 'Data'
+session_columns = [
+    'ses-clinical',
+    'ses-clinicalpostop',
+    'ses-research',
+    'ses-research_anat-t2fatsat',
+    'ses-research_dwi',
+    'ses-research_perf',
+    'ses-research_task-resteyesopen',
+    'ses-research_task-resteyesopen_physio',
+    'ses-research_task-resteyesclosed',
+    'ses-research_task-resteyesclosed_physio',
+    'ses-researchpostop',
+    'ses-researchpostop_anat-t2fatsat',
+    'ses-researchpostop_dwi',
+    'ses-researchpostop_perf',
+    'ses-researchpostop_task-resteyesopen',
+    'ses-researchpostop_task-resteyesopen_physio',
+    'ses-researchpostop_task-resteyesclosed',
+    'ses-researchpostop_task-resteyesclosed_physio',
+    'ses-meg',
+    'ses-meg_task-resteyesopen',
+    'ses-meg_task-resteyesclosed',
+    'ses-altclinical',
+    'ses-altclinical_anat-t1',
+    'ses-altclinical_anat-t2',
+    'ses-altclinical_anat-flair',
+    'ses-altclinicalpostop',
+    'ses-altclinicalpostop_anat-t1',
+    'ses-altclinicalpostop_anat-t2',
+    'ses-altclinicalpostop_anat-flair',
+]
+
+val_options_dict = {
+    'sex': [('M','F','n/a'),'M, F, n/a if unknown'],
+    'handedness': [('L','R','n/a'),'L, R, n/a if unknown']
+}
+
+def add_session_to_dict(session, new_dict, old_dict, pnum, verbose=True):
 
-def add_session_to_dict(session, new_dict, old_dict):
-    
     new_dict[session] = [1]
-    
-    if old_dict[session] == [0]:
+
+    if verbose and old_dict[session] == [0]:
         print(
             Colors.GREEN,
             f'Adding {session} to participants.tsv for {pnum}',
             Colors.END
         )
-        
+
     return new_dict
-    
 
-if __name__ == "__main__":
 
-    # parse arguments
-    purpose = "update participants.tsv with new subject"
-    parser = ArgumentParser(description=purpose)
-    parser.add_argument("pnum", help="subject p-number")
+def read_participants():
+    """Load participants.tsv as a dataframe."""
 
-    args = parser.parse_args()
-    pnum = args.pnum
-    
-    print(
-        Colors.YELLOW,
-        '++ Updating participants.tsv ... ++',
-        Colors.END
-    )
-    
-    df = pd.read_csv(
-        (bids_root / 'participants.tsv'),
+    return pd.read_csv(
+        participants_file,
         delimiter='\t',
         keep_default_na=False
     )
-    
+
+
+def empty_subject_dict(pnum):
+    """participants.tsv row for pnum with no sessions and unknown sex/handedness."""
+
     new_dict = {
         'participant_id':[f'sub-{pnum}'],
         'sex':['n/a'],
         'handedness':['n/a'],
-        'ses-clinical':[0],
-        'ses-clinicalpostop':[0],
-        'ses-research':[0],
-        'ses-research_anat-t2fatsat':[0],
-        'ses-research_dwi':[0],
-        'ses-research_perf':[0],
-        'ses-research_task-resteyesopen':[0],
-        'ses-research_task-resteyesopen_physio':[0],
-        'ses-research_task-resteyesclosed':[0],
-        'ses-research_task-resteyesclosed_physio':[0],
-        'ses-researchpostop':[0],
-        'ses-researchpostop_anat-t2fatsat':[0],
-        'ses-researchpostop_dwi':[0],
-        'ses-researchpostop_perf':[0],
-        'ses-researchpostop_task-resteyesopen':[0],
-        'ses-researchpostop_task-resteyesopen_physio':[0],
-        'ses-researchpostop_task-resteyesclosed':[0],
-        'ses-researchpostop_task-resteyesclosed_physio':[0],
-        'ses-meg':[0],
-        'ses-meg_task-resteyesopen':[0],
-        'ses-meg_task-resteyesclosed':[0],
-        'ses-altclinical':[0],
-        'ses-altclinical_anat-t1':[0],
-        'ses-altclinical_anat-t2':[0],
-        'ses-altclinical_anat-flair':[0],
-        'ses-altclinicalpostop':[0],
-        'ses-altclinicalpostop_anat-t1':[0],
-        'ses-altclinicalpostop_anat-t2':[0],
-        'ses-altclinicalpostop_anat-flair':[0],
     }
-    
-    if f'sub-{pnum}' in df.participant_id.unique():
-        is_new_subject = False
-        subj_df = df.loc[df.participant_id == f'sub-{pnum}']
-        old_dict = subj_df.to_dict('list')
-    else:
-        is_new_subject = True
-        old_dict = new_dict.copy()
-        
+    new_dict.update({session: [0] for session in session_columns})
+
+    return new_dict
+
+
+def scan_subject(pnum, old_dict, verbose=True):
+    """Build the participants.tsv row for pnum from its BIDS directory.
+
+    old_dict is the subject's current row (as returned by to_dict('list'));
+    sex and handedness are carried over from it.
+    """
+
+    new_dict = empty_subject_dict(pnum)
     new_dict['sex'] = old_dict['sex']
     new_dict['handedness'] = old_dict['handedness']
-    
-    val_options_dict = {
-        'sex': [('M','F','n/a'),'M, F, n/a if unknown'],
-        'handedness': [('L','R','n/a'),'L, R, n/a if unknown']
-    }
-    
+
+    def add_session(session):
+        add_session_to_dict(
+            session=session,
+            new_dict=new_dict,
+            old_dict=old_dict,
+            pnum=pnum,
+            verbose=verbose
+        )
+
     subj_path = bids_root / f'sub-{pnum}'
-    
+
     # update session values (1 if present)
     for ses_path in subj_path.glob('ses-*'):
         session = ses_path.stem
-        
+
         if session not in new_dict.keys():
             continue
-        
-        new_dict = add_session_to_dict(
-            session=session,
-            new_dict=new_dict,
-            old_dict=old_dict
-        )
-    
+
+        add_session(session)
+
     for ses_suffix in ('', 'postop'):
-        
+
         if new_dict[('ses-research' + ses_suffix)] == [1]:
-            
+
             # set paths
             ses_path = subj_path / ('ses-research' + ses_suffix)
             anat_path = ses_path / 'anat'
             dwi_path = ses_path / 'dwi'
             perf_path = ses_path / 'perf'
             func_path = ses_path / 'func'
-            
+
             # check for paths
             if len(list(anat_path.glob('*fatsat*T2w*'))) > 0:
-                add_session_to_dict(
-                    session=('ses-research' + ses_suffix + '_anat-t2fatsat'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
+                add_session('ses-research' + ses_suffix + '_anat-t2fatsat')
 
             if dwi_path.is_dir():
-                add_session_to_dict(
-                    session=('ses-research' + ses_suffix + '_dwi'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
+                add_session('ses-research' + ses_suffix + '_dwi')
 
             if perf_path.is_dir():
-                add_session_to_dict(
-                    session=('ses-research' + ses_suffix + '_perf'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
-                
+                add_session('ses-research' + ses_suffix + '_perf')
+
             if len(list(func_path.glob('*resteyesopen*'))) > 0:
-                add_session_to_dict(
-                    session=('ses-research' + ses_suffix + '_task-resteyesopen'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
-                
+                add_session('ses-research' + ses_suffix + '_task-resteyesopen')
+
             if len(list(func_path.glob('*resteyesopen*physio*'))) > 0:
-                add_session_to_dict(
-                    session=('ses-research' + ses_suffix + '_task-resteyesopen_physio'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
-        
+                add_session('ses-research' + ses_suffix + '_task-resteyesopen_physio')
+
             if len(list(func_path.glob('*resteyesclosed*'))) > 0:
-                add_session_to_dict(
-                    session=('ses-research' + ses_suffix + '_task-resteyesclosed'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
-            
+                add_session('ses-research' + ses_suffix + '_task-resteyesclosed')
+
             if len(list(func_path.glob('*resteyesclosed*physio*'))) > 0:
-                add_session_to_dict(
-                    session=('ses-research' + ses_suffix + '_task-resteyesclosed_physio'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
-        
+                add_session('ses-research' + ses_suffix + '_task-resteyesclosed_physio')
+
         # meg data will not occur postoperatively
         if ses_suffix == '':
             if new_dict[('ses-meg' + ses_suffix)] == [1]:
-                
+
                 ses_path = subj_path / ('ses-meg' + ses_suffix)
                 meg_path = ses_path / 'meg'
-                
+
                 if len(list(meg_path.glob('*resteyesopen*'))) > 0:
-                    add_session_to_dict(
-                        session=('ses-meg' + ses_suffix + '_task-resteyesopen'),
-                        new_dict=new_dict,
-                        old_dict=old_dict
-                    )
-            
+                    add_session('ses-meg' + ses_suffix + '_task-resteyesopen')
+
                 if len(list(meg_path.glob('*resteyesclosed*'))) > 0:
-                    add_session_to_dict(
-                        session=('ses-meg' + ses_suffix + '_task-resteyesclosed'),
-                        new_dict=new_dict,
-                        old_dict=old_dict
-                    )
-        
+                    add_session('ses-meg' + ses_suffix + '_task-resteyesclosed')
+
         if new_dict[('ses-altclinical' + ses_suffix)] == [1]:
-            
+
             ses_path = subj_path / ('ses-altclinical' + ses_suffix)
             anat_path = ses_path / 'anat'
 
             if len(list(anat_path.glob('*T1w*'))) > 0:
-                add_session_to_dict(
-                    session=('ses-altclinical' + ses_suffix + '_anat-t1'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
-                
+                add_session('ses-altclinical' + ses_suffix + '_anat-t1')
+
             if len(list(anat_path.glob('*T2w*'))) > 0:
-                add_session_to_dict(
-                    session=('ses-altclinical' + ses_suffix + '_anat-t2'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
-                
+                add_session('ses-altclinical' + ses_suffix + '_anat-t2')
+
             if len(list(anat_path.glob('*FLAIR*'))) > 0:
-                add_session_to_dict(
-                    session=('ses-altclinical' + ses_suffix + '_anat-flair'),
-                    new_dict=new_dict,
-                    old_dict=old_dict
-                )
-    
-    # request user for missing values
+                add_session('ses-altclinical' + ses_suffix + '_anat-flair')
+
+    return new_dict
+
+
+def prompt_missing_values(pnum, new_dict):
+    """Ask the user for sex/handedness values that are still n/a."""
+
     for key, val in new_dict.items():
-    
+
         if val == ['n/a']:
             new_val = input(
                 f'Please enter {key} for {pnum} (options are {val_options_dict[key][1]}):\n'
@@ -257,30 +206,63 @@ if __name__ == "__main__":
                     f'Failed to enter correct option. Setting {key} to n/a.',
                     Colors.END
                 )
-    
+
+    return new_dict
+
+
+def write_subject(pnum, new_dict):
+    """Replace (or add) the row for pnum in participants.tsv."""
+
     # load again in case it has been modified while script is running
-    df = pd.read_csv(
-        (bids_root / 'participants.tsv'),
-        delimiter='\t',
-        keep_default_na=False
-    )
-    
+    df = read_participants()
+
     # delete old version from df
-    if not is_new_subject:
-        df.drop(df.loc[df.participant_id == f'sub-{pnum}'].index, inplace=True)
-    
+    df.drop(df.loc[df.participant_id == f'sub-{pnum}'].index, inplace=True)
+
     append_df = pd.DataFrame(new_dict)
     out_df = pd.concat([df,append_df], ignore_index=True)
-    
+
     out_df.sort_values(
         by='participant_id',
         inplace=True,
         ascending=True,
         ignore_index=True
     )
-    
+
     out_df.to_csv(
-        (bids_root / 'participants.tsv'),
+        participants_file,
         sep='\t',
         index=False
-    )
\ No newline at end of file
+    )
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "update participants.tsv with new subject"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("pnum", help="subject p-number")
+
+    args = parser.parse_args()
+    pnum = args.pnum
+
+    print(
+        Colors.YELLOW,
+        '++ Updating participants.tsv ... ++',
+        Colors.END
+    )
+
+    df = read_participants()
+
+    if f'sub-{pnum}' in df.participant_id.unique():
+        subj_df = df.loc[df.participant_id == f'sub-{pnum}']
+        old_dict = subj_df.to_dict('list')
+    else:
+        old_dict = empty_subject_dict(pnum)
+
+    new_dict = scan_subject(pnum, old_dict)
+
+    # request user for missing values
+    new_dict = prompt_missing_values(pnum, new_dict)
+
+    write_subject(pnum, new_dict)
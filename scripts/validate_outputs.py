@@ -0,0 +1,376 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Header-only validation of the NIfTI outputs in the BIDS tree. Only the first
+348 bytes of each image are read (streamed through gzip) together with its
+JSON sidecar, and the gzip trailer gives the uncompressed size, so a
+truncated image is caught without decompressing it. Files are read in a
+thread pool and the extracted facts are cached by the size and mtime of the
+image and its sidecars, so a nightly run only reads what changed.
+
+The facts are checked against files/expected_protocol.json, where each rule
+matches file names with 'pattern' and may give 'ndim' (number or list),
+'n_volumes' (a number, or 'aslcontext' for the rows of the aslcontext.tsv
+next to the image), 'min_volumes', 'sidecar' (required keys) and 'echoes'
+(images per multi-echo run, which must also agree in length and have
+increasing echo times). IntendedFor entries must point at existing files.
+"""
+
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import csv
+from fnmatch import fnmatchcase
+import gzip
+import json
+import math
+import os
+from pathlib import Path
+import re
+import struct
+import sys
+
+from colors import Colors
+from neu_paths import bids_root, derivatives_dir, files_dir
+
+protocol_file = files_dir / 'expected_protocol.json'
+validation_dir = derivatives_dir / 'output_validation'
+cache_file = validation_dir / 'header_cache.json'
+# bump when the cached facts change so that old caches are rebuilt
+CACHE_VERSION = 1
+NIFTI_EXTENSIONS = ('.nii.gz', '.nii')
+NIFTI1_MAGICS = (b'n+1\0', b'ni1\0')
+NIFTI2_MAGICS = (b'n+2\0\r\n\x1a\n', b'ni2\0\r\n\x1a\n')
+ECHO_RE = re.compile(r'_echo-(\d+)')
+REPORT_COLUMNS = ['file', 'rule', 'problem']
+
+
+def load_protocol(path=protocol_file):
+    """rule name -> rule from expected_protocol.json."""
+
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def match_rule(name, protocol):
+    """(rule name, rule) of the first rule whose pattern matches name, else (None, None)."""
+
+    for rule_name, rule in protocol.items():
+        if fnmatchcase(name, rule['pattern']):
+            return rule_name, rule
+
+    return None, None
+
+
+def companion_files(nifti_file):
+    """Files whose content the facts of nifti_file depend on (its sidecar and aslcontext)."""
+
+    nifti_file = str(nifti_file)
+    stem = nifti_file[:-len('.nii.gz')] if nifti_file.endswith('.gz') else nifti_file[:-len('.nii')]
+    companions = [f'{stem}.json']
+    if stem.endswith('_asl'):
+        companions.append(f'{stem[:-len("_asl")]}_aslcontext.tsv')
+
+    return companions
+
+
+def identity(nifti_file):
+    """[size, mtime] of the image and each companion (None where missing)."""
+
+    ident = []
+    for path in [nifti_file] + companion_files(nifti_file):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            ident.append(None)
+            continue
+        ident.append([st.st_size, st.st_mtime_ns])
+
+    return ident
+
+
+def parse_header(hdr):
+    """(ndim, shape, zooms, bitpix, vox_offset) from the start of a NIfTI-1 or NIfTI-2 file."""
+
+    for endian in '<>':
+        if len(hdr) < 4:
+            break
+        sizeof_hdr = struct.unpack(f'{endian}i', hdr[:4])[0]
+        if sizeof_hdr == 348 and len(hdr) >= 348 and hdr[344:348] in NIFTI1_MAGICS:
+            dim = struct.unpack(f'{endian}8h', hdr[40:56])
+            bitpix = struct.unpack(f'{endian}h', hdr[72:74])[0]
+            pixdim = struct.unpack(f'{endian}8f', hdr[76:108])
+            vox_offset = struct.unpack(f'{endian}f', hdr[108:112])[0]
+            break
+        if sizeof_hdr == 540 and len(hdr) >= 540 and hdr[4:12] in NIFTI2_MAGICS:
+            bitpix = struct.unpack(f'{endian}h', hdr[14:16])[0]
+            dim = struct.unpack(f'{endian}8q', hdr[16:80])
+            pixdim = struct.unpack(f'{endian}8d', hdr[104:168])
+            vox_offset = struct.unpack(f'{endian}q', hdr[168:176])[0]
+            break
+    else:
+        raise ValueError('not a NIfTI header')
+    if not 1 <= dim[0] <= 7:
+        raise ValueError(f'invalid dim[0] {dim[0]}')
+    ndim = dim[0]
+
+    return ndim, list(dim[1:ndim + 1]), [round(z, 6) for z in pixdim[1:ndim + 1]], bitpix, int(vox_offset)
+
+
+def stored_size(nifti_file):
+    """Uncompressed size of the image (modulo 2**32 for .gz, from the gzip trailer)."""
+
+    if not str(nifti_file).endswith('.gz'):
+        return os.stat(nifti_file).st_size
+    with open(nifti_file, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return struct.unpack('<I', f.read(4))[0]
+
+
+def read_facts(nifti_file):
+    """What the checks need to know about an image: header fields, size check and sidecars."""
+
+    facts = {}
+    opener = gzip.open if str(nifti_file).endswith('.gz') else open
+    try:
+        with opener(nifti_file, 'rb') as f:
+            hdr = f.read(348)
+            if hdr[:4] in (struct.pack('<i', 540), struct.pack('>i', 540)):
+                hdr += f.read(540 - 348)
+        ndim, shape, zooms, bitpix, vox_offset = parse_header(hdr)
+        expected = vox_offset + math.prod(shape) * bitpix // 8
+        size = stored_size(nifti_file)
+        size_ok = size == expected % 2**32 if str(nifti_file).endswith('.gz') else size >= expected
+        facts.update(ndim=ndim, shape=shape, zooms=zooms, size_ok=size_ok)
+    except (OSError, EOFError, ValueError, struct.error) as e:
+        facts['error'] = f'unreadable header ({e})'
+
+    sidecar_file, *others = companion_files(nifti_file)
+    try:
+        with open(sidecar_file, 'r') as f:
+            facts['sidecar'] = json.load(f)
+    except FileNotFoundError:
+        facts['sidecar'] = None
+    except ValueError as e:
+        facts['sidecar'] = None
+        facts['sidecar_error'] = f'invalid JSON sidecar ({e})'
+    if others:
+        try:
+            with open(others[0], 'r') as f:
+                facts['aslcontext_rows'] = max(sum(1 for line in f if line.strip()) - 1, 0)
+        except FileNotFoundError:
+            facts['aslcontext_rows'] = None
+
+    return facts
+
+
+def read_cache():
+
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+
+    return cache['files']
+
+
+def write_cache(entries):
+
+    validation_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = cache_file.with_name(f'{cache_file.name}.{os.getpid()}.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump({'version': CACHE_VERSION, 'files': entries}, f, separators=(',', ':'))
+    os.replace(tmp_file, cache_file)
+
+
+def find_niftis(subject_dirs):
+    """NIfTI images below the subject directories."""
+
+    nifti_files = []
+    for subject_dir in subject_dirs:
+        for root, dirs, names in os.walk(subject_dir):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            nifti_files += [os.path.join(root, name) for name in names if name.endswith(NIFTI_EXTENSIONS)]
+
+    return sorted(nifti_files)
+
+
+def collect_facts(subject_dirs, rescan=False, n_jobs=16):
+    """path (relative to the BIDS root) -> facts for every image below subject_dirs.
+
+    Only images whose size or mtime (or their sidecars') changed since the
+    cached run are read.
+    """
+
+    nifti_files = find_niftis(subject_dirs)
+    cached = {} if rescan else read_cache()
+
+    with ThreadPoolExecutor(max_workers=n_jobs) as pool:
+        identities = list(pool.map(identity, nifti_files))
+        keys = [os.path.relpath(path, bids_root) for path in nifti_files]
+        stale = [i for i, (key, ident) in enumerate(zip(keys, identities))
+                 if key not in cached or cached[key]['identity'] != ident]
+        new_facts = pool.map(read_facts, [nifti_files[i] for i in stale])
+        entries = {key: cached[key] for key in keys if key in cached}
+        for i, facts in zip(stale, new_facts):
+            entries[keys[i]] = {'identity': identities[i], 'facts': facts}
+
+    # keep the cache of subjects that were not scanned, forget removed images
+    scanned = tuple(f'{os.path.relpath(d, bids_root)}{os.sep}' for d in subject_dirs)
+    kept = {key: entry for key, entry in cached.items() if not key.startswith(scanned)}
+    if stale or set(keys) != {key for key in cached if key.startswith(scanned)}:
+        write_cache({**kept, **entries})
+
+    return {key: entries[key]['facts'] for key in keys}, len(stale)
+
+
+def n_volumes(facts):
+
+    return facts['shape'][3] if facts['ndim'] >= 4 else 1
+
+
+def check_file(facts, rule):
+    """Problems of one image against its protocol rule."""
+
+    if 'error' in facts:
+        return [facts['error']]
+
+    problems = []
+    if not facts['size_ok']:
+        problems.append('image data does not match the header size (truncated?)')
+    if any(z <= 0 for z in facts['zooms'][:3]):
+        problems.append(f"invalid voxel size {facts['zooms'][:3]}")
+    if facts.get('sidecar_error'):
+        problems.append(facts['sidecar_error'])
+    if rule is None:
+        return problems
+
+    allowed = rule.get('ndim')
+    if allowed is not None and facts['ndim'] not in (allowed if isinstance(allowed, list) else [allowed]):
+        problems.append(f"{facts['ndim']}D image (expected {allowed}D)")
+
+    expected = rule.get('n_volumes')
+    if expected == 'aslcontext':
+        expected = facts.get('aslcontext_rows')
+        if expected is None:
+            problems.append('no aslcontext.tsv')
+    if isinstance(expected, int) and n_volumes(facts) != expected:
+        problems.append(f'{n_volumes(facts)} volumes (expected {expected})')
+    if n_volumes(facts) < rule.get('min_volumes', 0):
+        problems.append(f"{n_volumes(facts)} volumes (expected at least {rule['min_volumes']})")
+
+    if rule.get('sidecar'):
+        if facts['sidecar'] is None:
+            if not facts.get('sidecar_error'):
+                problems.append('no JSON sidecar')
+        else:
+            missing = [key for key in rule['sidecar'] if key not in facts['sidecar']]
+            if missing:
+                problems.append(f"sidecar lacks {', '.join(missing)}")
+
+    return problems
+
+
+def check_echoes(run_facts, n_echoes):
+    """Problems of one multi-echo run: {echo number: facts}."""
+
+    problems = []
+    if sorted(run_facts) != list(range(1, n_echoes + 1)):
+        problems.append(f'echoes {sorted(run_facts)} (expected 1-{n_echoes})')
+
+    readable = {echo: facts for echo, facts in sorted(run_facts.items()) if 'error' not in facts}
+    if len({n_volumes(facts) for facts in readable.values()}) > 1:
+        problems.append(f"echo lengths differ ({', '.join(str(n_volumes(f)) for f in readable.values())})")
+    echo_times = [(facts['sidecar'] or {}).get('EchoTime') for facts in readable.values()]
+    if None not in echo_times and echo_times != sorted(set(echo_times)):
+        problems.append(f'echo times not increasing ({echo_times})')
+
+    return problems
+
+
+def intended_for_target(key, target):
+    """Path (relative to the BIDS root) of an IntendedFor entry of the image at key."""
+
+    if target.startswith('bids::'):
+        return target[len('bids::'):]
+
+    # older entries are relative to the subject directory
+    return os.path.join(Path(key).parts[0], target)
+
+
+def validate(all_facts, protocol):
+    """(file, rule, problem) rows for every problem found."""
+
+    rows = []
+    runs = {}
+    for key, facts in all_facts.items():
+        rule_name, rule = match_rule(os.path.basename(key), protocol)
+        rows += [(key, rule_name or '', problem) for problem in check_file(facts, rule)]
+
+        if rule and rule.get('echoes') and 'error' not in facts:
+            match = ECHO_RE.search(key)
+            if match:
+                run_key = (ECHO_RE.sub('', key), rule_name, rule['echoes'])
+                runs.setdefault(run_key, {})[int(match.group(1))] = facts
+
+        intended_for = (facts.get('sidecar') or {}).get('IntendedFor') or []
+        for target in [intended_for] if isinstance(intended_for, str) else intended_for:
+            target_key = intended_for_target(key, target)
+            if target_key not in all_facts and not (bids_root / target_key).exists():
+                rows.append((key, rule_name or '', f'IntendedFor target {target} does not exist'))
+
+    for (run_key, rule_name, n_echoes), run_facts in sorted(runs.items()):
+        rows += [(run_key, rule_name, problem) for problem in check_echoes(run_facts, n_echoes)]
+
+    return rows
+
+
+def write_report(report_file, rows):
+
+    report_file = Path(report_file)
+    report_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = report_file.with_name(f'.{report_file.name}.tmp')
+    with open(tmp_file, 'w', newline='') as f:
+        writer = csv.writer(f, delimiter='\t')
+        writer.writerow(REPORT_COLUMNS)
+        writer.writerows(rows)
+    os.replace(tmp_file, report_file)
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "check NIfTI headers and sidecars in the BIDS tree against the expected protocol"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("--subjects", nargs="+", help="p-numbers or sub-* ids (default: all subjects)")
+    parser.add_argument("--rescan", action="store_true", help="ignore the cached headers")
+    parser.add_argument("--n_jobs", type=int, default=16, help="files read in parallel")
+    parser.add_argument("--report", default=validation_dir / 'validation_report.tsv',
+                        help="TSV of the problems found")
+
+    args = parser.parse_args()
+
+    if args.subjects:
+        subject_dirs = [bids_root / (s if s.startswith('sub-') else f'sub-{s}') for s in args.subjects]
+        for subject_dir in subject_dirs:
+            if not subject_dir.is_dir():
+                print(Colors.YELLOW, f"++ {subject_dir.name} has no BIDS directory ++", Colors.END)
+        subject_dirs = [d for d in subject_dirs if d.is_dir()]
+    else:
+        subject_dirs = sorted(d for d in bids_root.glob('sub-*') if d.is_dir())
+
+    all_facts, n_read = collect_facts(subject_dirs, rescan=args.rescan, n_jobs=args.n_jobs)
+    rows = validate(all_facts, load_protocol())
+    write_report(args.report, rows)
+
+    for key, rule_name, problem in rows:
+        print(Colors.RED, f"++ {key}: {problem} ++", Colors.END)
+    color = Colors.RED if rows else Colors.GREEN
+    print(color, f"++ {len(all_facts)} images checked ({n_read} headers read), "
+                 f"{len(rows)} problem(s); report in {args.report} ++", Colors.END)
+    if rows:
+        sys.exit(1)
@@ -0,0 +1,543 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Watch Raw_Data for new scans and queue the stage jobs they need. Every poll
+lists the Raw_Data folder types and subject folders once; a raw session
+(research session date, clinical mri folder, altclinical or MEG subject
+folder) that is new or whose folder changed is walked until its file count,
+size and newest mtime stay the same for --settle seconds. It is then planned
+with the plan_cohort.py rules and only its missing subject/session/stage jobs
+are appended to a JSONL queue, which `watch_raw.py run` works through.
+
+On Linux the raw folders are also watched with inotify (through ctypes, no
+extra packages) so that a poll starts as soon as something is created. Writes
+made from other hosts on a network share raise no inotify events, so the
+polling interval remains the upper bound on the latency.
+"""
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import ctypes
+import ctypes.util
+from datetime import datetime
+import errno
+import fcntl
+import json
+import os
+import select
+import shlex
+import socket
+import struct
+import sys
+import time
+
+from colors import Colors
+from instrument import logs_dir, run_command
+from neu_paths import (folder_types, pnum_key, raw_altclinical_dir,
+                       raw_clinical_dir, raw_meg_dir, raw_research_dir,
+                       read_key, scripts_dir)
+from plan_cohort import (index_bids_subject, plan_clinical_session, plan_meg,
+                         plan_research_session)
+
+queue_file = logs_dir / 'raw_queue.jsonl'
+failed_file = logs_dir / 'raw_queue_failed.jsonl'
+# jobs taken off the queue by a runner and not finished yet
+running_file = logs_dir / 'raw_queue_running.jsonl'
+state_file = logs_dir / 'watch_raw_state.json'
+
+RAW_ROOTS = {
+    'research': raw_research_dir,
+    'clinical': raw_clinical_dir,
+    'altclinical': raw_altclinical_dir,
+    'meg': raw_meg_dir,
+}
+FOLDER_TYPES = ('Patients', 'Post-op', 'Healthy_Volunteers')
+# bump when the state layout changes so that old state files are rebuilt
+STATE_VERSION = 1
+
+# inotify(7) constants
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_MODIFY | IN_ONLYDIR
+EVENT = struct.Struct('iIII')
+# seconds to keep collecting events after the first one before polling
+EVENT_COALESCE = 2
+
+
+class Inotify:
+    """Minimal inotify wrapper used to wake the poll loop early (Linux only)."""
+
+    def __init__(self):
+        libc_name = ctypes.util.find_library('c')
+        if sys.platform != 'linux' or not libc_name:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.libc = ctypes.CDLL(libc_name, use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.paths = {}  # path -> watch descriptor
+        self.full = False
+
+    def add(self, path):
+        """Watch a directory (no-op if it is watched or the watch limit was reached)."""
+
+        path = str(path)
+        if path in self.paths or self.full:
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd >= 0:
+            self.paths[path] = wd
+        elif ctypes.get_errno() == errno.ENOSPC:
+            self.full = True
+            print(Colors.YELLOW, f"++ inotify watch limit reached after {len(self.paths)} folders; "
+                  "the remaining folders are only polled ++", Colors.END)
+
+    def read_events(self):
+        """Drain pending events; returns True if any arrived."""
+
+        seen = False
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return seen
+            seen = True
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _, name_len = EVENT.unpack_from(buf, offset)
+                offset += EVENT.size + name_len
+                if mask & IN_IGNORED:
+                    # the folder was removed; forget it so that it can be watched again
+                    self.paths = {path: w for path, w in self.paths.items() if w != wd}
+
+    def wait(self, timeout):
+        """Block until an event arrives or timeout seconds pass."""
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if readable and self.read_events():
+            time.sleep(EVENT_COALESCE)
+            self.read_events()
+
+    def close(self):
+
+        os.close(self.fd)
+
+
+def scan_subdirs(path):
+    """name -> mtime_ns of the sub-directories of path (empty if it does not exist)."""
+
+    try:
+        with os.scandir(path) as it:
+            return {entry.name: entry.stat().st_mtime_ns for entry in it if entry.is_dir()}
+    except (FileNotFoundError, NotADirectoryError):
+        return {}
+
+
+def tree_signature(path):
+    """[n_files, total bytes, newest mtime_ns] of everything below path."""
+
+    n_files, n_bytes, newest = 0, 0, 0
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                        continue
+                    try:
+                        st = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    n_files += 1
+                    n_bytes += st.st_size
+                    newest = max(newest, st.st_mtime_ns)
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+
+    return [n_files, n_bytes, newest]
+
+
+def discover_sessions(modalities, inotify=None):
+    """(modality, folder_type, subject name, session folder) -> (raw session dir, mtime_ns)."""
+
+    sessions = {}
+    for modality in modalities:
+        for folder_type in FOLDER_TYPES:
+            type_dir = RAW_ROOTS[modality] / folder_type
+            if inotify:
+                inotify.add(type_dir)
+            for subj_name, mtime_ns in scan_subdirs(type_dir).items():
+                subj_dir = type_dir / subj_name
+                if modality == 'research':
+                    if inotify:
+                        inotify.add(subj_dir)
+                    for session_date, date_mtime_ns in scan_subdirs(subj_dir).items():
+                        sessions[(modality, folder_type, subj_name, session_date)] = (
+                            subj_dir / session_date, date_mtime_ns
+                        )
+                elif modality == 'clinical':
+                    mri = scan_subdirs(subj_dir).get('mri')
+                    if mri is not None:
+                        sessions[(modality, folder_type, subj_name, 'mri')] = (subj_dir / 'mri', mri)
+                else:
+                    sessions[(modality, folder_type, subj_name, '')] = (subj_dir, mtime_ns)
+
+    if inotify:
+        for raw_session_dir, _ in sessions.values():
+            inotify.add(raw_session_dir)
+
+    return sessions
+
+
+def name_to_pnum():
+    """(subject name, folder_type) -> p-number from the 14N0061 key."""
+
+    lookup = {}
+    for pnum, subj_name in read_key(pnum_key).items():
+        for folder_type in folder_types(pnum):
+            lookup[(subj_name, folder_type)] = pnum
+
+    return lookup
+
+
+def plan_session(modality, folder_type, pnum, subj_name, raw_session_dir):
+    """Pending jobs of one raw session."""
+
+    bids_index = index_bids_subject(pnum)
+    if modality == 'research':
+        return plan_research_session(pnum, folder_type, raw_session_dir, bids_index, set())
+    if modality == 'meg':
+        return plan_meg(pnum, folder_type, raw_session_dir, bids_index, set())
+
+    return plan_clinical_session(pnum, folder_type, subj_name, modality, raw_session_dir, bids_index, set())
+
+
+def participants_job(pnum):
+    """update_participants.py job queued after a subject's stage jobs, as in bids_proc.sh."""
+
+    script = scripts_dir / 'update_participants.py'
+    return {
+        'subject': pnum,
+        'session': '',
+        'stage': 'update_participants',
+        'detail': '',
+        'raw': '',
+        'command': ' '.join(shlex.quote(str(a)) for a in ('python', script, pnum)),
+    }
+
+
+def job_key(job):
+
+    return job['subject'], job['session'], job['stage'], job['raw']
+
+
+@contextmanager
+def locked_jobs(path):
+    """Yield the jobs in a JSONL file for modification and save them atomically on exit."""
+
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    with open(path.with_suffix('.lock'), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        jobs = read_queue(path)
+        yield jobs
+        tmp_file = path.with_name(f'{path.name}.{os.getpid()}.tmp')
+        with open(tmp_file, 'w') as f:
+            for job in jobs:
+                f.write(json.dumps(job) + '\n')
+        os.replace(tmp_file, path)
+
+
+def locked_queue():
+
+    return locked_jobs(queue_file)
+
+
+def read_queue(path=queue_file):
+
+    if not path.is_file():
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def enqueue(new_jobs):
+    """Append jobs that are not queued yet; returns the number added."""
+
+    with locked_queue() as jobs:
+        queued = {job_key(job) for job in jobs}
+        added = 0
+        for job in new_jobs:
+            if job_key(job) in queued:
+                if job['stage'] == 'update_participants':
+                    # keep it behind the subject's newly queued stage jobs
+                    jobs.append(jobs.pop([job_key(j) for j in jobs].index(job_key(job))))
+                continue
+            queued.add(job_key(job))
+            jobs.append(dict(job, queued=datetime.now().isoformat(timespec='seconds')))
+            added += 1
+
+    return added
+
+
+def pop_job():
+    """Move the first queued job to the running list and return it (None if the queue is empty)."""
+
+    # lock order is always queue, then running
+    with locked_queue() as jobs:
+        if not jobs:
+            return None
+        job = dict(jobs.pop(0), host=socket.gethostname(), pid=os.getpid(),
+                   started=datetime.now().isoformat(timespec='seconds'))
+        with locked_jobs(running_file) as running:
+            running.append(job)
+    return job
+
+
+def finish_job(job):
+    """Drop a job from the running list once its exit status is known."""
+
+    with locked_jobs(running_file) as running:
+        running[:] = [j for j in running if (j['host'], j['pid'], job_key(j)) != (job['host'], job['pid'], job_key(job))]
+
+
+def pid_alive(pid):
+
+    try:
+        os.kill(int(pid), 0)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def requeue_interrupted():
+    """Put the running jobs of dead runners on this host back at the front of the queue."""
+
+    host = socket.gethostname()
+    with locked_queue() as jobs:
+        with locked_jobs(running_file) as running:
+            interrupted = [j for j in running if j['host'] == host and not pid_alive(j['pid'])]
+            running[:] = [j for j in running if j not in interrupted]
+        queued = {job_key(job) for job in jobs}
+        requeued = [{k: v for k, v in j.items() if k not in ('host', 'pid', 'started')}
+                    for j in interrupted if job_key(j) not in queued]
+        jobs[:0] = requeued
+
+    for job in requeued:
+        print(Colors.YELLOW, f"++ Requeued interrupted {job['stage']} for {job['subject']} ({job['detail']}) ++", Colors.END)
+    return len(requeued)
+
+
+def read_state():
+
+    try:
+        with open(state_file, 'r') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if state.get('version') != STATE_VERSION:
+        return None
+
+    return state['sessions']
+
+
+def write_state(sessions):
+
+    logs_dir.mkdir(parents=True, exist_ok=True)
+    tmp_file = state_file.with_name(f'{state_file.name}.{os.getpid()}.tmp')
+    with open(tmp_file, 'w') as f:
+        json.dump({'version': STATE_VERSION, 'sessions': sessions}, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, state_file)
+
+
+def poll(state, modalities, settle, inotify=None):
+    """Update the per-session state from one listing of Raw_Data; returns the sessions that settled.
+
+    state maps raw session paths to {'mtime_ns', 'status', 'signature', 'changed'}.
+    A session is 'done' until its folder mtime changes, then 'pending' until
+    its signature has not changed for settle seconds.
+    """
+
+    now = time.time()
+    sessions = discover_sessions(modalities, inotify)
+    settled = []
+    seen = set()
+    for key, (raw_session_dir, mtime_ns) in sessions.items():
+        path = str(raw_session_dir)
+        seen.add(path)
+        entry = state.get(path)
+        if entry is None or (entry['status'] == 'done' and entry['mtime_ns'] != mtime_ns):
+            entry = state[path] = {'mtime_ns': mtime_ns, 'status': 'pending', 'signature': None, 'changed': now}
+        if entry['status'] != 'pending':
+            continue
+
+        signature = tree_signature(raw_session_dir)
+        if signature != entry['signature']:
+            entry.update(signature=signature, changed=now, mtime_ns=mtime_ns)
+        elif signature[0] and now - entry['changed'] >= settle:
+            entry['mtime_ns'] = mtime_ns
+            settled.append((key, raw_session_dir))
+
+    # forget sessions that were removed from the watched Raw_Data folders
+    roots = tuple(f'{RAW_ROOTS[modality]}{os.sep}' for modality in modalities)
+    for path in set(state) - seen:
+        if path.startswith(roots):
+            del state[path]
+
+    return settled
+
+
+def queue_settled(state, settled):
+    """Plan and queue the jobs of the settled sessions."""
+
+    lookup = name_to_pnum()
+    subjects = []
+    new_jobs = []
+    for (modality, folder_type, subj_name, _), raw_session_dir in settled:
+        entry = state[str(raw_session_dir)]
+        pnum = lookup.get((subj_name, folder_type))
+        if pnum is None:
+            # stays pending so that it is queued once the key lists the subject
+            if not entry.get('unknown'):
+                print(Colors.YELLOW, f"++ {subj_name} ({raw_session_dir}) is not in the key ++", Colors.END)
+            entry['unknown'] = True
+            continue
+
+        entry.pop('unknown', None)
+        entry['status'] = 'done'
+        jobs = plan_session(modality, folder_type, pnum, subj_name, raw_session_dir)
+        if not jobs:
+            print(Colors.GREEN, f"++ {raw_session_dir} settled; nothing to convert for {pnum} ++", Colors.END)
+            continue
+        for job in jobs:
+            print(Colors.GREEN, f"++ Queued {job['stage']} ({job['detail']}) for {pnum} ++", Colors.END)
+        new_jobs += jobs
+        if pnum not in subjects:
+            subjects.append(pnum)
+
+    new_jobs += [participants_job(pnum) for pnum in subjects]
+    if new_jobs:
+        enqueue(new_jobs)
+
+
+def watch(modalities, interval, settle, backfill=False, once=False, use_inotify=True):
+    """Poll Raw_Data (waking early on inotify events) and queue jobs for settled sessions."""
+
+    state = read_state()
+    if state is None:
+        state = {}
+        if not backfill:
+            # first run: sessions already in Raw_Data are the baseline, not new scans
+            for raw_session_dir, mtime_ns in discover_sessions(modalities).values():
+                state[str(raw_session_dir)] = {'mtime_ns': mtime_ns, 'status': 'done',
+                                               'signature': None, 'changed': time.time()}
+            write_state(state)
+            print(Colors.GREEN, f"++ Recorded {len(state)} existing raw sessions as the baseline ++", Colors.END)
+
+    inotify = None
+    if use_inotify and not once:
+        try:
+            inotify = Inotify()
+        except OSError:
+            print(Colors.YELLOW, "++ inotify is not available; polling only ++", Colors.END)
+
+    try:
+        while True:
+            before = json.dumps(state, sort_keys=True)
+            settled = poll(state, modalities, settle, inotify)
+            if settled:
+                queue_settled(state, settled)
+            if json.dumps(state, sort_keys=True) != before:
+                write_state(state)
+            if once:
+                break
+
+            # poll again after settle seconds if something is pending, else after interval
+            pending = any(entry['status'] == 'pending' for entry in state.values())
+            timeout = min(interval, settle) if pending else interval
+            if inotify:
+                inotify.wait(timeout)
+            else:
+                time.sleep(timeout)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if inotify:
+            inotify.close()
+
+
+def run_queue(follow=False, interval=60):
+    """Run queued jobs in order; failed jobs are moved to the failed list.
+
+    A job stays in the running list until its exit status is known, so jobs
+    of a runner that was killed or crashed are requeued when a runner starts.
+    """
+
+    requeue_interrupted()
+    while True:
+        job = pop_job()
+        if job is None:
+            if not follow:
+                return
+            time.sleep(interval)
+            continue
+
+        print(Colors.PURPLE, f"++ Running {job['stage']} for {job['subject']} ({job['detail']}) ++", Colors.END)
+        returncode = run_command(shlex.split(job['command']), stage=job['stage'], subject=job['subject'],
+                                 session=job['session'] or None)
+        if returncode != 0:
+            print(Colors.RED, f"++ {job['stage']} failed for {job['subject']} (exit {returncode}) ++", Colors.END)
+            with open(failed_file, 'a') as f:
+                f.write(json.dumps(dict(job, returncode=returncode,
+                                        failed=datetime.now().isoformat(timespec='seconds'))) + '\n')
+        finish_job(job)
+
+
+if __name__ == "__main__":
+
+    modalities = list(RAW_ROOTS)
+
+    # parse arguments
+    purpose = "watch Raw_Data for new scans and queue the bids_proc.sh stage jobs they need"
+    parser = ArgumentParser(description=purpose)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    watch_parser = subparsers.add_parser("watch", help="poll Raw_Data and queue jobs for new sessions")
+    watch_parser.add_argument("--modality", action="append", choices=modalities,
+                              help="only watch these modalities (repeatable)")
+    watch_parser.add_argument("--interval", type=float, default=300, help="seconds between polls")
+    watch_parser.add_argument("--settle", type=float, default=600,
+                              help="seconds a session's files must stay unchanged before it is queued")
+    watch_parser.add_argument("--backfill", action="store_true",
+                              help="on the first run, also queue sessions that are already in Raw_Data")
+    watch_parser.add_argument("--once", action="store_true", help="poll once and exit (e.g. from cron)")
+    watch_parser.add_argument("--no_inotify", action="store_true", help="only poll")
+
+    run_parser = subparsers.add_parser("run", help="run the queued jobs in order")
+    run_parser.add_argument("--follow", action="store_true", help="keep waiting for new jobs")
+    run_parser.add_argument("--interval", type=float, default=60, help="seconds between queue checks")
+
+    subparsers.add_parser("list", help="print the queued jobs")
+
+    args = parser.parse_args()
+
+    if args.command == "watch":
+        watch(args.modality or modalities, args.interval, args.settle, backfill=args.backfill,
+              once=args.once, use_inotify=not args.no_inotify)
+
+    elif args.command == "run":
+        run_queue(follow=args.follow, interval=args.interval)
+
+    elif args.command == "list":
+        for job in read_queue():
+            print(f"   {job['queued']}  {job['subject']:<8} {job['session']:<24} {job['stage']:<28} {job['detail']}")
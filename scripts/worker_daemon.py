@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Warm worker for the pipeline's Python steps. It imports the heavy libraries
+(numpy, pandas, pydicom, nibabel, MNE) once, listens on a Unix socket, and
+runs each job submitted with worker_run.py in a forked copy of itself, so the
+job starts with those modules loaded. Repository modules are dropped before
+each job and imported fresh with the job's own environment. Where forking a
+process with these libraries loaded is unsafe (Mac OS, or --no_fork) jobs are
+started as new interpreters instead.
+
+instrument.py records around worker_run.py keep the job's wall time; its CPU
+time is accounted to the worker.
+"""
+
+from argparse import ArgumentParser
+import importlib
+import json
+import os
+from pathlib import Path
+import runpy
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+
+from colors import Colors
+from instrument import logs_dir
+from worker_run import HEADER, connect, recv_exact, recv_message, send_message, socket_path
+
+PRELOAD = ['numpy', 'pandas', 'pydicom', 'nibabel', 'matplotlib', 'mne', 'mne_bids']
+# seconds `start` waits for the worker to answer (importing MNE is slow)
+START_TIMEOUT = 120
+# exit code of `start` when a worker is already listening
+ALREADY_RUNNING = 2
+
+
+def preload(modules):
+    """Import the modules that are installed; returns their names."""
+
+    loaded = []
+    for name in modules:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            continue
+        loaded.append(name)
+
+    return loaded
+
+
+def ping(path=None, timeout=5):
+    """The worker's status reply, or None if no worker answers."""
+
+    sock = connect(path, timeout=timeout)
+    if sock is None:
+        return None
+    with sock:
+        try:
+            send_message(sock, {'command': 'ping'})
+            return recv_message(sock)
+        except (OSError, ValueError):
+            return None
+
+
+def peer_uid(conn):
+    """uid of the connected client (the socket file is private where this is unknown)."""
+
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1]
+
+    return os.getuid()
+
+
+def recv_request(conn):
+    """(request, passed file descriptors) from a client."""
+
+    header, fds, _, _ = socket.recv_fds(conn, HEADER.size, 3)
+    if len(header) < HEADER.size:
+        header += recv_exact(conn, HEADER.size - len(header))
+    try:
+        request = json.loads(recv_exact(conn, HEADER.unpack(header)[0]))
+    except (ValueError, struct.error):
+        for fd in fds:
+            os.close(fd)
+        raise
+
+    return request, fds
+
+
+def drop_repo_modules():
+    """Forget modules imported from this directory so jobs import them with their own environment."""
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, '__file__', None)
+        if module_file and os.path.dirname(os.path.abspath(module_file)) == scripts_dir:
+            del sys.modules[name]
+
+
+def run_job(request, fds):
+    """Become the job: take over the client's stdio, cwd and environment and run the script."""
+
+    code = 1
+    try:
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+        sys.stdin = open(0, 'r', closefd=False)
+        sys.stdout = open(1, 'w', buffering=1 if os.isatty(1) else -1, closefd=False)
+        sys.stderr = open(2, 'w', buffering=1, closefd=False)
+
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        os.chdir(request['cwd'])
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.umask(request['umask'])
+
+        drop_repo_modules()
+        sys.argv = list(request['argv'])
+        sys.path[0] = os.path.dirname(sys.argv[0])
+        try:
+            runpy.run_path(sys.argv[0], run_name='__main__')
+            code = 0
+        except SystemExit as e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                print(e.code, file=sys.stderr)
+                code = 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        for stream in (sys.stdout, sys.stderr):
+            try:
+                stream.flush()
+            except Exception:
+                pass
+        os._exit(code)
+
+
+def supervise(conn, request, fds, use_fork):
+    """Run one job, stop it if the client goes away, and send back its exit code."""
+
+    if use_fork:
+        pid = os.fork()
+        if pid == 0:
+            conn.close()
+            run_job(request, fds)
+    else:
+        pid = subprocess.Popen([sys.executable] + request['argv'], cwd=request['cwd'], env=request['env'],
+                               umask=request['umask'], stdin=fds[0], stdout=fds[1], stderr=fds[2]).pid
+    for fd in fds:
+        os.close(fd)
+
+    # wake up when the job exits (pidfd, Linux) or poll for it
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        pidfd = None
+    watched = [conn] if pidfd is None else [conn, pidfd]
+    while True:
+        done, status = os.waitpid(pid, os.WNOHANG)
+        if done:
+            break
+        readable, _, _ = select.select(watched, [], [], 0.2 if pidfd is None else None)
+        if conn in readable and not conn.recv(1):
+            os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+            break
+    if pidfd is not None:
+        os.close(pidfd)
+
+    try:
+        send_message(conn, {'returncode': os.waitstatus_to_exitcode(status)})
+    except OSError:
+        pass
+    conn.close()
+
+
+def serve(path, use_fork=True):
+    """Listen on path and run jobs until asked to stop."""
+
+    if ping(path):
+        print(Colors.YELLOW, f"++ A worker is already listening on {path} ++", Colors.END)
+        return ALREADY_RUNNING
+    if os.path.exists(path):
+        os.unlink(path)
+
+    t0 = time.perf_counter()
+    loaded = preload(PRELOAD)
+    print(Colors.GREEN, f"++ Preloaded {', '.join(loaded)} in {time.perf_counter() - t0:.1f}s ++", Colors.END)
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(umask)
+    server.listen(64)
+
+    if use_fork:
+        # job supervisors are reaped automatically
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print(Colors.GREEN, f"++ Worker {os.getpid()} listening on {path} ++", Colors.END, flush=True)
+
+    n_jobs = 0
+    try:
+        while True:
+            conn, _ = server.accept()
+            if peer_uid(conn) != os.getuid():
+                conn.close()
+                continue
+            # a client that connects but never sends must not block the worker
+            conn.settimeout(10)
+            try:
+                request, fds = recv_request(conn)
+            except (OSError, ValueError, struct.error):
+                conn.close()
+                continue
+            conn.settimeout(None)
+
+            if request.get('command') == 'ping':
+                send_message(conn, {'pid': os.getpid(), 'preloaded': loaded, 'jobs': n_jobs,
+                                    'fork': use_fork})
+                conn.close()
+            elif request.get('command') == 'stop':
+                send_message(conn, {'stopping': True})
+                conn.close()
+                break
+            elif request.get('command') == 'run' and len(fds) == 3:
+                n_jobs += 1
+                sys.stdout.flush()
+                sys.stderr.flush()
+                if not use_fork:
+                    threading.Thread(target=supervise, args=(conn, request, fds, False), daemon=True).start()
+                    continue
+                if os.fork() == 0:
+                    server.close()
+                    signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                    try:
+                        supervise(conn, request, fds, True)
+                    finally:
+                        os._exit(0)
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+            else:
+                for fd in fds:
+                    os.close(fd)
+                conn.close()
+    finally:
+        server.close()
+        if os.path.exists(path):
+            os.unlink(path)
+
+    print(Colors.GREEN, f"++ Worker stopped after {n_jobs} job(s) ++", Colors.END)
+    return 0
+
+
+if __name__ == "__main__":
+
+    # parse arguments
+    purpose = "warm worker that runs pipeline Python scripts with their libraries preloaded"
+    parser = ArgumentParser(description=purpose)
+    parser.add_argument("--socket", default=socket_path(), help="Unix socket path")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="run the worker in the foreground")
+    serve_parser.add_argument("--no_fork", action="store_true", help="start every job as a new interpreter")
+
+    start_parser = subparsers.add_parser("start", help=f"start the worker in the background "
+                                                       f"(exit {ALREADY_RUNNING} if one is running)")
+    start_parser.add_argument("--no_fork", action="store_true", help="start every job as a new interpreter")
+
+    subparsers.add_parser("stop", help="stop the worker")
+    subparsers.add_parser("status", help="print the worker status (exit 1 if none is running)")
+
+    args = parser.parse_args()
+
+    if args.command in ("serve", "start"):
+        use_fork = hasattr(os, 'fork') and sys.platform != 'darwin' and not args.no_fork
+
+    if args.command == "serve":
+        sys.exit(serve(args.socket, use_fork))
+
+    elif args.command == "start":
+        if ping(args.socket):
+            print(Colors.YELLOW, f"++ A worker is already listening on {args.socket} ++", Colors.END)
+            sys.exit(ALREADY_RUNNING)
+        logs_dir.mkdir(parents=True, exist_ok=True)
+        log_file = logs_dir / f'worker_daemon_{socket.gethostname()}.log'
+        cmd = [sys.executable, str(Path(__file__).resolve()), '--socket', args.socket, 'serve']
+        if not use_fork:
+            cmd.append('--no_fork')
+        with open(log_file, 'a') as log:
+            proc = subprocess.Popen(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        deadline = time.monotonic() + START_TIMEOUT
+        while time.monotonic() < deadline and proc.poll() is None:
+            status = ping(args.socket)
+            if status:
+                print(Colors.GREEN, f"++ Worker {status['pid']} started ({', '.join(status['preloaded'])}) ++",
+                      Colors.END)
+                sys.exit()
+            time.sleep(0.5)
+        print(Colors.RED, f"++ Worker did not start (see {log_file}) ++", Colors.END)
+        sys.exit(1)
+
+    elif args.command == "stop":
+        sock = connect(args.socket, timeout=5)
+        if sock is None:
+            print(Colors.YELLOW, "++ No worker is running ++", Colors.END)
+            sys.exit()
+        with sock:
+            send_message(sock, {'command': 'stop'})
+            recv_message(sock)
+        print(Colors.GREEN, "++ Worker stopped ++", Colors.END)
+
+    elif args.command == "status":
+        status = ping(args.socket)
+        if status is None:
+            print("++ No worker is running ++")
+            sys.exit(1)
+        print(f"++ Worker {status['pid']}: {status['jobs']} job(s) run, "
+              f"preloaded {', '.join(status['preloaded'])}, fork {status['fork']} ++")
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 2026
+
+Run a pipeline Python script in the warm worker (worker_daemon.py) if one is
+listening, else run it directly:
+
+    python worker_run.py script.py [args ...]
+
+The job gets this process's stdin/stdout/stderr, working directory,
+environment and umask, and its exit code is returned as ours. Only the
+standard library is imported here so that the client itself starts fast.
+"""
+
+import json
+import os
+import socket
+import struct
+import sys
+
+# set BIDS_PROC_WORKER=0 to always run scripts directly
+DISABLE_ENV = 'BIDS_PROC_WORKER'
+SOCKET_ENV = 'BIDS_PROC_WORKER_SOCKET'
+HEADER = struct.Struct('!I')
+
+
+def socket_path():
+    """Unix socket of this user's worker ($BIDS_PROC_WORKER_SOCKET overrides)."""
+
+    if os.environ.get(SOCKET_ENV):
+        return os.environ[SOCKET_ENV]
+    base = os.environ.get('XDG_RUNTIME_DIR') or '/tmp'
+
+    return os.path.join(base, f'bids_proc_worker_{os.getuid()}.sock')
+
+
+def recv_exact(sock, n):
+    """Read exactly n bytes (fewer only if the peer closed the connection)."""
+
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+
+    return data
+
+
+def send_message(sock, message, fds=()):
+    """Send a length-prefixed JSON message, passing fds along with the header."""
+
+    payload = json.dumps(message).encode()
+    if fds:
+        socket.send_fds(sock, [HEADER.pack(len(payload))], list(fds))
+    else:
+        sock.sendall(HEADER.pack(len(payload)))
+    sock.sendall(payload)
+
+
+def recv_message(sock):
+    """Receive one message sent with send_message (None on EOF)."""
+
+    header = recv_exact(sock, HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    payload = recv_exact(sock, HEADER.unpack(header)[0])
+
+    return json.loads(payload)
+
+
+def connect(path=None, timeout=None):
+    """Connected socket to the worker, or None if none is listening."""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path or socket_path())
+    except OSError:
+        sock.close()
+        return None
+
+    return sock
+
+
+def run_in_worker(argv):
+    """Exit code of argv run by the worker, or None if no worker is available."""
+
+    if os.environ.get(DISABLE_ENV) == '0':
+        return None
+    sock = connect()
+    if sock is None:
+        return None
+
+    umask = os.umask(0)
+    os.umask(umask)
+    request = {
+        'command': 'run',
+        'argv': [os.path.abspath(argv[0])] + argv[1:],
+        'cwd': os.getcwd(),
+        'env': dict(os.environ),
+        'umask': umask,
+    }
+    with sock:
+        try:
+            send_message(sock, request, fds=[0, 1, 2])
+        except OSError:
+            return None
+        # the job may have started from here on, so it is never rerun directly
+        try:
+            reply = recv_message(sock)
+        except OSError:
+            reply = None
+        except KeyboardInterrupt:
+            # closing the connection makes the worker stop the job
+            return 130
+
+    if reply is None:
+        print("++ worker exited without a result ++", file=sys.stderr)
+        return 1
+
+    return reply['returncode']
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) < 2:
+        sys.exit("usage: worker_run.py script.py [args ...]")
+
+    returncode = run_in_worker(sys.argv[1:])
+    if returncode is None:
+        # no worker: replace this process with a plain interpreter
+        os.execv(sys.executable, [sys.executable] + sys.argv[1:])
+
+    sys.exit(returncode)
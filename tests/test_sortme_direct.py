@@ -0,0 +1,36 @@
+"""sortme.py --direct must write the same NIfTI files and sidecars as dcm2niix."""
+
+import json
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / 'scripts'))
+
+pytest.importorskip('pydicom')
+pytest.importorskip('nibabel')
+pytestmark = pytest.mark.skipif(shutil.which('dcm2niix') is None, reason='dcm2niix is not installed')
+
+
+def test_direct_matches_dcm2niix(tmp_path):
+    from benchmark import validate_direct
+
+    # voxels, affine, zooms/TR and every sidecar field except sortme.directMissingKeys
+    differences, _ = validate_direct(tmp_path, n_files=240)
+
+    assert differences == []
+
+
+def test_direct_sidecar_keys(tmp_path):
+    from benchmark import validate_direct
+    from sortme import directMissingKeys
+
+    validate_direct(tmp_path, n_files=240)
+    for echo_json in sorted((tmp_path / 'validate_240_dcm2niix').glob('echo_*.json')):
+        ref = json.loads(echo_json.read_text())
+        new = json.loads((tmp_path / 'validate_240_direct' / echo_json.name).read_text())
+
+        assert set(ref) - set(new) <= set(directMissingKeys)
+        assert new['ConversionSoftware'] == 'sortme.py'